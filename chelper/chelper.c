@@ -8,6 +8,8 @@
 #include <fcntl.h>
 #include <dirent.h>
 #include <sys/mount.h>
+#include <ctype.h>
+#include <errno.h>
 
 #include "chelper.h"
 
@@ -18,13 +20,14 @@
    Lots of fork()ing here
 */
 
-int detach_image(void) {
+int detach_image(char *wanted) {
   pid_t pid;
   int counter = 0;
   int result,completed,outerloop, outercompleted;
-  char *s,*device,*mountpoint;
+  char *device,*mountpoint;
   FILE *fp;
   char buf[1024];   /* just something big */
+  char field[1024];
 
   outerloop = 0;
   outercompleted = 0;
@@ -37,12 +40,11 @@ int detach_image(void) {
       exit(1);
     }
     while (fgets(buf,1023,fp) != NULL) {
-      s = strstr(buf, MOUNTPOINT);
-      if (!s)
+      /* Match the mount point field exactly. A prefix match would mix
+	 MOUNTPOINT up with the worker mount points MOUNTPOINT-n */
+      if (sscanf(buf, "%*s %1023s", field) != 1)
 	continue;
-      if (strlen(s) < 10)     /*something fishy is going on */
-	continue;
-      else {
+      if (strcmp(field, wanted) == 0) {
 	completed=1;
 	break;
       }
@@ -264,15 +266,15 @@ int is_dir_empty(char *path) {
 }
 
 /* Mount a specific file system */
-int mount_ntfs_filesystem(char *device) {
+int mount_ntfs_filesystem(char *device, char *mountpoint) {
   int result;
   pid_t pid;
 
-  if (!is_dir_empty(MOUNTPOINT)) {
+  if (!is_dir_empty(mountpoint)) {
     fprintf(stderr,"Mount point not empty\n");
     return (-1);
   }
-  char *arg[] = {NTFS_3G, "-o", "windows_names,streams_interface=windows", device, MOUNTPOINT, NULL};
+  char *arg[] = {NTFS_3G, "-o", "windows_names,streams_interface=windows", device, mountpoint, NULL};
   
   pid = fork();
   if (pid == -1) {
@@ -303,15 +305,15 @@ int mount_ntfs_filesystem(char *device) {
 }
 
 /* Mount FAT file system */
-int mount_fat_filesystem(char *device) {
+int mount_fat_filesystem(char *device, char *mountpoint) {
   int result;
   pid_t pid;
 
-  if (!is_dir_empty(MOUNTPOINT)) {
+  if (!is_dir_empty(mountpoint)) {
     fprintf(stderr,"Mount point not empty\n");
     return (-1);
   }
-  char *arg[] = {MOUNT_FAT, "-t", "vfat", "-o", "umask=000", device, MOUNTPOINT, NULL};
+  char *arg[] = {MOUNT_FAT, "-t", "vfat", "-o", "umask=000", device, mountpoint, NULL};
   
   pid = fork();
   if (pid == -1) {
@@ -341,33 +343,19 @@ int mount_fat_filesystem(char *device) {
   return (-1);
 }
 
-/* Attach a file to a loopback interface. Return char* to loopback device name 
-   After this function the rest of the program can assure the loopback device is 
-   "owned" by this process 
-   Also check that file attached is a regular file, not a symlink, device, 
-   fifo or anything weird, and that hard link count is exactly 1.
-*/
-
-char *attach_file(char *prefix, char *command) {
-  int i,result=42;
+/* Full path of an image file under prefix. Only a regular file with exactly
+   one link is accepted */
+char *image_path(char *prefix, char *fname) {
   char *path;
-  pid_t   pid;
-  char  *arg[10];
-  int ipipe[2];
-  char *loopback;
   struct stat statbuf;
 
-  if (!is_dir_empty(MOUNTPOINT)) {
-    fprintf(stderr,"Mount point not empty\n");
-    exit(1);
-  }
-  path = malloc(sizeof(char)*(strlen(prefix)+strlen(command)+1));
+  path = malloc(sizeof(char)*(strlen(prefix)+strlen(fname)+1));
   if (path == NULL) {
     perror(PNAME);
     exit(1);
   }
   strcpy(path, prefix);
-  strcat(path, command);
+  strcat(path, fname);
   sanitize_path(path);
 
   if (lstat (path, &statbuf) == -1) {
@@ -382,8 +370,31 @@ char *attach_file(char *prefix, char *command) {
     fprintf(stderr, "file is not a regular file, go away\n");
     exit(1);
   }
+  return path;
+}
 
+/* Attach a file to a loopback interface. Return char* to loopback device name 
+   After this function the rest of the program can assure the loopback device is 
+   "owned" by this process 
+   Also check that file attached is a regular file, not a symlink, device, 
+   fifo or anything weird, and that hard link count is exactly 1.
+   losetup -f --show finds a free device and binds it in one step, so parallel
+   workers attaching at the same time cannot race for the same device.
+*/
 
+char *attach_file(char *prefix, char *command, char *mountpoint) {
+  int i,result=42;
+  char *path;
+  pid_t   pid;
+  char  *arg[10];
+  int ipipe[2];
+  char *loopback;
+
+  if (!is_dir_empty(mountpoint)) {
+    fprintf(stderr,"Mount point not empty\n");
+    exit(1);
+  }
+  path = image_path(prefix, command);
 
   /* A kludge to redirect child stdout back to parent to find a loopback device */
   if (pipe(ipipe)) {
@@ -391,7 +402,7 @@ char *attach_file(char *prefix, char *command) {
     exit(1);
   }
 
-  /* Fork to run losetup -f to get a free loopback interface */
+  /* Fork to run losetup -f --show pathname */
   pid = fork();
   if (pid == -1) {
     perror(PNAME);
@@ -407,7 +418,9 @@ char *attach_file(char *prefix, char *command) {
 
     arg[0] = LOSETUP;
     arg[1] = "-f";
-    arg[2] = NULL;
+    arg[2] = "--show";
+    arg[3] = path;
+    arg[4] = NULL;
     if (execv(LOSETUP, arg) == -1) {
       perror(PNAME);
       exit(1);
@@ -422,51 +435,49 @@ char *attach_file(char *prefix, char *command) {
       perror(PNAME);
       exit(1);
     }
-    loopback[read(ipipe[0],loopback,256)] = 0;
-    if (strlen(loopback) < 5) {
-      fprintf(stderr, "no loopback device found\n");
-      wait(&result);
-      close(ipipe[0]);
-      exit(1);
-    }
-    /* Get a free loopback device to loopback */
-    loopback[strlen(loopback)-1] = 0;
+    i = read(ipipe[0],loopback,255);
+    loopback[i > 0 ? i : 0] = 0;
     wait(&result);
     close(ipipe[0]);
-    if (result != 0) {
-      fprintf(stderr, "this should not happen, losetup -f did not return a proper value\n");
-      exit(result);
+    if (result != 0 || strlen(loopback) < 5) {
+      fprintf(stderr, "no loopback device found\n");
+      free(loopback);
+      return NULL;
     }
-    /* Attach the loopback device. Examine return value as not a single state operation */
-    arg[0] = LOSETUP;
-    arg[1] = loopback;
-    arg[2] = path;
-    arg[3] = NULL;
+    /* Strip the trailing newline */
+    loopback[strlen(loopback)-1] = 0;
+    return loopback;
+  }
+}
 
-    /* Fork to exec losetup /dev/loopx pathname */
-    pid = fork();
-    if (pid == -1) {
-      perror(PNAME);
+/* Mount point of a worker slot: MOUNTPOINT-n. With create set the directory
+   is created on first use */
+char *slot_mountpoint(char *base, char *slot, int create) {
+  char *mp;
+  int n;
+
+  for (n=0; n < strlen(slot); n++) {
+    if (!isdigit(slot[n])) {
+      fprintf(stderr, "slot must be a number\n");
       exit(1);
     }
-    if (pid == 0) {
-      if (execv(LOSETUP, arg) == -1) {
-	perror(PNAME);
-	exit(1);
-      }
-      /* This is never reached */
-      return NULL;
-    }
-    else {
-      wait (&result);
-      if (result == 0) 
-	return loopback;
-      else {
-	free(loopback);
-	return NULL;
-      }
-    }
   }
+  n = atoi(slot);
+  if (strlen(slot) == 0 || strlen(slot) > 3 || n >= MAX_SLOTS) {
+    fprintf(stderr, "slot must be between 0 and %d\n", MAX_SLOTS-1);
+    exit(1);
+  }
+  mp = malloc(sizeof(char)*(strlen(base)+8));
+  if (mp == NULL) {
+    perror(PNAME);
+    exit(1);
+  }
+  sprintf(mp, "%s-%d", base, n);
+  if (create && mkdir(mp, 0755) == -1 && errno != EEXIST) {
+    perror(PNAME);
+    exit(1);
+  }
+  return mp;
 }
 
 /* Creates FAT filesystem */
@@ -696,7 +707,9 @@ void create_file(char *prefix, char *filename, long size, int contents) {
 
 
 
-main (int argc, char **argv) {
+/* Run one command line. Every path ends in exit(). Also the body of the
+   requests a daemon connection runs in a child process */
+int chelper_command(int argc, char **argv) {
   char *params[10], *lodevice;
   char *prefix, *fname, *mountpoint;
   pid_t pid, cluster_size=0;
@@ -735,7 +748,7 @@ main (int argc, char **argv) {
 #endif
 
   if (argc < 2) {
-    fprintf(stderr,"Usage: %s [create fstype size cluster_size name [clean | random] filename | attach fstype filename | detach]\n", PNAME);
+    fprintf(stderr,"Usage: %s [create fstype size cluster_size name [clean | random] filename | attach fstype filename [slot] | detach [slot] | daemon]\n", PNAME);
     exit(1);
   }
 
@@ -743,6 +756,14 @@ main (int argc, char **argv) {
     exit(process_lxc(argc, argv));
   }
 
+  if (strcmp(argv[1], "daemon") == 0) {
+    if (argc != 2) {
+      fprintf(stderr,"Usage: %s daemon\n", PNAME);
+      exit(1);
+    }
+    exit(run_daemon(prefix, mountpoint));
+  }
+
 
   if (strcmp(argv[1], "create") == 0) {
     if (argc < 2) {
@@ -811,7 +832,7 @@ main (int argc, char **argv) {
 	fprintf(stderr, "Too long parameter %s\n", argv[8]);
 	exit(1);
       }
-      fname = malloc(sizeof(char)*strlen(argv[7])+1);
+      fname = malloc(sizeof(char)*strlen(argv[8])+1);
       if (fname == NULL) {
 	perror(PNAME);
 	exit(1);
@@ -855,10 +876,10 @@ main (int argc, char **argv) {
 
 
   
-  /* Attach */
+  /* Attach. Optional slot selects worker mount point MOUNTPOINT-slot */
   if (strcmp(argv[1], "attach") == 0) {
-    if (argc != 4) {
-      fprintf(stderr,"Usage: %s attach fstype filename\n", PNAME);
+    if (argc != 4 && argc != 5) {
+      fprintf(stderr,"Usage: %s attach fstype filename [slot]\n", PNAME);
       exit(1);
     }
     if (strlen(argv[3]) > MAX_PATH_LENGTH) {
@@ -871,16 +892,18 @@ main (int argc, char **argv) {
       exit(1);
     }
     strcpy(fname, argv[3]);
-    lodevice = attach_file(prefix,fname);
+    if (argc == 5)
+      mountpoint = slot_mountpoint(mountpoint, argv[4], 1);
+    lodevice = attach_file(prefix,fname,mountpoint);
     if (lodevice) {
       if (strcmp(argv[2],"ntfs") == 0) {
-	q = mount_ntfs_filesystem(lodevice);
+	q = mount_ntfs_filesystem(lodevice, mountpoint);
 	if (q != 0) 
 	  detach_device(lodevice);
 	exit(q);
       }
       if (strncmp(argv[2], "FAT",3 ) == 0) {
-	q = mount_fat_filesystem(lodevice);
+	q = mount_fat_filesystem(lodevice, mountpoint);
 	if (q != 0)
 	  detach_device(lodevice);
 	exit(q);
@@ -893,15 +916,24 @@ main (int argc, char **argv) {
     }
     else
       fprintf (stderr, "Cannot find loopback device\n");
-    exit(0);
+    exit(1);
   }
   
   /* detach */
   if (strcmp(argv[1], "detach") == 0) {
+    if (argc != 2 && argc != 3) {
+      fprintf(stderr,"Usage: %s detach [slot]\n", PNAME);
+      exit(1);
+    }
+    if (argc == 3)
+      mountpoint = slot_mountpoint(mountpoint, argv[2], 0);
     freopen("/dev/null","w",stderr);
-    exit(detach_image());
+    exit(detach_image(mountpoint));
   }
-  fprintf(stderr,"Usage: %s [create fstype size cluster_size name [clean | random] filename | attach fstype filename | detach]\n", PNAME);  
+  fprintf(stderr,"Usage: %s [create fstype size cluster_size name [clean | random] filename | attach fstype filename [slot] | detach [slot] | daemon]\n", PNAME);  
   exit(1);
 }
 
+int main (int argc, char **argv) {
+  return chelper_command(argc, argv);
+}
@@ -0,0 +1,507 @@
+#define _GNU_SOURCE
+#include <stdio.h>
+#include <unistd.h>
+#include <string.h>
+#include <stdlib.h>
+#include <sys/types.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <sys/mount.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <sys/ioctl.h>
+#include <sys/wait.h>
+#include <linux/loop.h>
+#include <signal.h>
+#include <errno.h>
+
+#include "chelper.h"
+
+/* chelper daemon. Listens on HELPER_SOCKET and serves the commands of the
+   command line, so that a process building images keeps one connection
+   instead of running chelper for every mount.
+
+   A request is its arguments without "chelper", each followed by a newline,
+   and an empty line. The reply is a line "status length" and length bytes of
+   output. status is what the command line would exit with.
+
+   Every connection is served by its own process. attach, detach and status
+   are handled there: the image is bound to a loop device the connection keeps
+   open and reuses, FAT is mounted with mount(2) and detach unmounts without
+   running umount and losetup. create, lxc and detach of an image attached
+   elsewhere run the command line code in a child, and its standard output is
+   sent back. A request the command line would refuse with exit() ends the
+   connection.
+*/
+
+#define MAX_ARGS 32
+#define MAX_ARG_LENGTH 4096
+
+struct pooled_loop {
+  int fd;              /* open /dev/loopN, -1 if none */
+  int number;
+  ino_t inode;         /* image bound to the device */
+  char *mountpoint;    /* where the image is mounted, NULL if unused */
+};
+
+static struct pooled_loop pool[LOOP_POOL];
+
+/* Bind an open image to a loop device. A device of the pool is tried first,
+   another process may have taken it after it was released. Returns the pool
+   entry or -1 */
+static int bind_loop(int filefd) {
+  int i, ctl, n, fd, tries;
+  char device[32];
+
+  for (i=0; i < LOOP_POOL; i++) {
+    if (pool[i].fd == -1 || pool[i].mountpoint != NULL)
+      continue;
+    if (ioctl(pool[i].fd, LOOP_SET_FD, filefd) == 0)
+      return i;
+    close(pool[i].fd);
+    pool[i].fd = -1;
+  }
+
+  for (i=0; i < LOOP_POOL && pool[i].fd != -1; i++)
+    ;
+  if (i == LOOP_POOL) {
+    fprintf(stderr, "all pooled loop devices in use\n");
+    return -1;
+  }
+  ctl = open("/dev/loop-control", O_RDWR|O_CLOEXEC);
+  if (ctl == -1) {
+    perror(PNAME);
+    return -1;
+  }
+  /* A free device can be taken by someone else before it is bound */
+  for (tries=0; tries < 10; tries++) {
+    n = ioctl(ctl, LOOP_CTL_GET_FREE);
+    if (n < 0)
+      break;
+    sprintf(device, "/dev/loop%d", n);
+    fd = open(device, O_RDWR|O_CLOEXEC);
+    if (fd == -1)
+      break;
+    if (ioctl(fd, LOOP_SET_FD, filefd) == 0) {
+      close(ctl);
+      pool[i].fd = fd;
+      pool[i].number = n;
+      return i;
+    }
+    close(fd);
+    if (errno != EBUSY)
+      break;
+  }
+  close(ctl);
+  fprintf(stderr, "no loopback device found\n");
+  return -1;
+}
+
+/* Unbind the image of pool entry i. While the device is open elsewhere, as
+   by ntfs-3g which closes it after the unmount, the kernel only releases it
+   at the last close. Wait for that, the image is complete when detach
+   returns. The descriptor of the pool is reopened until then so it does not
+   hold the device */
+static int release_loop(int i) {
+  struct loop_info64 info;
+  char device[32];
+  int n;
+
+  free(pool[i].mountpoint);
+  pool[i].mountpoint = NULL;
+  if (ioctl(pool[i].fd, LOOP_CLR_FD, 0) == -1 && errno != ENXIO)
+    perror(PNAME);
+
+  sprintf(device, "/dev/loop%d", pool[i].number);
+  for (n=0; n < 1000; n++) {
+    if (ioctl(pool[i].fd, LOOP_GET_STATUS64, &info) == -1) {
+      if (errno == ENXIO)
+	return 0;
+      break;
+    }
+    /* Released and already bound to someone else's image */
+    if (info.lo_inode != pool[i].inode)
+      break;
+    close(pool[i].fd);
+    usleep(10000);
+    pool[i].fd = open(device, O_RDWR|O_CLOEXEC);
+    if (pool[i].fd == -1) {
+      perror(PNAME);
+      return -1;
+    }
+  }
+  close(pool[i].fd);
+  pool[i].fd = -1;
+  if (n == 1000) {
+    fprintf(stderr, "%s still busy\n", device);
+    return -1;
+  }
+  return 0;
+}
+
+/* attach fstype filename [slot] */
+static int daemon_attach(char *prefix, char *mountpoint, int argc, char **argv) {
+  struct stat statbuf;
+  char *path, *mp, device[32];
+  int i, filefd, q;
+
+  if (argc != 3 && argc != 4) {
+    fprintf(stderr,"Usage: %s attach fstype filename [slot]\n", PNAME);
+    return 1;
+  }
+  if (strlen(argv[2]) > MAX_PATH_LENGTH) {
+    fprintf(stderr, "Too long parameter %s\n", argv[2]);
+    return 1;
+  }
+  if (strcmp(argv[1], "ntfs") != 0 && strncmp(argv[1], "FAT", 3) != 0) {
+    fprintf(stderr, "unknown file system type %s\n", argv[1]);
+    return 1;
+  }
+  if (argc == 4)
+    mp = slot_mountpoint(mountpoint, argv[3], 1);
+  else
+    mp = strdup(mountpoint);
+  if (!is_dir_empty(mp)) {
+    fprintf(stderr,"Mount point not empty\n");
+    free(mp);
+    return 1;
+  }
+
+  /* Checked again on the open file, it could be replaced in between */
+  path = image_path(prefix, argv[2]);
+  filefd = open(path, O_RDWR|O_NOFOLLOW|O_CLOEXEC);
+  free(path);
+  if (filefd == -1 || fstat(filefd, &statbuf) == -1) {
+    perror(PNAME);
+    if (filefd != -1)
+      close(filefd);
+    free(mp);
+    return 1;
+  }
+  if (statbuf.st_nlink != 1 || (statbuf.st_mode & S_IFMT) != S_IFREG) {
+    fprintf(stderr, "file is not a regular file with one link\n");
+    close(filefd);
+    free(mp);
+    return 1;
+  }
+  i = bind_loop(filefd);
+  close(filefd);
+  if (i == -1) {
+    free(mp);
+    return 1;
+  }
+  pool[i].inode = statbuf.st_ino;
+  sprintf(device, "/dev/loop%d", pool[i].number);
+
+  if (strcmp(argv[1], "ntfs") == 0)
+    q = mount_ntfs_filesystem(device, mp);
+  else {
+    q = mount(device, mp, "vfat", 0, "umask=000");
+    if (q == -1)
+      perror(PNAME);
+  }
+  if (q != 0) {
+    release_loop(i);
+    free(mp);
+    return 1;
+  }
+  pool[i].mountpoint = mp;
+  return 0;
+}
+
+/* detach [slot]. Returns -1 if the image was not attached by this
+   connection */
+static int daemon_detach(char *mountpoint, int argc, char **argv) {
+  char *mp;
+  int i, counter;
+
+  if (argc != 1 && argc != 2) {
+    fprintf(stderr,"Usage: %s detach [slot]\n", PNAME);
+    return 1;
+  }
+  mp = argc == 2 ? slot_mountpoint(mountpoint, argv[1], 0) : mountpoint;
+  for (i=0; i < LOOP_POOL; i++)
+    if (pool[i].mountpoint != NULL && strcmp(pool[i].mountpoint, mp) == 0)
+      break;
+  if (mp != mountpoint)
+    free(mp);
+  if (i == LOOP_POOL)
+    return -1;
+
+  for (counter=0; umount2(pool[i].mountpoint, 0) == -1; counter++) {
+    if (errno != EBUSY || counter >= 10) {
+      fprintf(stderr, "mount point busy, cannot continue\n");
+      return 1;
+    }
+    sync();
+    sleep(1);
+  }
+  return release_loop(i) == 0 ? 0 : 1;
+}
+
+static int daemon_status(char **output, size_t *length) {
+  FILE *fp;
+  int i;
+
+  fp = open_memstream(output, length);
+  if (fp == NULL) {
+    perror(PNAME);
+    return 1;
+  }
+  fprintf(fp, "connection %d\n", getpid());
+  for (i=0; i < LOOP_POOL; i++) {
+    if (pool[i].fd == -1)
+      continue;
+    fprintf(fp, "/dev/loop%d %s\n", pool[i].number,
+	    pool[i].mountpoint ? pool[i].mountpoint : "free");
+  }
+  fclose(fp);
+  return 0;
+}
+
+/* Run a request with the command line code in a child and collect its
+   standard output */
+static int run_child(int argc, char **argv, char **output, size_t *length) {
+  int ipipe[2], result;
+  size_t size = 4096;
+  ssize_t n;
+  char **arg;
+  pid_t pid;
+
+  if (pipe(ipipe)) {
+    perror(PNAME);
+    return 1;
+  }
+  pid = fork();
+  if (pid == -1) {
+    perror(PNAME);
+    close(ipipe[0]);
+    close(ipipe[1]);
+    return 1;
+  }
+  if (pid == 0) {
+    dup2(ipipe[1], STDOUT_FILENO);
+    close(ipipe[0]);
+    close(ipipe[1]);
+    arg = malloc(sizeof(char*)*(argc+2));
+    if (arg == NULL) {
+      perror(PNAME);
+      exit(1);
+    }
+    arg[0] = PNAME;
+    memcpy(arg+1, argv, sizeof(char*)*argc);
+    arg[argc+1] = NULL;
+    exit(chelper_command(argc+1, arg));
+  }
+
+  close(ipipe[1]);
+  *output = malloc(size);
+  *length = 0;
+  while (*output != NULL && (n = read(ipipe[0], *output+*length, size-*length)) > 0) {
+    *length += n;
+    if (*length == size) {
+      size *= 2;
+      *output = realloc(*output, size);
+    }
+  }
+  close(ipipe[0]);
+  waitpid(pid, &result, 0);
+  if (*output == NULL) {
+    *length = 0;
+    return 1;
+  }
+  return WIFEXITED(result) ? WEXITSTATUS(result) : 1;
+}
+
+static int send_all(int fd, char *buf, size_t length) {
+  ssize_t n;
+
+  while (length > 0) {
+    n = send(fd, buf, length, MSG_NOSIGNAL);
+    if (n == -1) {
+      if (errno == EINTR)
+	continue;
+      return -1;
+    }
+    buf += n;
+    length -= n;
+  }
+  return 0;
+}
+
+static void serve_connection(int fd, char *prefix, char *mountpoint) {
+  FILE *in;
+  char line[MAX_ARG_LENGTH+2], header[32], *argv[MAX_ARGS], *output;
+  size_t length;
+  int argc, status, i;
+
+  for (i=0; i < LOOP_POOL; i++) {
+    pool[i].fd = -1;
+    pool[i].mountpoint = NULL;
+  }
+  in = fdopen(fd, "r");
+  if (in == NULL) {
+    perror(PNAME);
+    exit(1);
+  }
+  while (1 == 1) {
+    argc = 0;
+    while (fgets(line, sizeof(line), in) != NULL) {
+      if (strlen(line) == 0 || line[strlen(line)-1] != '\n') {
+	fprintf(stderr, "too long request\n");
+	exit(1);
+      }
+      line[strlen(line)-1] = 0;
+      if (strlen(line) == 0)
+	break;
+      if (argc == MAX_ARGS) {
+	fprintf(stderr, "too many arguments\n");
+	exit(1);
+      }
+      argv[argc++] = strdup(line);
+    }
+    if (feof(in) || ferror(in))
+      exit(0);
+
+    output = NULL;
+    length = 0;
+    if (argc == 0)
+      status = 1;
+    else if (strcmp(argv[0], "attach") == 0)
+      status = daemon_attach(prefix, mountpoint, argc, argv);
+    else if (strcmp(argv[0], "detach") == 0) {
+      status = daemon_detach(mountpoint, argc, argv);
+      if (status == -1)
+	status = run_child(argc, argv, &output, &length);
+    }
+    else if (strcmp(argv[0], "status") == 0)
+      status = daemon_status(&output, &length);
+    else if (strcmp(argv[0], "create") == 0 || strcmp(argv[0], "lxc") == 0)
+      status = run_child(argc, argv, &output, &length);
+    else {
+      fprintf(stderr, "unknown request %s\n", argv[0]);
+      status = 1;
+    }
+
+    sprintf(header, "%d %lu\n", status, (unsigned long)length);
+    if (send_all(fd, header, strlen(header)) == -1 ||
+	send_all(fd, output, length) == -1)
+      exit(0);
+    free(output);
+    for (i=0; i < argc; i++)
+      free(argv[i]);
+  }
+}
+
+/* Start the daemon unless one is already listening. Returns once the socket
+   accepts connections, the daemon goes on in the background */
+int run_daemon(char *prefix, char *mountpoint) {
+  struct sockaddr_un addr;
+  struct stat statbuf;
+  struct ucred cred;
+  socklen_t len;
+  int sock, fd, devnull;
+  long maxfd;
+  pid_t pid;
+
+  if (geteuid() != 0) {
+    fprintf(stderr, "daemon needs a setuid root %s\n", PNAME);
+    return 1;
+  }
+  if (strlen(HELPER_SOCKET) >= sizeof(addr.sun_path)) {
+    fprintf(stderr, "too long HELPER_SOCKET\n");
+    return 1;
+  }
+  memset(&addr, 0, sizeof(addr));
+  addr.sun_family = AF_UNIX;
+  strcpy(addr.sun_path, HELPER_SOCKET);
+
+  sock = socket(AF_UNIX, SOCK_STREAM|SOCK_CLOEXEC, 0);
+  if (sock == -1) {
+    perror(PNAME);
+    return 1;
+  }
+  if (connect(sock, (struct sockaddr *)&addr, sizeof(addr)) == 0) {
+    close(sock);
+    return 0;
+  }
+  close(sock);
+
+  /* Left behind by a daemon that is gone */
+  if (lstat(HELPER_SOCKET, &statbuf) == 0) {
+    if ((statbuf.st_mode & S_IFMT) != S_IFSOCK) {
+      fprintf(stderr, "%s is not a socket\n", HELPER_SOCKET);
+      return 1;
+    }
+    unlink(HELPER_SOCKET);
+  }
+
+  sock = socket(AF_UNIX, SOCK_STREAM|SOCK_CLOEXEC, 0);
+  if (sock == -1) {
+    perror(PNAME);
+    return 1;
+  }
+  umask(077);
+  if (bind(sock, (struct sockaddr *)&addr, sizeof(addr)) == -1 ||
+      chown(HELPER_SOCKET, getuid(), getgid()) == -1 ||
+      listen(sock, 16) == -1) {
+    perror(PNAME);
+    return 1;
+  }
+
+  pid = fork();
+  if (pid == -1) {
+    perror(PNAME);
+    return 1;
+  }
+  if (pid != 0)
+    return 0;
+
+  setsid();
+  if (chdir("/") == -1) {
+    perror(PNAME);
+    exit(1);
+  }
+  devnull = open("/dev/null", O_RDWR);
+  if (devnull == -1) {
+    perror(PNAME);
+    exit(1);
+  }
+  dup2(devnull, STDIN_FILENO);
+  dup2(devnull, STDOUT_FILENO);
+  dup2(devnull, STDERR_FILENO);
+  /* Nothing of the process that started the daemon stays open */
+  maxfd = sysconf(_SC_OPEN_MAX);
+  for (fd=3; fd < maxfd; fd++)
+    if (fd != sock)
+      close(fd);
+  /* Connection processes are not waited for */
+  signal(SIGCHLD, SIG_IGN);
+
+  while (1 == 1) {
+    fd = accept4(sock, NULL, NULL, SOCK_CLOEXEC);
+    if (fd == -1) {
+      if (errno != EINTR) {
+	perror(PNAME);
+	sleep(1);
+      }
+      continue;
+    }
+    len = sizeof(cred);
+    if (getsockopt(fd, SOL_SOCKET, SO_PEERCRED, &cred, &len) == -1 ||
+	(cred.uid != getuid() && cred.uid != 0)) {
+      close(fd);
+      continue;
+    }
+    pid = fork();
+    if (pid == -1)
+      perror(PNAME);
+    if (pid == 0) {
+      close(sock);
+      signal(SIGCHLD, SIG_DFL);
+      serve_connection(fd, prefix, mountpoint);
+      exit(0);
+    }
+    close(fd);
+  }
+}
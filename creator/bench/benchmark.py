@@ -0,0 +1,158 @@
+'''
+Copyright 2014 Hannu Visti
+
+This file is part of ForGe forensic test image generator.
+ForGe is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
+
+Parser benchmarks on synthetic images. Run from the creator directory of an
+installed ForGe (ui.uitools must be importable):
+
+    python -m bench.benchmark --fs NTFS --size 512 --files 20000
+
+Every entry point runs in a child process of its own. Peak memory is the
+maximum resident size of that child, so it includes the fs_init that the
+other entry points need.
+'''
+
+import os
+import sys
+import time
+import json
+import random
+from optparse import OptionParser
+from ui.uitools import ForensicError
+from imagefile import stats
+from synth import synthetic_image, FSCLASS
+
+LOOKUPS = 200
+ALLOCATIONS = 100
+ALLOCATION_SIZE = 64*1024
+
+def _parse(fstype, path):
+    fs = FSCLASS[fstype](path, "/nonexistent")
+    fs.fs_init()
+    return fs
+
+def bench_fs_init(fstype, path, paths, options):
+    t = time.time()
+    fs = _parse(fstype, path)
+    return time.time()-t, len(paths)
+
+def bench_find_file_by_path(fstype, path, paths, options):
+    fs = _parse(fstype, path)
+    rnd = random.Random(options.seed)
+    sample = [rnd.choice(paths) for _ in range(0, options.lookups)]
+    t = time.time()
+    for p in sample:
+        fs.find_file_by_path(p)
+    return time.time()-t, len(sample)
+
+def bench_locate_unallocated_space(fstype, path, paths, options):
+    fs = _parse(fstype, path)
+    t = time.time()
+    for n in range(0, ALLOCATIONS):
+        try:
+            fs.locate_unallocated_space(ALLOCATION_SIZE)
+        except ForensicError:
+            """ image is full """
+            break
+    else:
+        n = ALLOCATIONS
+    return time.time()-t, n
+
+def bench_file_slack(fstype, path, paths, options):
+    fs = _parse(fstype, path)
+    t = time.time()
+    slack = fs.get_file_slack() or []
+    return time.time()-t, len(slack)
+
+BENCHMARKS = [("fs_init", bench_fs_init),
+              ("find_file_by_path", bench_find_file_by_path),
+              ("locate_unallocated_space", bench_locate_unallocated_space),
+              ("file_slack", bench_file_slack)]
+
+def run_isolated(func, *args):
+    """ Run func in a child process. Returns [seconds, operations, bytes read
+    from the image, peak resident kB] """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        collector = stats.StageStats()
+        collector.activate()
+        collector.begin("bench")
+        try:
+            seconds, ops = func(*args)
+            collector.end()
+            result = [seconds, ops, collector.get_stages()[0]["bytes_read"]]
+        except Exception as e:
+            result = str(e)
+        os.write(wfd, json.dumps(result))
+        os._exit(0)
+    os.close(wfd)
+    data = ""
+    while True:
+        buf = os.read(rfd, 65536)
+        if not buf:
+            break
+        data += buf
+    os.close(rfd)
+    _, status, usage = os.wait4(pid, 0)
+    result = json.loads(data) if data else "child exited with status %d" % status
+    if not isinstance(result, list):
+        raise RuntimeError(result)
+    return result+[usage.ru_maxrss]
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--fs", action="append", dest="fs",
+                      help="FAT12, FAT16, FAT32 or NTFS, may be repeated. Default all")
+    parser.add_option("--size", type="int", dest="size", default=256,
+                      help="image size in MB")
+    parser.add_option("--files", type="int", dest="files", default=2000)
+    parser.add_option("--cluster", type="int", dest="cluster", default=4096,
+                      help="cluster size in bytes")
+    parser.add_option("--max-file-size", type="int", dest="max_size", default=65536)
+    parser.add_option("--seed", type="int", dest="seed", default=1)
+    parser.add_option("--lookups", type="int", dest="lookups", default=LOOKUPS)
+    parser.add_option("--workdir", dest="workdir", default="/tmp/forge-bench",
+                      help="generated images are kept here and reused")
+    parser.add_option("--base", dest="base",
+                      help="empty image to copy instead of running mkfs, one --fs only")
+    parser.add_option("--json", action="store_true", dest="json", default=False)
+    options, args = parser.parse_args(argv)
+    fstypes = options.fs or ["FAT12", "FAT16", "FAT32", "NTFS"]
+    if not os.path.isdir(options.workdir):
+        os.makedirs(options.workdir)
+
+    results = []
+    for fstype in fstypes:
+        path, paths = synthetic_image(fstype, options.workdir, options.size, options.files,
+                                      options.cluster, options.max_size, options.seed,
+                                      options.base)
+        mb = os.path.getsize(path)/(1024.0*1024.0)
+        for name, func in BENCHMARKS:
+            seconds, ops, nread, peak = run_isolated(func, fstype, path, paths, options)
+            results.append(dict(fs=fstype, image_mb=mb, files=len(paths), benchmark=name,
+                                seconds=seconds, operations=ops,
+                                ops_per_second=ops/seconds if seconds > 0 else 0,
+                                mb_read=nread/(1024.0*1024.0), peak_kb=peak))
+    if options.json:
+        print json.dumps(results, indent=1)
+        return 0
+    print "%-6s %7s %7s %-25s %9s %8s %12s %9s %9s" % ("fs", "MB", "files", "benchmark",
+        "seconds", "ops", "ops/s", "MB read", "peak kB")
+    for r in results:
+        print "%-6s %7.0f %7d %-25s %9.3f %8d %12.1f %9.1f %9d" % (r["fs"], r["image_mb"],
+            r["files"], r["benchmark"], r["seconds"], r["operations"], r["ops_per_second"],
+            r["mb_read"], r["peak_kb"])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,133 @@
+'''
+Copyright 2014 Hannu Visti
+
+This file is part of ForGe forensic test image generator.
+ForGe is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import random
+import shutil
+from subprocess import call
+from ui.uitools import ForensicError
+from fat.fat import FATC
+from fat.fatwriter import FATWriter
+from ntfsparser.ntfsc import NTFSC
+from ntfsparser.ntfswriter import NTFSWriter
+
+""" Formatting does not need root, the same tools chelper runs are used
+directly on a plain file """
+MKFS_NTFS = "/sbin/mkfs.ntfs"
+MKFS_FAT = "/sbin/mkfs.msdos"
+
+""" files per directory and directories per level of the generated tree """
+DIR_FANOUT = 64
+""" share of file names that are not plain 8.3 names """
+LONG_NAMES = 0.5
+""" FAT12 cannot address more than 4084 clusters """
+FAT12_MAX_CLUSTERS = 4084
+
+FSCLASS = {"FAT12": FATC, "FAT16": FATC, "FAT32": FATC, "NTFS": NTFSC}
+
+""" Endless file contents. Cheap and reproducible, the parsers never look
+at the data """
+class _Pattern(object):
+    def __init__(self, seed):
+        self.p_block = ("%08x" % seed)*8192
+
+    def read(self, n):
+        buf = self.p_block*(n/len(self.p_block)+1)
+        return buf[:n]
+
+def format_image(fstype, path, size_mb, clustersize):
+    """ Create an empty file system of size_mb megabytes in path """
+    fh = open(path, "wb")
+    fh.truncate(size_mb*1024*1024)
+    fh.close()
+    if fstype == "NTFS":
+        args = [MKFS_NTFS, "-L", "bench", "-c", str(clustersize), "-s", "512", "-p", "0",
+                "-S", "0", "-H", "0", "-F", "-f", "-q", path]
+    else:
+        args = [MKFS_FAT, "-S", "512", "-s", str(clustersize/512), "-n", "BENCH",
+                "-i", "42424242", "-F", fstype[3:], path]
+    devnull = open(os.devnull, "w")
+    try:
+        result = call(args, stdout=devnull, stderr=devnull)
+    except OSError:
+        result = -1
+    devnull.close()
+    if result != 0:
+        raise ForensicError("Cannot format "+path+" with "+args[0])
+
+def fat12_max_mb(clustersize):
+    """ Largest FAT12 image in whole megabytes with clusters of clustersize 
+    bytes. Only the boot sector and the two FATs are counted as overhead, 
+    mkfs uses at least that much """
+    fatsectors = ((FAT12_MAX_CLUSTERS+2)*3/2+511)/512
+    return (FAT12_MAX_CLUSTERS*clustersize+(1+2*fatsectors)*512)/(1024*1024)
+
+def tree_paths(files):
+    """ Directory of each of files files. Directories are nested so that no
+    directory holds more than DIR_FANOUT files or subdirectories """
+    result = []
+    for n in range(0, files):
+        d = n/DIR_FANOUT
+        parts = []
+        while d > 0:
+            parts.append("dir%03d" % (d % DIR_FANOUT))
+            d = d/DIR_FANOUT
+        result.append("/"+"/".join(reversed(parts)))
+    return result
+
+def populate(fstype, path, files, max_size, seed):
+    """ Write files files of random size up to max_size bytes with the direct
+    writers. Returns the list of file paths """
+    rnd = random.Random(seed)
+    fs = FSCLASS[fstype](path, "/nonexistent")
+    fs.fs_init()
+    writer = NTFSWriter(fs) if fstype == "NTFS" else FATWriter(fs)
+    written = []
+    dirs = tree_paths(files)
+    for n in range(0, files):
+        if rnd.random() < LONG_NAMES:
+            name = "Synthetic document %05d.txt" % n
+        else:
+            name = "F%05d.DAT" % n
+        """ mostly small files, as on real disks """
+        size = min(max_size, int(rnd.expovariate(1.0/(max_size/8+1))))
+        writer.write_stream(dirs[n], name, _Pattern(n), size)
+        written.append(dirs[n].rstrip("/")+"/"+name)
+    writer.close()
+    return written
+
+def synthetic_image(fstype, workdir, size_mb, files, clustersize=4096, max_size=65536,
+                    seed=1, base=None):
+    """ Path of a populated image and the files on it. Images are cached in
+    workdir by their parameters. base is an empty image to copy instead of
+    running mkfs """
+    if fstype == "FAT12":
+        size_mb = min(size_mb, fat12_max_mb(clustersize))
+    name = "%s-%dM-%d-%d-%d-%d.img" % (fstype, size_mb, files, clustersize, max_size, seed)
+    path = os.path.join(workdir, name)
+    listing = path+".files"
+    if os.path.exists(path) and os.path.exists(listing):
+        fh = open(listing)
+        written = [l.rstrip("\n").decode("utf-8") for l in fh]
+        fh.close()
+        return path, written
+    if base != None:
+        shutil.copyfile(base, path)
+    else:
+        format_image(fstype, path, size_mb, clustersize)
+    written = populate(fstype, path, files, max_size, seed)
+    fh = open(listing, "w")
+    for w in written:
+        fh.write(w.encode("utf-8")+"\n")
+    fh.close()
+    return path, written
@@ -19,7 +19,6 @@ from hiding.ads import HidingMethod
 from ui.uitools import errlog
 from ui.uitools import ForensicError
 from ui.uitools import Chelper
-from subprocess import check_output
 from subprocess import CalledProcessError
 from shutil import copyfile
 from traceback import format_exc
@@ -46,14 +45,11 @@ class BrowserHistory(HidingMethod):
 
     def prepare_container(self):
         try:
-            a=check_output([self.chelper.binary, "lxc", "lxc-destroy"], 
-                           shell=False)
-            a=check_output([self.chelper.binary, "lxc", "lxc-create"], 
-                           shell=False)
+            a=self.chelper.check_output(["lxc", "lxc-destroy"])
+            a=self.chelper.check_output(["lxc", "lxc-create"])
             sleep (3)
-            a=check_output([self.chelper.binary, "lxc", "lxc-attach", "nowait", "silent",
-                            "Xvfb", ":0", "-screen", "0", "1024x768x24"], 
-                           shell=False)
+            a=self.chelper.check_output(["lxc", "lxc-attach", "nowait", "silent",
+                                         "Xvfb", ":0", "-screen", "0", "1024x768x24"])
             sleep (3)
         except CalledProcessError as e:
             print e
@@ -65,8 +61,7 @@ class BrowserHistory(HidingMethod):
 
     def delete_container(self):
         try:
-            a=check_output([self.chelper.binary, "lxc", "lxc-destroy"], 
-                           shell=False)
+            a=self.chelper.check_output(["lxc", "lxc-destroy"])
         except CalledProcessError as e:
            print e 
            raise ForensicError("delete_container")
@@ -79,8 +74,7 @@ class BrowserHistory(HidingMethod):
 
     def send_file(self,src):
         try:
-            a=check_output([self.chelper.binary, "lxc", "copy_file",src], 
-                           shell=False)
+            a=self.chelper.check_output(["lxc", "copy_file",src])
         except CalledProcessError as e:
             format_exc()
             raise ForensicError("send_file")
@@ -88,10 +82,10 @@ class BrowserHistory(HidingMethod):
     def exec_file(self):
 
         try:
-            b = check_output([self.chelper.binary,"lxc", "lxc-attach", "wait", 
-                              "vocal",
-                              "su", "-", "forge", "-c", 
-                              "python /tmp/wh.py"], shell=False)
+            b = self.chelper.check_output(["lxc", "lxc-attach", "wait", 
+                                           "vocal",
+                                           "su", "-", "forge", "-c", 
+                                           "python /tmp/wh.py"])
             return b.rstrip()
         except CalledProcessError as e:
             print e
@@ -144,9 +138,9 @@ class BrowserHistory(HidingMethod):
                 resl.append(dict(status="Fail", fname=None,size=0))
             else:
                 try:
-                    rloc = check_output([self.chelper.binary,"lxc", "copy_result", 
-                                         self.chelper.rootdir+result_path, tmpdir], 
-                                        shell=False).rstrip()
+                    rloc = self.chelper.check_output(["lxc", "copy_result", 
+                                                      self.chelper.rootdir+result_path, 
+                                                      tmpdir]).rstrip()
                 except:
                     raise ForensicError("copy results");
 
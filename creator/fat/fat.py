@@ -4,11 +4,19 @@ import sys
 import binascii
 import datetime
 
-from subprocess import call
+from array import array
+from itertools import repeat
+from operator import and_, rshift
 from ui.uitools import ForensicError
 from ui.uitools import Chelper
 from ntfsparser.ntfsc import FileEntry
 from random import randint
+from imagefile.template import TemplateCache
+from imagefile.writeback import ImageWriter
+from imagefile.view import ImageView, STREAM_CHUNK
+from imagefile.extents import FreeExtentIndex, runs_from_entries
+from imagefile import stats
+from fatwriter import FATWriter
 
 
 def _Split_String(s):
@@ -51,7 +59,7 @@ FLAG_DIR = 0x16
 
 
 
-def FAT16CreateImage(name,size,clustersize,garbage,parameters={}):
+def _FATCreateImage(fattype,name,size,clustersize,garbage):
 
     if len(name) <= 8:
         imagename = name
@@ -63,53 +71,81 @@ def FAT16CreateImage(name,size,clustersize,garbage,parameters={}):
     else:
         fill = "clean"
 
-    result = call([Chelper().binary,"create","FAT16",str(size),str(clustersize),str(512), imagename,fill,name], shell=False)
-    return result
-
-def FAT12CreateImage(name,size,clustersize,garbage,parameters={}):
+    c = Chelper()
+    if c.templates:
+        return TemplateCache().create_image([fattype, size, clustersize, fill], name,
+                    lambda tname: c.call(["create",fattype,str(size),str(clustersize),str(512), 
+                                          "FORGE",fill,tname]),
+                    lambda path: FATRestampImage(path, imagename))
 
-    if len(name) <= 8:
-        imagename = name
-    else:
-        imagename = name[:8]
-        
-    if garbage:
-        fill = "random"
-    else:
-        fill = "clean"
-
-    result = call([Chelper().binary,"create","FAT12",str(size),str(clustersize),str(512), imagename,fill,name], shell=False)
+    result = c.call(["create",fattype,str(size),str(clustersize),str(512), imagename,fill,name])
     return result
 
-def FAT32CreateImage(name,size,clustersize,garbage,parameters={}):
+def FAT16CreateImage(name,size,clustersize,garbage,parameters={}):
+    return _FATCreateImage("FAT16",name,size,clustersize,garbage)
 
-    if len(name) <= 8:
-        imagename = name
-    else:
-        imagename = name[:8]
-        
-    if garbage:
-        fill = "random"
-    else:
-        fill = "clean"
+def FAT12CreateImage(name,size,clustersize,garbage,parameters={}):
+    return _FATCreateImage("FAT12",name,size,clustersize,garbage)
 
-    result = call([Chelper().binary,"create","FAT32",str(size),str(clustersize),str(512), imagename,fill,name], shell=False)
-    return result
+def FAT32CreateImage(name,size,clustersize,garbage,parameters={}):
+    return _FATCreateImage("FAT32",name,size,clustersize,garbage)
 
 def FATGenericCreateImage(name,size,clustersize,garbage,parameters={}):
-
-    if len(name) <= 8:
-        imagename = name
-    else:
-        imagename = name[:8]
-        
-    if garbage:
-        fill = "random"
-    else:
-        fill = "clean"
-
-    result = call([Chelper().binary,"create","GENERICFAT",str(size),str(clustersize),str(512), imagename,fill,name], shell=False)
-    return result
+    return _FATCreateImage("GENERICFAT",name,size,clustersize,garbage)
+
+""" Give a copy of a template image its own identity: a new volume id and the 
+volume label in the boot sector, its FAT32 backup and the root directory """
+def FATRestampImage(fname, label):
+    try:
+        fh = open(fname, "r+b")
+    except IOError:
+        raise ForensicError("Cannot open image for restamp")
+    try:
+        vbr = fh.read(512)
+        if vbr[510:512] != "\x55\xaa":
+            raise ForensicError("Template is not a FAT image")
+        sectorsize = struct.unpack("<H", vbr[11:13])[0]
+        spc = struct.unpack("B", vbr[13])[0]
+        reserved = struct.unpack("<H", vbr[14:16])[0]
+        nfats = struct.unpack("B", vbr[16])[0]
+        rootentries = struct.unpack("<H", vbr[17:19])[0]
+        fatsize = struct.unpack("<H", vbr[22:24])[0]
+        bootsectors = [0]
+        if fatsize == 0:
+            """ FAT32 """
+            fatsize = struct.unpack("<I", vbr[36:40])[0]
+            rootcluster = struct.unpack("<I", vbr[44:48])[0]
+            backup = struct.unpack("<H", vbr[50:52])[0]
+            if backup not in (0, 0xffff):
+                bootsectors.append(backup*sectorsize)
+            idoffset = 67
+            rootloc = (reserved+nfats*fatsize+(rootcluster-2)*spc)*sectorsize
+            rootlen = spc*sectorsize
+        else:
+            idoffset = 39
+            rootloc = (reserved+nfats*fatsize)*sectorsize
+            rootlen = rootentries*32
+        if vbr[idoffset-1] != "\x29":
+            raise ForensicError("Template has no extended boot signature")
+
+        volname = label[:11].ljust(11)
+        volid = struct.pack("<I", randint(0, 2**32-1))
+        for loc in bootsectors:
+            fh.seek(loc+idoffset)
+            fh.write(volid+volname)
+
+        fh.seek(rootloc)
+        rootdir = fh.read(rootlen)
+        for i in range(0, len(rootdir), 32):
+            if rootdir[i] == "\x00":
+                break
+            attr = ord(rootdir[i+11])
+            if rootdir[i] != "\xe5" and attr & 0x8 and attr != 0xf:
+                fh.seek(rootloc+i)
+                fh.write(volname)
+                break
+    finally:
+        fh.close()
 
 
 """ ForGe uses NTFS flags - 0x1 = system, 0x2 = directory, 0x4 = regular 
@@ -301,6 +337,8 @@ class DirEntry(object):
         self.d_flags, = struct.unpack("B",se[11])
         self.d_time = FATTime(self,se[13:20],se[22:26])
         self.d_cluster, = struct.unpack("<H",se[26:28])
+        if parent.fs_fstype == "FAT32":
+            self.d_cluster |= struct.unpack("<H",se[20:22])[0] << 16
         self.d_filesize, = struct.unpack("<I", se[28:32])
         self.d_location = loc+block[1]
         self.d_parentdir = parentdir
@@ -376,12 +414,13 @@ class DirEntry(object):
         if self.d_dummy:
             return None
         if len(self.d_clusterchain) > 0:
-            buf = ""
-            for i in self.d_clusterchain:
-                buf += self.parent.read_cluster(i)
-            return buf
+            return self.parent.read_chain(self.d_clusterchain)
         else:
             return None
+    def iter_file(self, chunk=STREAM_CHUNK):
+        if self.d_dummy or len(self.d_clusterchain) == 0:
+            return iter([])
+        return self.parent.iter_chain(self.d_clusterchain, chunk)
     def write_timestamps(self):
         if self.d_dummy:
             return None
@@ -401,6 +440,39 @@ class DirEntry(object):
         self.d_time.change_mtime(times)
         self.write_timestamps()
 
+""" typed array codes for 16 and 32 bit FAT entries """
+_FAT_TYPECODE = {16: "H", 32: [t for t in "ILH" if array(t).itemsize == 4][0]}
+
+""" Decode the first clusters entries of a FAT into a typed array. FAT16 and
+FAT32 tables are little endian arrays already. FAT12 packs two entries into
+three bytes: the bytes are spread into 32 bit words and both entries are
+masked out of the words with C level map calls """
+def _decode_fat(raw, bits, clusters):
+    if bits != 12:
+        entries = array(_FAT_TYPECODE[bits])
+        entries.fromstring(raw[:clusters*entries.itemsize])
+        if sys.byteorder != "little":
+            entries.byteswap()
+        return entries
+    pairs = (clusters+1)/2
+    packed = bytearray(raw[:pairs*3])
+    packed += bytearray(pairs*3-len(packed))
+    spread = bytearray(pairs*4)
+    spread[0::4] = packed[0::3]
+    spread[1::4] = packed[1::3]
+    spread[2::4] = packed[2::3]
+    words = array(_FAT_TYPECODE[32])
+    words.fromstring(str(spread))
+    if sys.byteorder != "little":
+        words.byteswap()
+    entries = array("H", [0])*(pairs*2)
+    entries[0::2] = array("H", map(and_, words, repeat(0xfff, pairs)))
+    entries[1::2] = array("H", map(rshift, words, repeat(12, pairs)))
+    return entries[:clusters]
+
+""" lowest cluster handed out for hiding """
+FREE_SEARCH_START = 20
+
 class FatTable(object):
     def __init__(self,buf,loc,par):
         self.rawdata = buf
@@ -412,6 +484,7 @@ class FatTable(object):
             self.bytes = 12
         if self.parent.fs_fstype == "FAT32":
             self.bytes = 32
+        self.eoc = 2**self.bytes-1 if self.bytes != 32 else 0x0fffffff
 
     def get_cluster_value(self,cluster):
         start_byte = self.bytes*cluster
@@ -439,9 +512,7 @@ class FatTable(object):
         return -1
 
     def get_cluster_chain(self,cl=0):
-        eoc = 2**self.bytes-1
-        if self.bytes == 32:
-            eoc = 0x0fffffff
+        eoc = self.eoc
         t = cl
         result = [cl]
         while True:
@@ -454,68 +525,100 @@ class FatTable(object):
             t = s
 
     def init_fat(self, clusters):
-        self.ftb = []
+        """ sector count over cluster size overestimates, the FAT may hold fewer entries """
+        clusters = min(clusters, len(self.rawdata)*8/self.bytes)
         self.maxclus = clusters-1
-        ctmp = 0
-        for ctmp in range (0,clusters):
-            cv = self.get_cluster_value(ctmp)
-            if cv == -1:
-                print ctmp
-                raise ForensicError("Cluster out of bounds")
-            else:
-                self.ftb.append(cv)
-        pass
+        self.ftb = _decode_fat(self.rawdata, self.bytes, clusters)
+        """ clusters past the end of the data area have FAT entries too """
+        spc = self.parent.f_clustersize/self.parent.f_sectorsize
+        last = min(self.maxclus, 1+(self.parent.f_numofsectors-self.parent.f_datastart)/spc)
+        """ the first clusters are left alone, as they always were """
+        self.free = FreeExtentIndex(runs_from_entries(self.ftb.tostring(), self.ftb.itemsize),
+                                    FREE_SEARCH_START, last+1)
 
     """
     This method finds n consecutive empty clusters. Then marks them
-    temporarily as used """
+    temporarily as used. Returns the first cluster or -1 """
 
     def find_consecutive_empty(self, n):
-        c = 0
-        # Random attempt
-        while c < 20:
-            y = randint(20, self.maxclus-n)
-            expected = True
-            for w in range(y,y+n):
-                if self.ftb[w] != 0:
-                    expected = False
-            if expected == True:
-                for w in range (y,y+n):
-                    self.ftb[w] = -1
-                return w
-            c += 1
-        #Sequential attempt
-        for y in range(20, self.maxclus-n):
-            expected = True
-            for w in range(y,y+n):
-                if self.ftb[w] != 0:
-                    expected = False
-            if expected == True:
-                for w in range (y,y+n):
-                    self.ftb[w] = -1
-                return w
-        #Sequential attempt fails
-        return -1
+        y = self.free.find(n)
+        if y == -1:
+            return -1
+        self.free.reserve(y, n)
+        self.ftb[y:y+n] = array(self.ftb.typecode, [self.eoc])*n
+        return y
 
 
 class FileSystemC(object):
-    def __init__(self, fname, mountpoint="/mnt/image"):
+    def __init__(self, fname, mountpoint="/mnt/image", slot=None):
         self.fs_sectorsize=0
         self.fs_size=0
         self.fs_fstype=""
         self.fs_mountpoint = mountpoint
-        self.fs_fh = open(fname, "r")
+        """ worker slot selects the mount point and loop device chelper uses """
+        self.fs_slot = slot
+        """ False until fs_init has run and again after a mount, when the kernel
+        may have written anything """
+        self.fs_parsed = False
+        """ True between begin_mount_session and end_mount_session """
+        self.fs_session = False
+        """ small writes are buffered, see fs_flush """
+        self.fs_writer = ImageWriter(fname)
+        self.fs_view = ImageView(fname)
         self.fs_filename = fname
-        FileHandler.SetFileName(fname,self.fs_fh)
+        FileHandler.SetFileName(fname,self.fs_view)
         if len(self.fs_filename.rsplit('/',1)) == 1:
             self.fs_shortname = self.fs_filename
         else:
             self.fs_shortname = self.fs_filename.rsplit('/',1)[1]
 
+    def _slot_args(self):
+        if self.fs_slot is None:
+            return []
+        return [str(self.fs_slot)]
+
+    """ File systems that can be written without a mount return a writer """
+    def get_direct_writer(self):
+        return None
+
+    """ Bring the parsed model up to date. Only the structures marked dirty
+    since the last parse are read again, unless a mount session has written 
+    to the image """
+    def fs_refresh(self):
+        self.fs_flush()
+        if not self.fs_parsed:
+            self.fs_init()
+        else:
+            self._apply_deltas()
+
+    def fs_mark_external(self):
+        self.fs_parsed = False
+
+    """ Write buffered write_location data to the image. Needed before the 
+    image is read without the parser, written through another handle or
+    mounted """
+    def fs_flush(self):
+        self.fs_writer.flush()
+
+    """ Mount the image once for several hiding methods. Inside a session
+    mount_image and dismount_image leave the mount as it is """
+    def begin_mount_session(self):
+        if self.mount_image() != 0:
+            raise ForensicError("Cannot mount image")
+        self.fs_session = True
+
+    def end_mount_session(self):
+        self.fs_session = False
+        return self.dismount_image()
+
+    """ Flush and release the image, the last step of fs_finalise """
+    def fs_commit(self):
+        self.fs_writer.close()
+
 class FATC(FileSystemC):
 
-    def __init__(self,fname,mountpoint="/mnt/image"):
-        super(FATC, self).__init__(fname,mountpoint)
+    def __init__(self,fname,mountpoint="/mnt/image",slot=None):
+        super(FATC, self).__init__(fname,mountpoint,slot)
         #self.fs_fstype = ""
         self.f_mounted = False
         self.f_filelist = []
@@ -561,6 +664,7 @@ class FATC(FileSystemC):
         self.f_filelist = []
         self.f_entrylist = []
         self.f_numofclusters = self.f_numofsectors / struct.unpack("B", vbr[13])[0]
+        self.f_rootcluster, = struct.unpack("<I", vbr[44:48])
         fstype_string, = struct.unpack("5s",vbr[54:59])
         if fstype_string == "FAT12":
             self.fs_fstype = "FAT12"
@@ -610,25 +714,50 @@ class FATC(FileSystemC):
 
     def fs_init(self):
 
-        self.fs_fh.seek(0)
-        buf = self.fs_fh.read(512)
+        buf = self.fs_view.read(0, 512)
         self.fat_vbr_init(buf)
 
-        self.fs_fh.seek(self.f_sectorsize*self.f_reserved)
-        buf = self.fs_fh.read(self.f_fatsize*self.f_sectorsize)
+        buf = self.fs_view.read(self.f_sectorsize*self.f_reserved, self.f_fatsize*self.f_sectorsize)
         self.f_fat = FatTable(buf,512,self)
         self.f_fat.init_fat(self.f_numofclusters)
         
-        self.fs_fh.seek(self.f_sectorsize*self.f_rootstart)
-        if self.fs_fstype == "FAT12" or self.fs_fstype == "FAT16":
-            rootdir = self.fs_fh.read(self.f_rootentries * 32)
-        if self.fs_fstype == "FAT32":
-            rootdir = self.fs_fh.read(2048)
-        """ process root dir """
-        dir_stack = []
-        dirent = self._process_dir(rootdir)
-        for f in dirent:
-            d = DirEntry(self,f, None, self.f_sectorsize*self.f_rootstart)
+        self.f_dircache = {}
+        self.f_dirtydirs = set()
+        self._build_tree()
+        self.fs_parsed = True
+
+    """ Directories written behind the parser's back, e.g. by FATWriter. Keys
+    are first clusters, 0 is the FAT12/16 root. The FAT itself is not tracked,
+    writers keep f_fat current themselves """
+    def fs_mark_directories(self, clusters):
+        self.f_dirtydirs.update(clusters)
+
+    def _apply_deltas(self):
+        if len(self.f_dirtydirs) > 0:
+            self._build_tree()
+
+    def _read_dir(self, nd):
+        """ Parse one directory, nd None is the root directory """
+        if nd == None:
+            location = self.f_sectorsize*self.f_rootstart
+            if self.fs_fstype == "FAT32":
+                chain = self.f_fat.get_cluster_chain(self.f_rootcluster)
+                buf = self.read_chain(chain)
+            else:
+                chain = None
+                buf = self.fs_view.read(location, self.f_rootentries * 32)
+        else:
+            """ the chain may have grown since the parent was parsed """
+            chain = nd.d_clusterchain = self.f_fat.get_cluster_chain(nd.d_cluster)
+            location = self.locate_cluster(nd.d_cluster)
+            buf = nd.read_file()
+        result = []
+        for f in self._process_dir(buf):
+            d = DirEntry(self,f,nd,location)
+            if chain != None:
+                d.d_location = self._dir_location(chain, f[1])
+            if d.d_filename == ".       " or d.d_filename == "..      ":
+                continue
             if d.d_cluster > 0:
                 d.d_clusterchain = self.f_fat.get_cluster_chain(d.d_cluster)
                 if not d.d_flags & FLAG_DIR:
@@ -638,43 +767,36 @@ class FATC(FileSystemC):
                     slackstart = self.locate_cluster(last_cluster) + self.f_clustersize - slackamount
                     if slackamount > 0:
                         d.d_slack = [slackstart, slackamount, 0]
-                        self.f_slack.append([slackstart, slackamount, 0])
+            result.append(d)
+        return result
+
+    def _build_tree(self):
+        """ Walk the directory tree. Directories that are not dirty come from
+        f_dircache instead of the image """
+        self.f_slack = []
+        self.f_filelist = []
+        self.f_entrylist = []
+        cache = {}
+        rootkey = self.f_rootcluster if self.fs_fstype == "FAT32" else 0
+        dir_stack = [[None, rootkey]]
+        while len(dir_stack) > 0:
+            nd, key = dir_stack.pop()
+            if key in self.f_dircache and key not in self.f_dirtydirs:
+                entries = self.f_dircache[key]
+                for d in entries:
+                    d.d_parentdir = nd
+            else:
+                entries = self._read_dir(nd)
+            cache[key] = entries
+            for d in entries:
+                if d.d_slack != None:
+                    self.f_slack.append(d.d_slack)
+                if d.d_flags & FLAG_DIR and d.d_cluster > 0 and d.d_exists:
+                    dir_stack.append([d, d.d_cluster])
+                self.f_filelist.append(d)
+        self.f_dircache = cache
+        self.f_dirtydirs = set()
 
-            if d.d_flags & FLAG_DIR and d.d_cluster > 0 and d.d_exists:
-                dir_stack.append(d)
-            self.f_filelist.append(d)
-        
-        while True:
-            try:
-                nd = dir_stack.pop()
-                buf = nd.read_file()
-                dirent = self._process_dir(buf)
-                for f in dirent:
-                    d = DirEntry(self,f,nd,self.locate_cluster(nd.d_cluster))
-                    if d.d_cluster > 0:
-                        d.d_clusterchain = self.f_fat.get_cluster_chain(d.d_cluster)
-                        if not d.d_flags & FLAG_DIR:
-                            last_cluster = d.d_clusterchain[-1]
-                            remainder = d.d_filesize % self.f_clustersize
-                            slackamount = (remainder / self.f_sectorsize) * self.f_sectorsize
-                            slackstart = self.locate_cluster(last_cluster) + self.f_clustersize - slackamount
-                            if slackamount > 0:
-                                d.d_slack = [slackstart, slackamount, 0]
-                                self.f_slack.append([slackstart, slackamount, 0])
-
-                    if d.d_flags & FLAG_DIR and d.d_cluster > 0 and d.d_exists:
-                        if d.d_filename == ".       " or d.d_filename == "..      ":
-                            pass
-                        else:
-                            dir_stack.append(d)
-                    if d.d_filename == ".       " or d.d_filename == "..      ":
-                        pass
-                    else:
-                        self.f_filelist.append(d)
-
-
-            except IndexError:
-                break
         """ Create a dummy entry for root dir """
         ddict = {}
         ddict["name"] = "."
@@ -682,18 +804,41 @@ class FATC(FileSystemC):
         dummyroot = DirEntry(self,"",None,0,dummy=ddict)
         self.f_filelist.append(dummyroot)
 
-        """ Create FileEntry structures """
+        """ Create FileEntry structures. f_pathindex keeps the first entry of
+        every path, deleted entries may share a path with a live one """
+        self.f_pathindex = {}
         i=0
         for q in self.f_filelist:
             fe = FileEntry(i,q.d_longpath,q.d_ntfsflags,q)
             i += 1
             self.f_entrylist.append(fe)
+            self.f_pathindex.setdefault(q.d_longpath, fe)
+
+    """ Image offset of a directory entry. Directory clusters need not be consecutive """
+    def _dir_location(self, chain, offset):
+        return self.locate_cluster(chain[offset/self.f_clustersize]) + offset%self.f_clustersize
 
     def read_cluster(self, cluster):
         position = self.f_datastart*self.f_sectorsize + (cluster-2)*self.f_clustersize
-        self.fs_fh.seek(position)
-        buf = self.fs_fh.read(self.f_clustersize)
-        return buf
+        return self.fs_view.read(position, self.f_clustersize)
+
+    """ Contents of a cluster chain, consecutive clusters are read in one slice """
+    def read_chain(self, chain):
+        return self.fs_view.read_extents(self._chain_extents(chain))
+
+    """ read_chain as an iterator of chunk byte pieces """
+    def iter_chain(self, chain, chunk=STREAM_CHUNK):
+        return self.fs_view.iter_extents(self._chain_extents(chain), chunk)
+
+    def _chain_extents(self, chain):
+        extents = []
+        for c in chain:
+            position = self.locate_cluster(c)
+            if len(extents) > 0 and extents[-1][0]+extents[-1][1] == position:
+                extents[-1][1] += self.f_clustersize
+            else:
+                extents.append([position, self.f_clustersize])
+        return extents
 
     def locate_cluster(self, cluster):
         position = self.f_datastart * self.f_sectorsize + (cluster -2)*self.f_clustersize
@@ -704,34 +849,43 @@ class FATC(FileSystemC):
             
     """ Interface methods """
     def fs_finalise(self):
-        pass
+        self.fs_commit()
 
     def write_location(self, position, data):
-        try:
-            wh = open(self.fs_filename,"r+b");
-            wh.seek(position)
-            wh.write(data)
-            wh.close()
-        except IOError:
-            raise ForensicError("Cannot write to image")
+        self.fs_writer.write(position, data)
 
     def get_file_slack(self):
         return self.f_slack if len (self.f_slack) > 0 else None
 
+    """ Writer that populates the image file without mounting it. Call after fs_init """
+    def get_direct_writer(self):
+        if not self.helper.direct_write:
+            return None
+        self.fs_flush()
+        return FATWriter(self)
+
     def register_used_file_slack(self, location, used):
         for s in self.f_slack:
             if s[0] == location:
                 s[2] = used
 
     def mount_image(self):
-        result = call([self.helper.binary, "attach", self.fs_fstype, self.fs_shortname], shell=False)
+        if self.fs_session:
+            return 0
+        self.fs_flush()
+        result = self.helper.call(["attach", self.fs_fstype, self.fs_shortname]+self._slot_args())
         if result == 0:
             self.f_mounted = True
+            self.fs_mark_external()
+            stats.count("mounts")
         return result
     def dismount_image(self):
-        result = call([self.helper.binary, "detach"], shell=False)
+        if self.fs_session:
+            return 0
+        result = self.helper.call(["detach"]+self._slot_args())
         if result == 0:
             self.f_mounted = False
+            stats.count("umounts")
         return result
 
     def get_list_of_files(self,flags):
@@ -746,10 +900,10 @@ class FATC(FileSystemC):
         if len(path) > 2:
             if path[:2] == "//":
                 path = path[1:]
-        for f in self.f_entrylist:
-            s = f.get_file_name()
-            if s == path:
-                return f
+        try:
+            return self.f_pathindex[path]
+        except KeyError:
+            pass
         emessage = "File not found: "+path
         raise ForensicError(emessage)
 
@@ -763,7 +917,33 @@ class FATC(FileSystemC):
     def set_cluster_status(self,a,b,c):
         pass
 
+    def set_cluster_range(self,a,b,c,d=False):
+        pass
+
     def change_time(self,fname,btime):
+        m = self.find_file_by_path(fname).link
+        self._set_times(m, btime)
+        m.write_timestamps()
+
+    """ TimelineEngine interface. Changes are grouped by directory entry, in
+    the order of the entries on disk. Directory entries are the only copy
+    of the times, nothing is held back """
+    def timeline_begin(self):
+        pass
+
+    def timeline_end(self):
+        pass
+
+    def timeline_target(self, path):
+        m = self.find_file_by_path(path).link
+        return [(m.d_location, id(m)), m]
+
+    def change_times(self, m, btimes):
+        for btime in btimes:
+            self._set_times(m, btime)
+        m.write_timestamps()
+
+    def _set_times(self, m, btime):
         atime=ctime=mtime=None
         try:
             atime=ctime=mtime=btime["all"]
@@ -783,16 +963,12 @@ class FATC(FileSystemC):
         except KeyError:
             pass
 
-        try:
-            m = self.find_file_by_path(fname).link
-            if atime:
-                m.change_atime(atime)
-            if mtime:
-                m.change_mtime(mtime)
-            if ctime:
-                m.change_ctime(ctime)
-        except ForensicError:
-            raise
+        if atime:
+            m.d_time.change_atime(atime)
+        if mtime:
+            m.d_time.change_mtime(mtime)
+        if ctime:
+            m.d_time.change_ctime(ctime)
 
     def implement_action(self,act):
 
@@ -0,0 +1,463 @@
+'''
+Copyright 2014 Hannu Visti
+
+This file is part of ForGe forensic test image generator.
+ForGe is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import struct
+import datetime
+import os
+from StringIO import StringIO
+from ui.uitools import ForensicError
+from imagefile.stats import CountingFile
+
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_VOLUME = 0x08
+ATTR_LFN = 0x0f
+
+SHORT_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~"
+LFN_ILLEGAL = u'\\/:*?"<>|'
+COPY_BLOCK = 1024*1024
+
+""" Writes files and directories straight into a FAT12/16/32 image file,
+without mounting it. Works on an initialised FATC: clusters are allocated from
+its FAT, both FAT copies are updated and names get 8.3 and LFN entries the way
+the Linux vfat driver writes them. Call close() to flush the FAT. """
+
+def _fat_datetime(dt):
+    if dt.year < 1980:
+        dt = datetime.datetime(1980,1,1)
+    d = ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day
+    t = (dt.hour << 11) | (dt.minute << 5) | (dt.second/2)
+    return t, d
+
+def _lfn_checksum(shortname):
+    s = 0
+    for c in shortname:
+        s = (((s & 1) << 7) + (s >> 1) + ord(c)) & 0xff
+    return s
+
+def _to_unicode(name):
+    if isinstance(name, str):
+        return name.decode("utf-8")
+    return name
+
+class _WriterDir(object):
+    """ Directory being written. chain is None for the fixed FAT12/16 root """
+    def __init__(self, parent, cluster, chain, location, data):
+        self.parent = parent
+        self.cluster = cluster
+        self.chain = chain
+        self.location = location
+        self.data = data
+        self.entries = {}
+        self.shortnames = set()
+        self.modified = False
+        self._parse()
+
+    def _parse(self):
+        lfn = []
+        for i in range(0, len(self.data), 32):
+            slot = self.data[i:i+32]
+            if slot[0] == 0:
+                break
+            if slot[0] == 0xe5:
+                lfn = []
+                continue
+            if slot[11] == ATTR_LFN:
+                lfn.append([i, slot])
+                continue
+            self.shortnames.add(str(slot[0:11]))
+            if slot[11] & ATTR_VOLUME:
+                lfn = []
+                continue
+            if lfn:
+                lname = "".join([str(e[1:11]+e[14:26]+e[28:32]) for s,e in reversed(lfn)])
+                lname = lname.decode("utf-16-le", "ignore").split(u"\x00")[0]
+                first = lfn[0][0]
+            else:
+                base = str(slot[0:8]).rstrip()
+                ext = str(slot[8:11]).rstrip()
+                lname = unicode(base+"."+ext if ext else base, errors="ignore")
+                first = i
+            lfn = []
+            if lname in (u".", u".."):
+                continue
+            cluster, = struct.unpack("<H", str(slot[26:28]))
+            if self.parent.w_fat32:
+                cluster |= struct.unpack("<H", str(slot[20:22]))[0] << 16
+            self.entries[lname.upper()] = dict(name=lname, first=first, last=i,
+                                               attr=slot[11], cluster=cluster)
+
+    def free_slots(self, n):
+        """ Index of n consecutive unused slots or -1 """
+        run = 0
+        for i in range(0, len(self.data), 32):
+            if self.data[i] == 0 or self.data[i] == 0xe5:
+                run += 1
+                if run == n:
+                    return i-(n-1)*32
+            else:
+                run = 0
+        return -1
+
+    def position(self, offset):
+        if self.chain == None:
+            return self.location+offset
+        cs = self.parent.w_clustersize
+        return self.parent.cluster_position(self.chain[offset/cs])+offset%cs
+
+    def write_slots(self, start, end):
+        """ write data[start:end] back to the image cluster by cluster """
+        cs = self.parent.w_clustersize
+        self.modified = True
+        while start < end:
+            stop = end if self.chain == None else min(end, (start/cs+1)*cs)
+            self.parent.w_fh.seek(self.position(start))
+            self.parent.w_fh.write(str(self.data[start:stop]))
+            start = stop
+
+class FATWriter(object):
+    def __init__(self, fs):
+        self.fs = fs
+        try:
+            self.w_fh = CountingFile(open(fs.fs_filename, "r+b"))
+        except IOError:
+            raise ForensicError("Cannot open image for writing")
+        self.w_fh.seek(0)
+        vbr = self.w_fh.read(512)
+        self.w_fat32 = fs.fs_fstype == "FAT32"
+        self.w_bits = fs.f_fat.bytes
+        self.w_sectorsize = fs.f_sectorsize
+        self.w_clustersize = fs.f_clustersize
+        self.w_fatstart = fs.f_reserved*fs.f_sectorsize
+        self.w_fatbytes = fs.f_fatsize*fs.f_sectorsize
+        self.w_datastart = fs.f_datastart*fs.f_sectorsize
+        self.w_fat = bytearray(fs.f_fat.rawdata)
+        self.w_dirty = None
+        spc = fs.f_clustersize/fs.f_sectorsize
+        self.w_lastcluster = min(1+(fs.f_numofsectors-fs.f_datastart)/spc,
+                                 len(self.w_fat)*8/self.w_bits-1)
+        self.w_eoc = (1 << self.w_bits)-1 if not self.w_fat32 else 0x0fffffff
+        self.w_next = 2
+        self.w_allocated = 0
+        self.w_fsinfo = None
+        self.w_dirs = {}
+        if self.w_fat32:
+            rootcluster, = struct.unpack("<I", vbr[44:48])
+            fsinfo, = struct.unpack("<H", vbr[48:50])
+            if fsinfo not in (0, 0xffff):
+                self.w_fsinfo = fsinfo*fs.f_sectorsize
+            self.w_root = self._open_dir(rootcluster)
+        else:
+            rootloc = fs.f_rootstart*fs.f_sectorsize
+            self.w_fh.seek(rootloc)
+            data = bytearray(self.w_fh.read(fs.f_rootentries*32))
+            self.w_root = _WriterDir(self, 0, None, rootloc, data)
+        self.w_dirs[u""] = self.w_root
+
+    """ FAT access """
+    def get_cluster_value(self, cluster):
+        if self.w_bits == 12:
+            o = cluster + cluster/2
+            v = self.w_fat[o] | (self.w_fat[o+1] << 8)
+            return v >> 4 if cluster & 1 else v & 0xfff
+        if self.w_bits == 16:
+            o = cluster*2
+            return self.w_fat[o] | (self.w_fat[o+1] << 8)
+        o = cluster*4
+        return struct.unpack("<I", str(self.w_fat[o:o+4]))[0] & 0x0fffffff
+
+    def set_cluster_value(self, cluster, value):
+        if self.w_bits == 12:
+            o = cluster + cluster/2
+            v = self.w_fat[o] | (self.w_fat[o+1] << 8)
+            if cluster & 1:
+                v = (v & 0x000f) | (value << 4)
+            else:
+                v = (v & 0xf000) | value
+            self.w_fat[o] = v & 0xff
+            self.w_fat[o+1] = v >> 8
+            span = [o, o+2]
+        elif self.w_bits == 16:
+            o = cluster*2
+            self.w_fat[o:o+2] = struct.pack("<H", value)
+            span = [o, o+2]
+        else:
+            o = cluster*4
+            high = self.w_fat[o+3] & 0xf0
+            self.w_fat[o:o+4] = struct.pack("<I", value | (high << 24))
+            span = [o, o+4]
+        if self.w_dirty == None:
+            self.w_dirty = span
+        else:
+            self.w_dirty = [min(self.w_dirty[0],span[0]), max(self.w_dirty[1],span[1])]
+        ftb = self.fs.f_fat.ftb
+        if cluster < len(ftb):
+            ftb[cluster] = value
+            if value == 0:
+                self.fs.f_fat.free.release(cluster, 1)
+            else:
+                self.fs.f_fat.free.reserve(cluster, 1)
+
+    def get_cluster_chain(self, cluster):
+        chain = []
+        while 2 <= cluster <= self.w_lastcluster and len(chain) <= self.w_lastcluster:
+            chain.append(cluster)
+            cluster = self.get_cluster_value(cluster)
+        return chain
+
+    def allocate(self, n, after=None):
+        """ First fit from the previous allocation. Returns the new chain,
+        linked after cluster after if given """
+        if n == 0:
+            return []
+        found = []
+        c = self.w_next
+        for _ in xrange(0, self.w_lastcluster-1):
+            if self.get_cluster_value(c) == 0:
+                found.append(c)
+                if len(found) == n:
+                    break
+            c = c+1 if c < self.w_lastcluster else 2
+        if len(found) < n:
+            raise ForensicError("Not enough free clusters")
+        for i in range(0, n-1):
+            self.set_cluster_value(found[i], found[i+1])
+        self.set_cluster_value(found[-1], self.w_eoc)
+        if after != None:
+            self.set_cluster_value(after, found[0])
+        self.w_next = found[-1]+1 if found[-1] < self.w_lastcluster else 2
+        self.w_allocated += n
+        return found
+
+    def free_chain(self, cluster):
+        for c in self.get_cluster_chain(cluster):
+            self.set_cluster_value(c, 0)
+            self.w_allocated -= 1
+
+    def cluster_position(self, cluster):
+        return self.w_datastart+(cluster-2)*self.w_clustersize
+
+    """ Directories """
+    def _open_dir(self, cluster):
+        chain = self.get_cluster_chain(cluster)
+        data = bytearray()
+        for c in chain:
+            self.w_fh.seek(self.cluster_position(c))
+            data += self.w_fh.read(self.w_clustersize)
+        return _WriterDir(self, cluster, chain, None, data)
+
+    def _grow_dir(self, wdir):
+        if wdir.chain == None:
+            raise ForensicError("Root directory full")
+        c = self.allocate(1, wdir.chain[-1])[0]
+        wdir.chain.append(c)
+        wdir.data += bytearray(self.w_clustersize)
+        self.w_fh.seek(self.cluster_position(c))
+        self.w_fh.write("\0"*self.w_clustersize)
+
+    def _split(self, path):
+        return [p for p in _to_unicode(path).split(u"/") if p not in (u"", u".")]
+
+    def makedirs(self, path, dtime=None):
+        """ Create directory path and any missing parents. Returns the directory """
+        wdir = self.w_root
+        key = u""
+        for name in self._split(path):
+            key = key+u"/"+name.upper()
+            try:
+                wdir = self.w_dirs[key]
+                continue
+            except KeyError:
+                pass
+            try:
+                entry = wdir.entries[name.upper()]
+                if not entry["attr"] & ATTR_DIRECTORY:
+                    raise ForensicError("Not a directory: "+name)
+                sub = self._open_dir(entry["cluster"])
+            except KeyError:
+                sub = self._create_dir(wdir, name, dtime)
+            self.w_dirs[key] = sub
+            wdir = sub
+        return wdir
+
+    def _create_dir(self, wdir, name, dtime):
+        cluster = self.allocate(1)[0]
+        slot = self._add_entry(wdir, name, ATTR_DIRECTORY, cluster, 0, dtime)
+        data = bytearray(self.w_clustersize)
+        dot = slot[:]
+        dot[0:11] = ".          "
+        dotdot = slot[:]
+        dotdot[0:11] = "..         "
+        parent = 0 if wdir is self.w_root else wdir.cluster
+        dotdot[20:22] = struct.pack("<H", parent >> 16)
+        dotdot[26:28] = struct.pack("<H", parent & 0xffff)
+        data[0:32] = dot
+        data[32:64] = dotdot
+        self.w_fh.seek(self.cluster_position(cluster))
+        self.w_fh.write(str(data))
+        return _WriterDir(self, cluster, [cluster], None, data)
+
+    """ Names """
+    def _is_short_name(self, name):
+        if name in (u".", u".."):
+            return False
+        parts = name.split(u".")
+        if len(parts) > 2 or not 1 <= len(parts[0]) <= 8:
+            return False
+        if len(parts) == 2 and not 1 <= len(parts[1]) <= 3:
+            return False
+        for c in u"".join(parts):
+            if c not in SHORT_CHARS:
+                return False
+        return True
+
+    def _short_name(self, wdir, name):
+        """ Returns the 8.3 name and whether a long name entry is needed """
+        upper = name.upper()
+        if self._is_short_name(upper):
+            parts = upper.split(u".")
+            short = str(parts[0]).ljust(8)+str(parts[1] if len(parts) > 1 else "").ljust(3)
+            if short not in wdir.shortnames:
+                return short, upper != name
+        stripped = name.lstrip(u". ")
+        if u"." in stripped:
+            base, ext = stripped.rsplit(u".", 1)
+        else:
+            base, ext = stripped, u""
+        def clean(s):
+            r = ""
+            for c in s.upper():
+                if c in u" .":
+                    continue
+                r += str(c) if c in SHORT_CHARS else "_"
+            return r
+        base = clean(base) or "_"
+        ext = clean(ext)[:3]
+        for n in xrange(1, 1000000):
+            tail = "~"+str(n)
+            short = (base[:8-len(tail)]+tail).ljust(8)+ext.ljust(3)
+            if short not in wdir.shortnames:
+                return short, True
+        raise ForensicError("Cannot generate short name for "+name)
+
+    def _lfn_slots(self, name, short):
+        uname = name.encode("utf-16-le")+"\0\0"
+        if len(uname) % 26:
+            uname += "\xff"*(26-len(uname) % 26)
+        count = len(uname)/26
+        checksum = _lfn_checksum(short)
+        slots = []
+        for i in range(count, 0, -1):
+            part = uname[(i-1)*26:i*26]
+            seq = i | 0x40 if i == count else i
+            slots.append(struct.pack("<B10sBBB12sH4s", seq, part[0:10], ATTR_LFN, 0,
+                                     checksum, part[10:22], 0, part[22:26]))
+        return slots
+
+    def _add_entry(self, wdir, name, attr, cluster, size, dtime):
+        if len(name) > 255 or [c for c in name if c in LFN_ILLEGAL]:
+            raise ForensicError("Illegal FAT file name "+name)
+        short, needlfn = self._short_name(wdir, name)
+        slots = self._lfn_slots(name, short) if needlfn else []
+        if dtime == None:
+            dtime = datetime.datetime.now()
+        t, d = _fat_datetime(dtime)
+        entry = bytearray(struct.pack("<11sBBBHHHHHHHI", short, attr, 0, 0, t, d, d,
+                                      cluster >> 16, t, d, cluster & 0xffff, size))
+        slots.append(str(entry))
+        start = wdir.free_slots(len(slots))
+        while start == -1:
+            self._grow_dir(wdir)
+            start = wdir.free_slots(len(slots))
+        wdir.data[start:start+32*len(slots)] = "".join(slots)
+        wdir.write_slots(start, start+32*len(slots))
+        last = start+32*(len(slots)-1)
+        wdir.shortnames.add(short)
+        wdir.entries[name.upper()] = dict(name=name, first=start, last=last, attr=attr,
+                                          cluster=cluster)
+        return entry
+
+    def _remove_entry(self, wdir, entry):
+        for i in range(entry["first"], entry["last"]+32, 32):
+            wdir.data[i] = 0xe5
+        wdir.write_slots(entry["first"], entry["last"]+32)
+        if entry["cluster"]:
+            self.free_chain(entry["cluster"])
+        del wdir.entries[entry["name"].upper()]
+
+    """ Files """
+    def write_stream(self, dirpath, name, fobj, size, dtime=None):
+        """ Create file dirpath/name of size bytes read from fobj. An existing
+        file of the same name is replaced like a copy to a mounted image does """
+        name = _to_unicode(name)
+        wdir = self.makedirs(dirpath, dtime)
+        try:
+            old = wdir.entries[name.upper()]
+            if old["attr"] & ATTR_DIRECTORY:
+                raise ForensicError("Is a directory: "+name)
+            self._remove_entry(wdir, old)
+        except KeyError:
+            pass
+        n = (size+self.w_clustersize-1)/self.w_clustersize
+        chain = self.allocate(n)
+        i = 0
+        while i < n:
+            """ write contiguous runs of the chain in one go """
+            j = i+1
+            while j < n and chain[j] == chain[j-1]+1 and (j-i)*self.w_clustersize < COPY_BLOCK:
+                j += 1
+            buf = fobj.read((j-i)*self.w_clustersize)
+            self.w_fh.seek(self.cluster_position(chain[i]))
+            self.w_fh.write(buf)
+            i = j
+        self._add_entry(wdir, name, ATTR_ARCHIVE, chain[0] if chain else 0, size, dtime)
+
+    def write_file(self, path, data, dtime=None):
+        parts = _to_unicode(path).rsplit(u"/", 1)
+        dirpath, name = parts if len(parts) == 2 else [u"", parts[0]]
+        self.write_stream(dirpath, name, StringIO(data), len(data), dtime)
+
+    def copy_file(self, source, dirpath, dtime=None):
+        """ Copy local file source into directory dirpath of the image """
+        try:
+            size = os.path.getsize(source)
+            fobj = open(source, "rb")
+        except (IOError, OSError):
+            raise ForensicError("Cannot read "+source)
+        try:
+            self.write_stream(dirpath, os.path.basename(source), fobj, size, dtime)
+        finally:
+            fobj.close()
+
+    def close(self):
+        """ Write the changed part of the FAT to every FAT copy and update
+        FAT32 FSInfo """
+        if self.w_dirty != None:
+            start, end = self.w_dirty
+            for i in range(0, self.fs.f_numberoffats):
+                self.w_fh.seek(self.w_fatstart+i*self.w_fatbytes+start)
+                self.w_fh.write(str(self.w_fat[start:end]))
+            self.fs.f_fat.rawdata = str(self.w_fat)
+            self.w_dirty = None
+        if self.w_fsinfo != None and self.w_allocated != 0:
+            self.w_fh.seek(self.w_fsinfo)
+            info = self.w_fh.read(512)
+            if info[0:4] == "RRaA" and info[484:488] == "rrAa":
+                free, = struct.unpack("<I", info[488:492])
+                if free != 0xffffffff:
+                    self.w_fh.seek(self.w_fsinfo+488)
+                    self.w_fh.write(struct.pack("<II", max(0, free-self.w_allocated),
+                                                self.w_next))
+            self.w_allocated = 0
+        self.fs.fs_mark_directories([d.cluster for d in self.w_dirs.values() if d.modified])
+        self.w_fh.close()
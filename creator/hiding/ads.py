@@ -24,9 +24,16 @@ from ui.uitools import errlog
 FLAG_SYSTEM = 0x1
 FLAG_DIRECTORY = 0x2
 FLAG_REGULAR = 0x4
+FLAG_FILESYSTEM = 1
+FLAG_RAW = 2
+FLAG_TIMELINE = 3
 
 
 
+""" priorityflag tells how a method reaches the image: FLAG_FILESYSTEM
+through the mounted file system, FLAG_RAW by writing the image through the 
+parser. processCase runs the FLAG_FILESYSTEM methods of a priority level
+in one mount session. 0 means the method does not say """
 class HidingMethod(object):
     def __init__(self): 
         self.supported = []
@@ -45,6 +52,7 @@ class AlternateDataStream(HidingMethod):
     def __init__(self,filesystem):
         super(AlternateDataStream, self).__init__()
         self.fs = filesystem
+        self.priorityflag = FLAG_FILESYSTEM
 
 
     def hide_file(self,hfile,image,param = {}):
@@ -25,6 +25,9 @@ import sys
 FLAG_SYSTEM = 0x1
 FLAG_DIRECTORY = 0x2
 FLAG_REGULAR = 0x4
+FLAG_FILESYSTEM = 1
+FLAG_RAW = 2
+FLAG_TIMELINE = 3
 
 
 """ Parameters taken:
@@ -37,6 +40,7 @@ class ExtensionChange(HidingMethod):
     def __init__(self,filesystem):
         super(ExtensionChange, self).__init__()
         self.fs = filesystem
+        self.priorityflag = FLAG_FILESYSTEM
 
 
     def hide_file(self, hfile, image, param = {}):
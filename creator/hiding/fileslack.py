@@ -24,6 +24,9 @@ import sys
 FLAG_SYSTEM = 0x1
 FLAG_DIRECTORY = 0x2
 FLAG_REGULAR = 0x4
+FLAG_FILESYSTEM = 1
+FLAG_RAW = 2
+FLAG_TIMELINE = 3
 
 
 """ params taken: """
@@ -32,6 +35,7 @@ class FileSlack(HidingMethod):
     def __init__(self,filesystem):
         super(FileSlack, self).__init__()
         self.fs = filesystem
+        self.priorityflag = FLAG_RAW
 
         
     def hide_file(self, hfile, image, param = {}):
@@ -27,6 +27,9 @@ from subprocess import call
 FLAG_SYSTEM = 0x1
 FLAG_DIRECTORY = 0x2
 FLAG_REGULAR = 0x4
+FLAG_FILESYSTEM = 1
+FLAG_RAW = 2
+FLAG_TIMELINE = 3
 
 
 """ Parameters taken:
@@ -38,6 +41,7 @@ class Steganography(HidingMethod):
     def __init__(self,filesystem):
         super(Steganography, self).__init__()
         self.fs = filesystem
+        self.priorityflag = FLAG_FILESYSTEM
 
 
     def hide_file(self, hfile, image, param = {}):
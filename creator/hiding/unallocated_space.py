@@ -24,6 +24,9 @@ import sys
 FLAG_SYSTEM = 0x1
 FLAG_DIRECTORY = 0x2
 FLAG_REGULAR = 0x4
+FLAG_FILESYSTEM = 1
+FLAG_RAW = 2
+FLAG_TIMELINE = 3
 
 
 """ params taken:
@@ -34,6 +37,7 @@ class UnallocatedSpace(HidingMethod):
     def __init__(self,filesystem):
         super(UnallocatedSpace, self).__init__()
         self.fs = filesystem
+        self.priorityflag = FLAG_RAW
 
         
     def hide_file(self, hfile, image, param = {}):
@@ -55,8 +59,9 @@ class UnallocatedSpace(HidingMethod):
             raise ForensicError("Not enough unallcoated space")
 
         self.fs.write_location(spc,buf)
-        for c in xrange(int(spc/self.fs.f_clustersize), int((spc+len(buf))/self.fs.f_clustersize)):
-            self.fs.set_cluster_status(c,1,mark_used)
+        first = int(spc/self.fs.f_clustersize)
+        last = int((spc+max(len(buf),1)-1)/self.fs.f_clustersize)
+        self.fs.set_cluster_range(first,last-first+1,1,mark_used)
 
         hf = "location: "+str(spc)+",length: "+str(len(buf))
         return dict(instruction=hf)
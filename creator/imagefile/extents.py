@@ -0,0 +1,154 @@
+'''
+Copyright 2014 Hannu Visti
+
+This file is part of ForGe forensic test image generator.
+ForGe is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import re
+from bisect import bisect_left, bisect_right
+from random import randint
+
+_ZERO_BYTES = re.compile("\x00+")
+
+""" Free runs [first cluster, length] of a FAT given as the raw bytes of its
+typed entry array, width bytes per entry. An entry is free when all its bytes
+are zero, so the free entries are the ones that lie wholly inside a run of
+zero bytes. The regular expression finds those runs in C """
+def runs_from_entries(raw, width):
+    runs = []
+    for m in _ZERO_BYTES.finditer(raw):
+        first = (m.start()+width-1)/width
+        last = m.end()/width
+        if last > first:
+            runs.append([first, last-first])
+    return runs
+
+_BITMAP_RUNS = re.compile("\x00+|[^\x00\xff]")
+
+def _zero_bit_runs(value):
+    runs = []
+    for bit in range(0, 8):
+        if (value >> bit) & 1:
+            continue
+        if runs and runs[-1][0]+runs[-1][1] == bit:
+            runs[-1][1] += 1
+        else:
+            runs.append([bit, 1])
+    return runs
+
+""" zero bit runs [first bit, length] of every byte value """
+_BYTE_RUNS = [_zero_bit_runs(v) for v in range(0, 256)]
+
+""" Free runs [first cluster, length] of an allocation bitmap, cluster n in
+bit n%8 of byte n/8. Runs of zero bytes are found with a regular expression.
+Only bytes that are partly used are looked at bit by bit, through a table """
+def runs_from_bitmap(bitmap):
+    runs = []
+    for m in _BITMAP_RUNS.finditer(bitmap):
+        if m.end()-m.start() > 1 or bitmap[m.start()] == "\x00":
+            pieces = [[0, 8*(m.end()-m.start())]]
+        else:
+            pieces = _BYTE_RUNS[ord(bitmap[m.start()])]
+        base = 8*m.start()
+        for offset, length in pieces:
+            if runs and runs[-1][0]+runs[-1][1] == base+offset:
+                runs[-1][1] += length
+            else:
+                runs.append([base+offset, length])
+    return runs
+
+""" Sorted index of free cluster runs. Runs are kept twice: by first cluster
+to find the run a cluster belongs to, and by length to find the runs that
+can hold a request. Both are sorted lists searched with bisect. Clusters
+outside [lo, hi) are never handed out """
+class FreeExtentIndex(object):
+    def __init__(self, runs, lo=0, hi=None):
+        self.e_starts = []
+        self.e_lengths = []
+        self.e_bylength = []
+        self.e_lo = lo
+        self.e_hi = hi
+        for start, length in runs:
+            end = start+length if hi == None else min(start+length, hi)
+            start = max(start, lo)
+            if end > start:
+                self._add(start, end-start)
+
+    def _add(self, start, length):
+        i = bisect_left(self.e_starts, start)
+        self.e_starts.insert(i, start)
+        self.e_lengths.insert(i, length)
+        self.e_bylength.insert(bisect_left(self.e_bylength, (length, start)), (length, start))
+
+    def _remove(self, i):
+        key = (self.e_lengths[i], self.e_starts[i])
+        del self.e_bylength[bisect_left(self.e_bylength, key)]
+        del self.e_starts[i]
+        del self.e_lengths[i]
+
+    """ First cluster of n free consecutive clusters, -1 if there is no room.
+    The run is picked at random among the runs long enough, then the position
+    at random within the run """
+    def find(self, n):
+        k = bisect_left(self.e_bylength, (n, -1))
+        if k == len(self.e_bylength):
+            return -1
+        length, start = self.e_bylength[randint(k, len(self.e_bylength)-1)]
+        return start+randint(0, length-n)
+
+    """ Take clusters start..start+n-1 out of the index. Clusters that are
+    not free are ignored """
+    def reserve(self, start, n):
+        end = start+n
+        i = max(bisect_right(self.e_starts, start)-1, 0)
+        while i < len(self.e_starts) and self.e_starts[i] < end:
+            rstart = self.e_starts[i]
+            rend = rstart+self.e_lengths[i]
+            if rend <= start:
+                i += 1
+                continue
+            self._remove(i)
+            if rstart < start:
+                self._add(rstart, start-rstart)
+                i += 1
+            if rend > end:
+                self._add(end, rend-end)
+                i += 1
+
+    """ Return clusters start..start+n-1 to the index, merging them with the
+    neighbouring runs """
+    def release(self, start, n):
+        end = start+n if self.e_hi == None else min(start+n, self.e_hi)
+        start = max(start, self.e_lo)
+        if end <= start:
+            return
+        i = bisect_right(self.e_starts, start)-1
+        if i >= 0 and self.e_starts[i]+self.e_lengths[i] >= start:
+            start = self.e_starts[i]
+            end = max(end, start+self.e_lengths[i])
+            self._remove(i)
+        else:
+            i += 1
+        while i < len(self.e_starts) and self.e_starts[i] <= end:
+            end = max(end, self.e_starts[i]+self.e_lengths[i])
+            self._remove(i)
+        self._add(start, end-start)
+
+    """ True if all of clusters start..start+n-1 are in the index """
+    def is_free_range(self, start, n):
+        i = bisect_right(self.e_starts, start)-1
+        return i >= 0 and start+n <= self.e_starts[i]+self.e_lengths[i]
+
+    def is_free(self, cluster):
+        i = bisect_right(self.e_starts, cluster)-1
+        return i >= 0 and cluster < self.e_starts[i]+self.e_lengths[i]
+
+    def get_runs(self):
+        return zip(self.e_starts, self.e_lengths)
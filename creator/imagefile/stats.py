@@ -0,0 +1,90 @@
+'''
+Copyright 2014 Hannu Visti
+
+This file is part of ForGe forensic test image generator.
+ForGe is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+
+""" I/O counters kept per stage of an image build """
+COUNTERS = ("reads", "bytes_read", "writes", "bytes_written", "write_calls",
+            "mounts", "umounts")
+
+""" Collector of the image being built. A process builds one image at a time,
+so one active collector per process is enough """
+_active = None
+
+def count(name, n=1):
+    if _active != None:
+        _active.s_counters[name] += n
+
+""" Wall time and I/O counters of the stages of one image build. A stage
+lasts from begin() to the next begin() or end() """
+class StageStats(object):
+    def __init__(self):
+        self.s_counters = dict.fromkeys(COUNTERS, 0)
+        self.s_stages = []
+        self.s_current = None
+
+    def activate(self):
+        global _active
+        _active = self
+
+    def deactivate(self):
+        global _active
+        self.end()
+        if _active is self:
+            _active = None
+
+    def begin(self, name):
+        self.end()
+        self.s_current = [name, time.time(), dict(self.s_counters)]
+
+    def end(self):
+        if self.s_current == None:
+            return
+        name, start, before = self.s_current
+        stage = dict(name=name, seconds=time.time()-start)
+        for c in COUNTERS:
+            stage[c] = self.s_counters[c]-before[c]
+        self.s_stages.append(stage)
+        self.s_current = None
+
+    def get_stages(self):
+        return self.s_stages
+
+""" File object wrapper that counts reads and writes, for writers that keep
+their own handle on the image """
+class CountingFile(object):
+    def __init__(self, fh):
+        self.c_fh = fh
+
+    def read(self, *args):
+        buf = self.c_fh.read(*args)
+        count("reads")
+        count("bytes_read", len(buf))
+        return buf
+
+    def write(self, data):
+        self.c_fh.write(data)
+        count("writes")
+        count("bytes_written", len(data))
+
+    def seek(self, *args):
+        self.c_fh.seek(*args)
+
+    def tell(self):
+        return self.c_fh.tell()
+
+    def flush(self):
+        self.c_fh.flush()
+
+    def close(self):
+        self.c_fh.close()
@@ -0,0 +1,123 @@
+'''
+Copyright 2014 Hannu Visti
+
+This file is part of ForGe forensic test image generator.
+ForGe is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import fcntl
+from ui.uitools import ForensicError
+from ui.uitools import Chelper
+from ui.uitools import errlog
+
+""" ioctl number of FICLONE (BTRFS_IOC_CLONE), linux/fs.h """
+FICLONE = 0x40049409
+COPY_BLOCK = 1024*1024
+TEMPLATEDIR = "templates"
+
+""" Golden base images. All images of a case share file system, size, cluster 
+size and garbage flag, so chelper create is run once per such combination and 
+every image is a copy of that pristine template. The copy is a reflink where 
+the file system supports it and a sparse copy otherwise. The file system 
+specific restamp function then gives each copy its own volume serial and label.
+
+Templates are kept in PREFIX/templates. Remove the directory after changing 
+chelper or the mkfs tools. """
+
+class TemplateCache(object):
+    def __init__(self, prefix=None):
+        if prefix == None:
+            prefix = Chelper().prefix
+        self.t_prefix = prefix
+        self.t_dir = os.path.join(prefix, TEMPLATEDIR)
+
+    def template_name(self, key):
+        return TEMPLATEDIR+"/"+"-".join([str(k) for k in key])
+
+    """ Create image name from the template identified by key. create(tname) 
+    builds the template with chelper and returns its exit code, restamp(path) 
+    re-randomises the identity of a copy. Returns 0 on success like call() """
+    def create_image(self, key, name, create, restamp):
+        tname = self.template_name(key)
+        tpath = os.path.join(self.t_prefix, tname)
+        target = os.path.join(self.t_prefix, name)
+        if not os.path.isdir(self.t_dir):
+            try:
+                os.makedirs(self.t_dir)
+            except OSError:
+                if not os.path.isdir(self.t_dir):
+                    errlog("Cannot create template directory")
+                    return 1
+
+        """ Parallel workers of a case want the same template at the same time. 
+        Only one of them creates it, the rest wait for the lock """
+        lock = open(tpath+".lock", "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(tpath):
+                result = create(tname)
+                if result != 0 or not os.path.exists(tpath):
+                    self._remove(tpath)
+                    return result if result != 0 else 1
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+        try:
+            self.clone(tpath, target)
+        except (IOError, OSError) as e:
+            errlog(e)
+            return 1
+        try:
+            restamp(target)
+        except ForensicError as fe:
+            """ Template did not come out as a file system, throw both away """
+            errlog(fe)
+            self._remove(target)
+            self._remove(tpath)
+            return 1
+        return 0
+
+    """ Copy src to dst. Refuses to overwrite dst like chelper create does """
+    def clone(self, src, dst):
+        sfd = os.open(src, os.O_RDONLY)
+        try:
+            dfd = os.open(dst, os.O_EXCL|os.O_CREAT|os.O_WRONLY, 0664)
+            try:
+                try:
+                    fcntl.ioctl(dfd, FICLONE, sfd)
+                    return
+                except IOError:
+                    pass
+                self._sparse_copy(sfd, dfd, os.fstat(sfd).st_size)
+            finally:
+                os.close(dfd)
+        finally:
+            os.close(sfd)
+
+    """ Blocks of zeroes are skipped, leaving holes in dst """
+    def _sparse_copy(self, sfd, dfd, size):
+        zero = "\0"*COPY_BLOCK
+        pos = 0
+        while pos < size:
+            buf = os.read(sfd, COPY_BLOCK)
+            if not buf:
+                break
+            if buf == zero[:len(buf)]:
+                os.lseek(dfd, len(buf), os.SEEK_CUR)
+            else:
+                os.write(dfd, buf)
+            pos += len(buf)
+        os.ftruncate(dfd, pos)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
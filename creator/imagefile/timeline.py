@@ -0,0 +1,72 @@
+'''
+Copyright 2014 Hannu Visti
+
+This file is part of ForGe forensic test image generator.
+ForGe is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from ui.uitools import ForensicError
+
+""" Applies the timestamp changes of a whole image in one batch. Paths are
+resolved first with the file system's path index. Changes that hit the same
+target, an MFT record or a FAT directory entry, are grouped and applied
+in their original order with one write per target. Targets are visited in
+on-disk order and the image is flushed once.
+
+The file system provides timeline_target(path), which returns [sort key,
+target] or raises ForensicError, and change_times(target, btimes), which
+applies a list of change_time dictionaries to a target. Changes happen
+between timeline_begin() and timeline_end(), where the file system may 
+hold back writes it can combine. A path that cannot be resolved or changed
+is reported, the rest of the timeline goes on """
+
+class TimelineEngine(object):
+    def __init__(self, fs):
+        self.t_fs = fs
+        self.t_changes = []
+
+    """ btime is a change_time dictionary or a datetime for all times """
+    def add(self, path, btime):
+        if not isinstance(btime, dict):
+            btime = dict(all=btime)
+        self.t_changes.append([path, btime])
+
+    """ [[path, datetime],..] as collected by processCase """
+    def add_list(self, commands):
+        for path, btime in commands:
+            self.add(path, btime)
+
+    """ Returns [[path, error message],..] of the changes that failed """
+    def apply(self):
+        failed = []
+        groups = {}
+        for path, btime in self.t_changes:
+            try:
+                key, target = self.t_fs.timeline_target(path)
+            except ForensicError as fe:
+                failed.append([path, fe.value])
+                continue
+            if key not in groups:
+                groups[key] = [target, [], []]
+            groups[key][1].append(path)
+            groups[key][2].append(btime)
+        self.t_fs.timeline_begin()
+        try:
+            for key in sorted(groups.keys()):
+                target, paths, btimes = groups[key]
+                try:
+                    self.t_fs.change_times(target, btimes)
+                except ForensicError as fe:
+                    for path in sorted(set(paths)):
+                        failed.append([path, fe.value])
+        finally:
+            self.t_fs.timeline_end()
+        self.t_fs.fs_flush()
+        self.t_changes = []
+        return failed
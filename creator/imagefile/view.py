@@ -0,0 +1,85 @@
+'''
+Copyright 2014 Hannu Visti
+
+This file is part of ForGe forensic test image generator.
+ForGe is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import mmap
+from ui.uitools import ForensicError
+from stats import count
+
+""" piece size of iter_extents """
+STREAM_CHUNK = 1024*1024
+
+""" Read-only memory map of an image file, shared by a file system object and
+its parser. Reads are slices of the map instead of seek and read calls. The
+map shares the page cache with every other user of the file, so writes made
+through other handles are visible at once. This includes the direct writers
+and loop mounts. Data buffered in an ImageWriter must still be flushed
+before it is read.
+
+The parsers work on str, so read() returns a copy made in a single slice.
+buffer() returns a zero-copy window for callers that only unpack from it """
+
+class ImageView(object):
+    def __init__(self, fname):
+        try:
+            fh = open(fname, "rb")
+            try:
+                self.v_map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                fh.close()
+        except (IOError, mmap.error, ValueError):
+            raise ForensicError("Cannot map image "+fname)
+        self.v_size = len(self.v_map)
+
+    def read(self, position, length):
+        count("reads")
+        count("bytes_read", length)
+        return self.v_map[position:position+length]
+
+    def buffer(self, position, length):
+        return buffer(self.v_map, position, length)
+
+    """ Concatenated contents of extents given as [image offset, length]. A
+    single extent is one slice, several are sliced and joined in one pass """
+    def read_extents(self, extents):
+        count("reads", len(extents))
+        count("bytes_read", sum([l for p,l in extents]))
+        if len(extents) == 1:
+            p, l = extents[0]
+            return self.v_map[p:p+l]
+        return "".join([self.v_map[p:p+l] for p,l in extents])
+
+    """ The same contents as read_extents in pieces of chunk bytes, the last
+    one may be shorter. Large attributes are walked without holding all of
+    their data at once """
+    def iter_extents(self, extents, chunk=STREAM_CHUNK):
+        pieces = []
+        size = 0
+        for p, l in extents:
+            count("reads")
+            while l > 0:
+                n = min(l, chunk-size)
+                pieces.append(self.v_map[p:p+n])
+                size += n
+                p += n
+                l -= n
+                if size == chunk:
+                    count("bytes_read", size)
+                    yield "".join(pieces)
+                    pieces = []
+                    size = 0
+        if size > 0:
+            count("bytes_read", size)
+            yield "".join(pieces)
+
+    def close(self):
+        self.v_map.close()
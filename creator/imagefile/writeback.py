@@ -0,0 +1,124 @@
+'''
+Copyright 2014 Hannu Visti
+
+This file is part of ForGe forensic test image generator.
+ForGe is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from bisect import bisect_left
+from ui.uitools import ForensicError
+from stats import count
+
+""" pending bytes that trigger an automatic flush """
+WRITEBACK_LIMIT = 4*1024*1024
+
+""" Write-back buffer for the small writes parsers make into an image:
+timestamps, bitmap bytes, FAT entries and slack. The image is opened once.
+Writes are kept as extents sorted by offset. Adjacent and overlapping
+writes merge into one extent, and a later write wins where they overlap.
+
+Anything that reads the image file directly, writes to it through another
+handle, or mounts it must flush first """
+
+class ImageWriter(object):
+    def __init__(self, fname, limit=WRITEBACK_LIMIT):
+        self.i_filename = fname
+        self.i_limit = limit
+        self.i_fh = None
+        self.i_starts = []
+        self.i_data = []
+        self.i_pending = 0
+
+    def write(self, position, data):
+        count("write_calls")
+        end = position+len(data)
+        i = bisect_left(self.i_starts, position)
+        if i > 0 and self.i_starts[i-1]+len(self.i_data[i-1]) >= position:
+            i -= 1
+        j = i
+        while j < len(self.i_starts) and self.i_starts[j] <= end:
+            j += 1
+        if i == j:
+            self.i_starts.insert(i, position)
+            self.i_data.insert(i, bytearray(data))
+            self.i_pending += len(data)
+        else:
+            start = min(self.i_starts[i], position)
+            stop = max(end, self.i_starts[j-1]+len(self.i_data[j-1]))
+            buf = bytearray(stop-start)
+            for k in range(i, j):
+                o = self.i_starts[k]-start
+                buf[o:o+len(self.i_data[k])] = self.i_data[k]
+                self.i_pending -= len(self.i_data[k])
+            buf[position-start:end-start] = data
+            self.i_starts[i:j] = [start]
+            self.i_data[i:j] = [buf]
+            self.i_pending += len(buf)
+        if self.i_pending >= self.i_limit:
+            self.flush()
+
+    """ Image contents with pending writes applied """
+    def read(self, position, length):
+        self._open()
+        self.i_fh.seek(position)
+        data = self.i_fh.read(length)
+        return self.overlay(position, data+"\0"*(length-len(data)))
+
+    """ data, read from the image at position, with pending writes applied """
+    def overlay(self, position, data):
+        if len(self.i_starts) == 0:
+            return data
+        buf = None
+        length = len(data)
+        end = position+length
+        i = bisect_left(self.i_starts, position)
+        if i > 0:
+            i -= 1
+        while i < len(self.i_starts) and self.i_starts[i] < end:
+            s = self.i_starts[i]
+            d = self.i_data[i]
+            lo = max(s, position)
+            hi = min(s+len(d), end)
+            if lo < hi:
+                if buf == None:
+                    buf = bytearray(data)
+                buf[lo-position:hi-position] = d[lo-s:hi-s]
+            i += 1
+        return data if buf == None else str(buf)
+
+    def flush(self):
+        if len(self.i_starts) == 0:
+            return
+        self._open()
+        try:
+            for i in range(0, len(self.i_starts)):
+                self.i_fh.seek(self.i_starts[i])
+                self.i_fh.write(str(self.i_data[i]))
+                count("writes")
+                count("bytes_written", len(self.i_data[i]))
+            self.i_fh.flush()
+        except IOError:
+            raise ForensicError("Cannot write to image")
+        self.i_starts = []
+        self.i_data = []
+        self.i_pending = 0
+
+    """ flush and release the file handle """
+    def close(self):
+        self.flush()
+        if self.i_fh != None:
+            self.i_fh.close()
+            self.i_fh = None
+
+    def _open(self):
+        if self.i_fh == None:
+            try:
+                self.i_fh = open(self.i_filename, "r+b")
+            except IOError:
+                raise ForensicError("Cannot write to image")
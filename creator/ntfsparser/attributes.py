@@ -17,9 +17,14 @@ along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
 
 import struct
 import sys
+from array import array
+from bisect import bisect_right
+from imagefile.view import STREAM_CHUNK
 from tools import _NTFSTime, _hexdump
-from tools import _Unpack48, _Pack48
+from tools import _Unpack48, _Pack48, _set_bit_range
+from tools import _fixup_blocks, _remove_fixup, _apply_fixup
 from directory import _DirIndexEntry
+from ui.uitools import ForensicError
 from directory import _ParseIndexEntries
 
 def parse_attributes(block):
@@ -33,6 +38,14 @@ def parse_attributes(block):
         pq += l
         yield [r,l,struct.unpack("<I",block[r:r+4])[0]]
 
+""" Little endian integer of a runlist field, 0 to 8 bytes long """
+def _unpack_le(data, signed):
+    if len(data) == 0:
+        return 0
+    if signed and ord(data[-1]) & 0x80:
+        return struct.unpack("<q", data+"\xff"*(8-len(data)))[0]
+    return struct.unpack("<Q", data+"\x00"*(8-len(data)))[0]
+
 class _ResidentAttribute(object):
     """ create a resident attribute. method read_data(start,end) 
     returns a chunk of data. read_data (-1,-1) return all data """
@@ -71,7 +84,9 @@ class _ResidentAttribute(object):
         print "Length:", self.a_size
 
 class _NonResidentAttribute(object):
-    """ create a non-resident attribute. read_data(start,end) return a chunk of data """
+    """ create a non-resident attribute. read_data(start,end) return a chunk of data.
+    Data runs are kept as extents: first virtual cluster, first logical cluster
+    and length, one array each, searched with bisect """
     
     def __init__(self,attr,parent):
         self.a_start_v_cluster = struct.unpack("<Q", attr[16:24])[0]
@@ -86,8 +101,9 @@ class _NonResidentAttribute(object):
         self.parent = parent
 
         
-        self.a_clusterrun = []
-        self.a_clusterlist = []
+        self.a_vcns = array("L")
+        self.a_lcns = array("l")
+        self.a_lengths = array("L")
 
         
         if self.a_start_v_cluster != 0:
@@ -99,82 +115,80 @@ class _NonResidentAttribute(object):
         
         
         while i <= self.a_end_v_cluster:
-            nibble = struct.unpack("B",attr[ptr:ptr+1])[0]
+            nibble = ord(attr[ptr])
             nibble_offset = (nibble & 240) >> 4
             nibble_length = nibble & 15
             
             if nibble_offset == 0:
                 break
-            nhex = ""
             ptr += 1
-            while nibble_length > 0:
-                nibble_length -= 1
-                nhex = '%02x' % struct.unpack("B",attr[ptr:ptr+1])[0] + nhex
-                ptr += 1
-            rlength = int(nhex,16)
-            nhex = ""
+            rlength = _unpack_le(attr[ptr:ptr+nibble_length], False)
+            ptr += nibble_length
             
             """ This can be negative as well """
-            max_of_this_offset = 256 ** nibble_offset
-            while nibble_offset > 0:
-                nibble_offset -= 1
-                nhex = '%02x' % struct.unpack("B",attr[ptr:ptr+1])[0] + nhex
-                ptr += 1
-            offset_candidate = int(nhex,16)
-            if offset_candidate > max_of_this_offset/2:
-                offset_candidate = -(max_of_this_offset-offset_candidate)
-            offset = offset_candidate + previous_run
+            offset = _unpack_le(attr[ptr:ptr+nibble_offset], True) + previous_run
+            ptr += nibble_offset
 
+            self.a_vcns.append(i)
+            self.a_lcns.append(offset)
+            self.a_lengths.append(rlength)
             i += rlength
-            self.a_clusterrun.append([rlength, offset])
-            for a in range(offset, offset+rlength):
-                self.a_clusterlist.append(a)
             previous_run = offset
         self.nonres_datablock = attr[16:ptr]
 
-    def _read_cluster(self, filed, clnum):
-        gl_clustersize = self.parent.parent.parent.f_clustersize
-        filed.seek(clnum*gl_clustersize)
-        z = filed.read(gl_clustersize)
-        
-        return z
+    """ index of the extent holding virtual cluster vcn """
+    def _extent(self, vcn):
+        i = bisect_right(self.a_vcns, vcn)-1
+        if i < 0 or vcn >= self.a_vcns[i]+self.a_lengths[i]:
+            raise IndexError("cluster outside the data runs")
+        return i
+
     def pack_residency(self):
         return self.nonres_datablock
 
+    """ end is the number of bytes to read. Runs that follow each other
+    on disk are sliced from the image view in one piece """
     def read_data(self,offset, end):
-        
+        view = self.parent.parent.parent.fs_view
+        return view.read_extents(self._data_extents(offset, end))
+
+    """ read_data as an iterator of chunk byte pieces """
+    def iter_data(self, offset, end, chunk=STREAM_CHUNK):
+        view = self.parent.parent.parent.fs_view
+        return view.iter_extents(self._data_extents(offset, end), chunk)
+
+    """ [image offset, length] pieces of the data, offset and end as in read_data """
+    def _data_extents(self, offset, end):
         gl_clustersize = self.parent.parent.parent.f_clustersize
-        fi = open(self.parent.parent.parent.fs_filename, "r")
 
         if offset == -1:
             offset = 0
             end = self.a_actual_size_of_content 
         elif end == -1:
             end = self.a_actual_size_of_content - offset
-
-        buf = ""
-
-        # First cluster - may be partial
-        cluster = int(offset / gl_clustersize)
-        tmp = self._read_cluster(fi, self.a_clusterlist[cluster])
-        buf = buf + tmp[offset - cluster*gl_clustersize:offset - cluster*gl_clustersize + end]
-        qread = len(buf)
-
-        if qread == end:
-            return buf
-        cluster += 1
-        while True:
-            
-            tmp = self._read_cluster(fi, self.a_clusterlist[cluster])
-            if end - qread > gl_clustersize:
-                buf = buf + tmp
-                qread += len(tmp)
-                cluster += 1
+        extents = []
+        if end <= 0:
+            return extents
+
+        vcn = int(offset / gl_clustersize)
+        i = self._extent(vcn)
+        skip = offset - vcn*gl_clustersize
+        remaining = end
+        while remaining > 0:
+            if i >= len(self.a_vcns):
+                raise IndexError("read past the data runs")
+            position = (self.a_lcns[i] + vcn - self.a_vcns[i])*gl_clustersize + skip
+            length = min((self.a_vcns[i]+self.a_lengths[i]-vcn)*gl_clustersize - skip, remaining)
+            if len(extents) > 0 and extents[-1][0]+extents[-1][1] == position:
+                extents[-1][1] += length
             else:
-                buf += tmp[:end - qread]
-                break
-        fi.close()
-        return buf
+                extents.append([position, length])
+            remaining -= length
+            skip = 0
+            i += 1
+            if i < len(self.a_vcns):
+                vcn = self.a_vcns[i]
+        return extents
     
     
     
@@ -182,8 +196,9 @@ class _NonResidentAttribute(object):
         gl_clustersize = self.parent.parent.parent.f_clustersize
         """ "First cluster - may be partial """
         cluster = int(offset / gl_clustersize)
+        i = self._extent(cluster)
 
-        br = gl_clustersize * self.a_clusterlist[cluster]
+        br = gl_clustersize * (self.a_lcns[i] + cluster - self.a_vcns[i])
         br += (offset % gl_clustersize)
         return br
 
@@ -191,10 +206,9 @@ class _NonResidentAttribute(object):
 
     """ slack may be found in the last cluster """
     def init_slack(self):
-        try:
-            last_cluster = self.a_clusterlist[-1]
-        except IndexError:
+        if len(self.a_lcns) == 0:
             return
+        last_cluster = self.a_lcns[-1]+self.a_lengths[-1]-1
         
         gl_clustersize = self.parent.parent.parent.f_clustersize
         gl_sectorsize = self.parent.parent.parent.f_sectorsize
@@ -313,7 +327,7 @@ class _NTFSAttributeStandard(_NTFSAttribute):
         buf += self.a_time.raw_time()
         buf += struct.pack("<IIII",self.a_dospermissions,self.a_maxversions,
                            self.a_versionnumber, self.a_classid)
-        self.parent.parent.write_location(self.a_location,buf)
+        self.parent.write_location(self.a_location,buf)
         
         
     def attribute_name(self):
@@ -376,7 +390,7 @@ class _NTFSAttributeFileName(_NTFSAttribute):
         """ padded to 8 bytes """
         buf += '\x00'* (self.a_length - len(buf))
         
-        self.parent.parent.write_location(self.a_location,buf)
+        self.parent.write_location(self.a_location,buf)
 
     def attribute_print(self):
         self.A_print_header()
@@ -528,7 +542,7 @@ class _NTFSAttributeIndexRoot(_NTFSAttribute):
         egen = _ParseIndexEntries(self.a_content.read_data(loc,-1))
         for dirtmp in egen:
             tmp = dirtmp[0]
-            entry = _DirIndexEntry(self,dirtmp[1]+self.a_location+loc)
+            entry = _DirIndexEntry(self,dirtmp[1]+self.a_location+self.a_content.a_offset+loc)
             entry.init_entry(tmp, self.a_ir_attrtype)     
             self.parent.m_ir_entry.append(entry)
 
@@ -537,6 +551,11 @@ class _NTFSAttributeIndexRoot(_NTFSAttribute):
 
         self.parent.set_directory()  
         
+    """ Write data at offset of an entry of this index root. The entry lives
+    in the MFT record, which stages the write """
+    def write_entry(self, entry, offset, data):
+        self.parent.write_location(entry.location+offset, data)
+
     def write_attribute(self):
         return       
     def attribute_print(self):
@@ -551,71 +570,120 @@ class _NTFSAttributeIndexAllocation(_NTFSAttribute):
         
     def init_attribute(self,attr,offset):
         self.a_location = offset
-        
-        """ every index buffer has a magic number, called VCN number. 
-            This has nothing to do with virtual clusters. Find the index buffer
-            corresponding to VCN and return it """
-            
-        def __returnIndexBlock(data,vcn):
-            
-            indexsize = self.parent.parent.f_indexbuffersize
-            idx = 0
-            while idx < len(data):
-                datmp = data[idx*indexsize:(idx+1)*indexsize]
-                clnum, = struct.unpack("<Q",datmp[0x10:0x18])
-                if clnum == vcn:
-                    return [datmp,idx*indexsize]
-                idx += 1
-            
-            """ this should not happen """
-            print "Index buffer not found, exiting", vcn
-            exit(1)
-     
         self.parse_header(attr)
         if self.a_resident == True:
             self.a_content = _ResidentAttribute(attr, self)
         else:
             self.a_content = _NonResidentAttribute(attr, self)
-        wholedata = self.a_content.read_data(-1,-1)
-        
-        
-        """ try to make sense of b-trees """
-        
-        
-        while True:
-            try:
-                vcn = self.parent.m_dirtmp.pop()
-                data,vcnloc = __returnIndexBlock(wholedata,vcn)
-                baselocation = self.a_content.locate_data(vcnloc)
-                """ Fixup array """
-                updateoffset = struct.unpack("<H", data[4:6])[0]
-                fixup = struct.unpack("<H", data[6:8])[0]
-                x = updateoffset + 2
-                y = fixup - 1
-                mtmp = data
-    
-                for z in range (0,y):
-                    f = data[x] + data[x+1]
-                    x += 2
-                    mtmp = mtmp[:z*512+510]+f+mtmp[(z+1)*512:]
-                
-                """ Find the exact length of index entries """
-                self.a_ir_endsequence, self.a_ir_endbuffer = struct.unpack("<II", mtmp[0x1c:0x24])
-                """ process entries """
-                
-                egen = _ParseIndexEntries(mtmp[0x40:self.a_ir_endsequence+0x18])            
-                for dirtmp in egen:
-                    tmp = dirtmp[0]
-                    entry = _DirIndexEntry(self,baselocation+dirtmp[1]+0x40)
-                    entry.init_entry(tmp, 0x30)
-                    self.parent.m_ir_entry.append(entry)
-                    if entry.flags & 1 != 0 and entry.vcn != 0:
-                        self.parent.m_dirtmp.append(entry.vcn)
-                    #__entry.print_entry()
-            except IndexError:
-                self.parent.set_directory()
-                break
+
+        """ try to make sense of b-trees. Buffers named in the index root 
+            are walked here, iter_index_entries can walk them again. Only
+            directory indexes hold file names, view indexes such as $SDH
+            and $SII of $Secure are not walked """
+        self.a_roots = self.parent.m_dirtmp if self.a_name == "$I30" else []
+        self.parent.m_dirtmp = []
+        """ index buffers being changed, without fixups, by VCN """
+        self.a_staged = {}
+        self.a_dirtybuffers = set()
+        self.a_buffers = self._buffer_map()
+        for entry in self.iter_index_entries():
+            self.parent.m_ir_entry.append(entry)
+        self.parent.set_directory()
         """ Index buffer done """
+
+    """ size bytes of attribute data from offset, less at the end of data """
+    def _read_buffer(self, offset, size):
+        if self.a_resident == True:
+            return self.a_content.read_data(-1, -1)[offset:offset+size]
+        return self.a_content.read_data(offset, min(size, self.a_total-offset))
+
+    """ every index buffer has a magic number, called VCN number. 
+        This has nothing to do with virtual clusters. Map the VCN of every 
+        index buffer to its offset in the attribute data, reading only the 
+        buffer headers. The first buffer wins if a VCN is repeated """
+    def _buffer_map(self):
+        indexsize = self.parent.parent.f_indexbuffersize
+        if self.a_resident == True:
+            self.a_total = len(self.a_content.read_data(-1, -1))
+        else:
+            self.a_total = self.a_content.a_actual_size_of_content
+        buffers = {}
+        for offset in xrange(0, self.a_total-0x17, indexsize):
+            vcn, = struct.unpack("<Q", self._read_buffer(offset+0x10, 8))
+            buffers.setdefault(vcn, offset)
+        return buffers
+
+    """ Walk the b-tree from the buffers the index root points to, depth
+        first with a stack, and yield a _DirIndexEntry for every entry. One
+        index buffer is read at a time, so a huge directory can be streamed
+        without holding its index allocation. A buffer is visited only once
+        even if a damaged index points to it again """
+    def iter_index_entries(self):
+        indexsize = self.parent.parent.f_indexbuffersize
+        stack = list(self.a_roots)
+        seen = set()
+        while len(stack) > 0:
+            vcn = stack.pop()
+            if vcn in seen:
+                continue
+            seen.add(vcn)
+            try:
+                vcnloc = self.a_buffers[vcn]
+            except KeyError:
+                emesg = "Index buffer %d not found in MFT entry %d" % (vcn, self.parent.m_mftnumber)
+                raise ForensicError(emesg)
+            baselocation = self.a_content.locate_data(vcnloc)
+            """ Fixup array """
+            mtmp = str(_remove_fixup(bytearray(self._read_buffer(vcnloc, indexsize))))
+
+            """ Find the exact length of index entries. Entries start at the
+                offset stored in the node header, which is not always 0x40 """
+            entrystart, = struct.unpack("<I", mtmp[0x18:0x1c])
+            entrystart += 0x18
+            self.a_ir_endsequence, self.a_ir_endbuffer = struct.unpack("<II", mtmp[0x1c:0x24])
+            """ process entries """
+
+            egen = _ParseIndexEntries(mtmp[entrystart:self.a_ir_endsequence+0x18])
+            for dirtmp in egen:
+                tmp = dirtmp[0]
+                entry = _DirIndexEntry(self,baselocation+dirtmp[1]+entrystart)
+                entry.init_entry(tmp, 0x30)
+                entry.buffervcn = vcn
+                if entry.flags & 1 != 0:
+                    stack.append(entry.vcn)
+                yield entry
+
+    """ Write data at offset of an entry in one of the index buffers. The
+    buffer is staged without fixups and written by write_buffers, at once or
+    when the update of the MFT record ends. A staged buffer is kept, the 
+    image may not have the last write of it yet """
+    def write_entry(self, entry, offset, data):
+        vcn = entry.buffervcn
+        vcnloc = self.a_buffers[vcn]
+        if vcn not in self.a_staged:
+            indexsize = self.parent.parent.f_indexbuffersize
+            self.a_staged[vcn] = _remove_fixup(bytearray(self._read_buffer(vcnloc, indexsize)))
+        o = entry.location-self.a_content.locate_data(vcnloc)+offset
+        self.a_staged[vcn][o:o+len(data)] = data
+        self.a_dirtybuffers.add(vcn)
+        if self.parent.m_batch == 0:
+            self.write_buffers()
+
+    """ Apply fixups with a new update sequence number to the changed index
+    buffers and write each one, in pieces of at most a cluster """
+    def write_buffers(self):
+        fs = self.parent.parent
+        step = min(fs.f_clustersize, fs.f_indexbuffersize)
+        for vcn in sorted(self.a_dirtybuffers):
+            staged = self.a_staged[vcn]
+            buf = _apply_fixup(bytearray(staged))
+            updateoffset = _fixup_blocks(buf)[0]
+            staged[updateoffset:updateoffset+2] = buf[updateoffset:updateoffset+2]
+            vcnloc = self.a_buffers[vcn]
+            for i in range(0, len(buf), step):
+                fs.write_location(self.a_content.locate_data(vcnloc+i), str(buf[i:i+step]))
+        self.a_dirtybuffers = set()
+
     def write_attribute(self):
         return        
        
@@ -627,7 +695,7 @@ class _NTFSAttributeIndexAllocation(_NTFSAttribute):
 class _NTFSAttributeBitmap(_NTFSAttribute):
     def __init__(self,parent):
         super(_NTFSAttributeBitmap, self).__init__(parent)
-        self.a_bitmap = ""
+        self.a_bitmap = bytearray()
 
     def init_attribute(self,attr,offset):
         self.a_location = offset
@@ -637,7 +705,7 @@ class _NTFSAttributeBitmap(_NTFSAttribute):
         else:
             self.a_content = _NonResidentAttribute(attr, self)
         
-        self.a_bitmap = self.a_content.read_data(-1, -1)
+        self.a_bitmap = bytearray(self.a_content.read_data(-1, -1))
 
     def get_bit(self,number):
         byte = int(number/8)
@@ -647,28 +715,24 @@ class _NTFSAttributeBitmap(_NTFSAttribute):
     def modify_bit(self,number, value, image_write=False):
         if value < 0 or value > 1:
             return False
-        byte = int(number/8)
-        bit = number - byte*8
-        
-        old_value = ord(self.a_bitmap[byte])
-        bloc = (2**bit)*value
-        new_value = struct.pack ("B",old_value | bloc)
-        
-        self.a_bitmap = self.a_bitmap[:byte]+new_value+self.a_bitmap[byte+1:]
-        if image_write:
-            self.parent.parent.write_location(self.a_location+byte, new_value)
-        
+        self.modify_range(number, 1, value, image_write)
+
+    def modify_range(self, first, count, value, image_write=False):
+        span = _set_bit_range(self.a_bitmap, first, count, value)
+        if image_write and span != None:
+            self.parent.write_location(self.a_location+span[0],
+                                              str(self.a_bitmap[span[0]:span[1]]))
 
     def write_attribute(self):
         return
         """ This write does not add anything. It modifies existing bytes only """
         buf =  self.pack_header()
         buf += self.a_content.pack_residency()
-        buf += self.a_bitmap
+        buf += str(self.a_bitmap)
         """ padded to 8 bytes """
         buf += '\x00'* (self.a_length - len(buf))
         
-        self.parent.parent.write_location(self.a_location,buf)
+        self.parent.write_location(self.a_location,buf)
     
     def attribute_print(self):
         self.A_print_header()
@@ -53,6 +53,8 @@ class _DirIndexEntry:
         self.parentdirseq = 0
         self.flags = 0
         self.location=location
+        """ VCN of the index buffer holding the entry, None in the index root """
+        self.buffervcn = None
         
     def init_entry(self, block, kind):
         self.filerecord = _Unpack48(block[0:6])
@@ -18,9 +18,11 @@ along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
 import struct
 from attributes import parse_attributes
 from attributes import _NTFSAttributeData, _NTFSAttributeStandard, _NTFSAttributeFileName
+from attributes import _NTFSAttributeIndexAllocation
 from attributes import NTFS_ATTRIBUTES
 from itertools import chain
 from ui.uitools import ForensicError
+from tools import _fixup_blocks, _fixup_valid, _remove_fixup, _apply_fixup
 import sys
 
 class _MftEntry:
@@ -50,14 +52,16 @@ class _MftEntry:
 
         """ Fixup array """
 
-        x = self.m_updateoffset + 2
-        y = self.m_fixup - 1
-        mtmp = mft
-        for z in range (0,y):
-            
-            f = mft[x] + mft[x+1]
-            x += 2
-            mtmp = mtmp[:z*512+510]+f+mtmp[(z+1)*512:]
+        buf = bytearray(mft)
+        self.m_fixupblocks = _fixup_blocks(buf)[1]
+        self.m_usn = struct.unpack_from("<H", buf, self.m_updateoffset)[0] if self.m_fixupblocks > 0 else 0
+        self.m_fixupvalid = _fixup_valid(buf)
+        """ the record without fixups, edits are staged here and the whole 
+        record is written back by write_record """
+        self.m_record = _remove_fixup(buf)
+        self.m_batch = 0
+        self.m_dirty = False
+        mtmp = str(self.m_record)
         if self.m_attroffset != 0:
             agen = parse_attributes(mtmp[self.m_attroffset:self.m_size+1])
             o = self.m_attroffset
@@ -77,6 +81,46 @@ class _MftEntry:
                     
         #print self.m_mftnumber, self.m_flags, self.get_file_name()   
             
+    """ Write data that belongs to this record at image location. Data inside
+    the record is staged on m_record and written with the rest of the record,
+    at once or when the outermost begin_update/end_update pair ends """
+    def write_location(self, location, data):
+        offset = location-self.m_location
+        if offset < 0 or offset+len(data) > len(self.m_record):
+            self.parent.write_location(location, data)
+            return
+        self.m_record[offset:offset+len(data)] = data
+        self.m_dirty = True
+        if self.m_batch == 0:
+            self.write_record()
+
+    def begin_update(self):
+        self.m_batch += 1
+
+    def end_update(self):
+        self.m_batch -= 1
+        if self.m_batch > 0:
+            return
+        if self.m_dirty:
+            self.write_record()
+        for f in self.m_attributes:
+            if isinstance(f, _NTFSAttributeIndexAllocation):
+                f.write_buffers()
+
+    """ Apply fixups with a new update sequence number to a copy of the
+    staged record and write it in one piece. A record that was torn when read
+    is not rewritten, new fixups would hide the damage """
+    def write_record(self):
+        if not self.m_fixupvalid:
+            raise ForensicError("MFT record %d has a bad fixup" % self.m_mftnumber)
+        buf = bytearray(self.m_record)
+        if self.m_fixupblocks > 0:
+            _apply_fixup(buf)
+            self.m_usn = struct.unpack_from("<H", buf, self.m_updateoffset)[0]
+            self.m_record[self.m_updateoffset:self.m_updateoffset+2] = buf[self.m_updateoffset:self.m_updateoffset+2]
+        self.parent.write_record(self.m_mftnumber, self.m_location, str(buf))
+        self.m_dirty = False
+
     def get_data_keys(self):
         for key in self.m_qdata.keys():
             print key
@@ -94,8 +138,12 @@ class _MftEntry:
     
     """ This is one of the key functions """
     def write_data(self):
-        for f in self.m_attributes:
-            f.write_attribute()
+        self.begin_update()
+        try:
+            for f in self.m_attributes:
+                f.write_attribute()
+        finally:
+            self.end_update()
     """ This is one of the key functions 
     Implement a MACE time change algorithm
     Expect a named list of form
@@ -105,7 +153,7 @@ class _MftEntry:
     if all and individual times present, individual attributes take precedence """
     
     
-    def change_std_time(self,btime):
+    def change_time(self, btime, std=True, fname=True):
         mtime=atime=ctime=etime=None
         try:
             mtime=atime=ctime=etime = btime["all"]
@@ -125,53 +173,44 @@ class _MftEntry:
             pass
         try:
             etime = btime["etime"]
-        except KeyError:
-            pass        
-        for f in self.m_attributes:
-            if isinstance(f, _NTFSAttributeStandard):
-                if mtime:
-                    f.a_time.change_mtime(mtime)
-                if atime:
-                    f.a_time.change_atime(atime)
-                if ctime:
-                    f.a_time.change_ctime(ctime)
-                if etime:
-                    f.a_time.change_etime(etime)
-                f.write_attribute()
-            
-    def change_fname_time(self,btime):
-        mtime=atime=ctime=etime=None
-        try:
-            mtime=atime=ctime=etime = btime["all"]
-        except KeyError:
-            pass
-        try:
-            mtime = btime["mtime"]
-        except KeyError:
-            pass
-        try:
-            atime = btime["atime"]
         except KeyError:
             pass
+        self.begin_update()
         try:
-            ctime = btime["ctime"]
-        except KeyError:
-            pass
-        try:
-            etime = btime["etime"]
-        except KeyError:
-            pass        
+            for f in self.m_attributes:
+                if (std and isinstance(f, _NTFSAttributeStandard)) or \
+                   (fname and isinstance(f, _NTFSAttributeFileName)):
+                    if mtime:
+                        f.a_time.change_mtime(mtime)
+                    if atime:
+                        f.a_time.change_atime(atime)
+                    if ctime:
+                        f.a_time.change_ctime(ctime)
+                    if etime:
+                        f.a_time.change_etime(etime)
+                    f.write_attribute()
+        finally:
+            self.end_update()
+
+    def change_std_time(self,btime):
+        self.change_time(btime, True, False)
+
+    def change_fname_time(self,btime):
+        self.change_time(btime, False, True)
+
+    """ [name, parent directory, raw times] of every $FILE_NAME attribute """
+    def fname_times(self):
+        result = []
         for f in self.m_attributes:
             if isinstance(f, _NTFSAttributeFileName):
-                if mtime:
-                    f.a_time.change_mtime(mtime)
-                if atime:
-                    f.a_time.change_atime(atime)
-                if ctime:
-                    f.a_time.change_ctime(ctime)
-                if etime:
-                    f.a_time.change_etime(etime)
-                f.write_attribute()
+                result.append([f.a_ascname, f.a_parentdir, f.a_time.raw_time()])
+        return result
+
+    """ Entries of this directory's $I30 index that name record number """
+    def index_entries(self, number, name):
+        return [e for e in self.m_ir_entry 
+                if e.filerecord == number and e.filename == name and not e.flags & 2]
+
     def query_std_time(self):
         for f in self.m_attributes:
             if isinstance(f,_NTFSAttributeStandard):
@@ -191,6 +230,9 @@ class _MftEntry:
         result = attr.read_data(offset, dlength)
         return result
     
+    def iter_mft_data(self, name, offset, dlength, chunk):
+        return self.m_qdata[name].iter_data(offset, dlength, chunk)
+
     def locate_data(self,name,offset):
         attr = self.m_qdata[name]
         return attr.locate_data(offset)
@@ -0,0 +1,124 @@
+'''
+Copyright 2014 Hannu Visti
+
+This file is part of ForGe forensic test image generator.
+ForGe is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import struct
+from array import array
+from collections import OrderedDict
+from mftentry import _MftEntry
+
+""" bytes of $MFT read at a time while scanning record headers """
+SCAN_CHUNK = 1024*1024
+
+_HEADER = struct.Struct("<4s18xH8xQ")
+
+""" The MFT records of an NTFSC, indexed by record number like the list it
+replaces. Record flags are kept for every record. _MftEntry objects are
+built when a record is first used and at most limit of them are kept, the
+least recently used is dropped first. Record 0 is always kept, every other
+record is read through its runlist. limit None keeps everything, and load()
+then parses the whole MFT up front like the parser always did.
+
+Changes to a parsed record that only live in memory are lost when it is
+dropped. Parent directories found in directory indexes are kept here and
+given to the record again when it is rebuilt """
+
+class _MftTable(object):
+    def __init__(self, fs, mft, limit=None):
+        self.t_fs = fs
+        self.t_limit = limit
+        self.t_mft = mft
+        self.t_cache = OrderedDict()
+        self.t_flags = array("H", [mft.m_flags])
+        self.t_extension = array("B", [0])
+        self.t_parents = {}
+
+    """ Read the record headers, or every record if there is no limit """
+    def load(self):
+        size = self.t_fs.f_mftsize
+        total = self.t_mft.m_qdata[None].a_actual_size_of_content
+        offset = size
+        chunk = SCAN_CHUNK - SCAN_CHUNK%size
+        for data in self.t_mft.iter_mft_data(None, offset, total-offset, chunk):
+            for i in range(0, len(data)-size+1, size):
+                if self.t_limit == None:
+                    location = self.t_mft.locate_data(None, offset+i)
+                    self.append(_MftEntry(data[i:i+size], self.t_fs, location))
+                else:
+                    magic, flags, base = _HEADER.unpack_from(data, i)
+                    self.t_flags.append(flags)
+                    self.t_extension.append(1 if base & 0xffffffffffff else 0)
+            offset += len(data)
+
+    def __len__(self):
+        return len(self.t_flags)
+
+    def __getitem__(self, number):
+        if number < 0:
+            number += len(self.t_flags)
+        if number == 0:
+            return self.t_mft
+        if number >= len(self.t_flags):
+            raise IndexError("MFT record out of range")
+        try:
+            record = self.t_cache.pop(number)
+        except KeyError:
+            record = self._build(number)
+        self.t_cache[number] = record
+        self._evict()
+        return record
+
+    def __setitem__(self, number, record):
+        if number == 0:
+            self.t_mft = record
+        else:
+            self.t_cache.pop(number, None)
+            self.t_cache[number] = record
+        self.t_flags[number] = record.m_flags
+        self.t_extension[number] = 1 if record.m_filereference & 0xffffffffffff else 0
+        if number in self.t_parents:
+            record.set_parent_dir(self.t_parents[number])
+        self._evict()
+
+    def __iter__(self):
+        for number in xrange(0, len(self.t_flags)):
+            yield self[number]
+
+    """ number of a new record, record None reads it when first used """
+    def append(self, record):
+        self.t_flags.append(0)
+        self.t_extension.append(0)
+        if record != None:
+            self[len(self.t_flags)-1] = record
+
+    def flags(self, number):
+        return self.t_flags[number]
+
+    def is_extension(self, number):
+        return self.t_extension[number] == 1
+
+    def set_parent_dir(self, number, parent):
+        self.t_parents[number] = parent
+        if number in self.t_cache:
+            self.t_cache[number].set_parent_dir(parent)
+
+    def _build(self, number):
+        record = self.t_fs._read_record(number)
+        if number in self.t_parents:
+            record.set_parent_dir(self.t_parents[number])
+        return record
+
+    def _evict(self):
+        if self.t_limit == None:
+            return
+        while len(self.t_cache) > self.t_limit:
+            self.t_cache.popitem(last=False)
@@ -17,18 +17,27 @@ along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
 
 import struct
 from mftentry import _MftEntry 
-from tools import _hexdump
-from subprocess import call
+from mfttable import _MftTable
+from tools import _hexdump, _set_bit_range, _remove_fixup, _apply_fixup
 from attributes import _NTFSAttributeBitmap
 import sys
 from ui.uitools import ForensicError
 from ui.uitools import Chelper
 from random import randint
+from imagefile.template import TemplateCache
+from imagefile.writeback import ImageWriter
+from imagefile.view import ImageView
+from imagefile.extents import FreeExtentIndex, runs_from_bitmap
+from imagefile import stats
+from ntfswriter import NTFSWriter
 
 FLAG_SYSTEM = 0x1
 FLAG_DIRECTORY = 0x2
 FLAG_REGULAR = 0x4
 
+""" lowest cluster handed out for hiding """
+FREE_SEARCH_START = 32
+
 def NTFSCreateImage(name, size, garbage, clustersize=4):
     c = Chelper()
     if len(name) <= 8:
@@ -40,11 +49,90 @@ def NTFSCreateImage(name, size, garbage, clustersize=4):
         fill = "random"
     else:
         fill = "clean"
+
+    if c.templates:
+        return TemplateCache().create_image(["ntfs", size, clustersize, fill], name,
+                    lambda tname: c.call(["create", "ntfs", str(size), str(clustersize), 
+                                          "forge", fill, tname]),
+                    lambda path: NTFSRestampImage(path, imagename))
          
-    result = call([c.binary, "create", "ntfs", str(size), str(clustersize), imagename, 
-                   fill, name], shell=False)
+    result = c.call(["create", "ntfs", str(size), str(clustersize), imagename, 
+                     fill, name])
     return result
 
+""" Give a copy of a template image its own identity: a new volume serial in 
+both boot sectors and the volume label in $Volume and its $MftMirr copy """
+def NTFSRestampImage(fname, label):
+    try:
+        fh = open(fname, "r+b")
+    except IOError:
+        raise ForensicError("Cannot open image for restamp")
+    try:
+        vbr = fh.read(512)
+        if vbr[3:7] != "NTFS":
+            raise ForensicError("Template is not a NTFS image")
+        sectorsize = struct.unpack("<H", vbr[11:13])[0]
+        clustersize = struct.unpack("B", vbr[13])[0]*sectorsize
+        sectors = struct.unpack("<Q", vbr[40:48])[0]
+        mft1 = struct.unpack("<Q", vbr[48:56])[0]
+        mft2 = struct.unpack("<Q", vbr[56:64])[0]
+        tmp = struct.unpack("B", vbr[64])[0]
+        if tmp > 128:
+            mftsize = 2 ** abs(tmp-256)
+        else:
+            mftsize = tmp*clustersize
+
+        serial = struct.pack("<Q", randint(0, 2**64-1))
+        """ Backup boot sector is the last sector of the volume """
+        for loc in [0, sectors*sectorsize]:
+            fh.seek(loc)
+            if fh.read(512)[3:7] == "NTFS":
+                fh.seek(loc+0x48)
+                fh.write(serial)
+
+        """ $Volume is MFT entry 3, mirrored in $MftMirr """
+        fh.seek(mft1*clustersize+3*mftsize)
+        record = _ntfs_set_volume_name(fh.read(mftsize), label)
+        for loc in [mft1*clustersize+3*mftsize, mft2*clustersize+3*mftsize]:
+            fh.seek(loc)
+            fh.write(record)
+    finally:
+        fh.close()
+
+def _ntfs_set_volume_name(record, label):
+    if record[0:4] != "FILE":
+        raise ForensicError("$Volume entry not found")
+    buf = _remove_fixup(bytearray(record))
+
+    attroffset, = struct.unpack_from("<H", buf, 20)
+    used, allocated = struct.unpack_from("<II", buf, 24)
+    used = min(used, len(buf))
+    o = attroffset
+    atype = None
+    while o+8 <= used:
+        atype, alen = struct.unpack_from("<II", buf, o)
+        if atype == 0xffffffff or alen == 0:
+            break
+        if atype == 0x60:
+            break
+        o += alen
+    if atype != 0x60:
+        raise ForensicError("$VOLUME_NAME attribute not found")
+    valueoffset, = struct.unpack_from("<H", buf, o+20)
+    value = bytearray(label.encode("utf-16-le"))
+    nlen = (valueoffset+len(value)+7) & ~7
+    attr = buf[o:o+valueoffset]+value
+    attr += "\0"*(nlen-len(attr))
+    struct.pack_into("<I", attr, 4, nlen)
+    struct.pack_into("<I", attr, 16, len(value))
+    body = buf[:o]+attr+buf[o+alen:used]
+    if len(body) > allocated-8:
+        raise ForensicError("Volume label does not fit in $Volume")
+    struct.pack_into("<I", body, 24, len(body))
+    buf[:len(body)] = body
+    buf[len(body):] = "\0"*(len(buf)-len(body))
+    return str(_apply_fixup(buf))
+
 
 
 class FileHandler(object):
@@ -64,12 +152,16 @@ class FileHandler(object):
     def GetHandle():
         return FileHandler.gl_fh
 
+""" entry is the object the file name refers to. With resolve given, entry
+is None and resolve(sid) returns it on demand, so that a file list does not
+hold every MFT record in memory """
 class FileEntry(object):
-    def __init__(self, sid, name, flags, entry):
+    def __init__(self, sid, name, flags, entry, resolve=None):
         self.filenumber = sid
         self.filename = name
         self.flags = flags
         self.link = entry
+        self.resolve = resolve
     def displayRecord(self):
         print self.filenumber, self.filename, self.flags, self.link
     def get_flags(self):
@@ -77,36 +169,93 @@ class FileEntry(object):
     def get_file_name(self):
         return self.filename
     def get_link(self):
+        if self.link == None and self.resolve != None:
+            return self.resolve(self.filenumber)
         return self.link
     
 class FileSystemC(object):
-    def __init__(self, fname, mountpoint="/mnt/image"):
+    def __init__(self, fname, mountpoint="/mnt/image", slot=None):
         self.fs_sectorsize=0
         self.fs_size=0
         self.fs_fstype=""
         self.fs_mountpoint = mountpoint
-        self.fs_fh = open(fname, "r")
+        """ worker slot selects the mount point and loop device chelper uses """
+        self.fs_slot = slot
+        """ False until fs_init has run and again after a mount, when the kernel
+        may have written anything """
+        self.fs_parsed = False
+        """ True between begin_mount_session and end_mount_session """
+        self.fs_session = False
+        """ small writes are buffered, see fs_flush """
+        self.fs_writer = ImageWriter(fname)
+        self.fs_view = ImageView(fname)
         self.fs_filename = fname
-        FileHandler.SetFileName(fname,self.fs_fh)
+        FileHandler.SetFileName(fname,self.fs_view)
         if len(self.fs_filename.rsplit('/',1)) == 1:
             self.fs_shortname = self.fs_filename
         else:
             self.fs_shortname = self.fs_filename.rsplit('/',1)[1]
+
+    def _slot_args(self):
+        if self.fs_slot is None:
+            return []
+        return [str(self.fs_slot)]
+
+    """ File systems that can be written without a mount return a writer """
+    def get_direct_writer(self):
+        return None
+
+    """ Bring the parsed model up to date. Only the structures marked dirty
+    since the last parse are read again, unless a mount session has written 
+    to the image """
+    def fs_refresh(self):
+        self.fs_flush()
+        if not self.fs_parsed:
+            self.fs_init()
+        else:
+            self._apply_deltas()
+
+    def fs_mark_external(self):
+        self.fs_parsed = False
+
+    """ Write buffered write_location data to the image. Needed before the 
+    image is read without the parser, written through another handle or
+    mounted """
+    def fs_flush(self):
+        self.fs_writer.flush()
+
+    """ Mount the image once for several hiding methods. Inside a session
+    mount_image and dismount_image leave the mount as it is """
+    def begin_mount_session(self):
+        if self.mount_image() != 0:
+            raise ForensicError("Cannot mount image")
+        self.fs_session = True
+
+    def end_mount_session(self):
+        self.fs_session = False
+        return self.dismount_image()
+
+    """ Flush and release the image, the last step of fs_finalise """
+    def fs_commit(self):
+        self.fs_writer.close()
         
         
 class NTFSC(FileSystemC):
     f_mft1 = 0
     f_mft2 = 0
+    f_mirrorcount = 0
+    f_timeline = None
     f_mftsize = 0       # 1024 in practice
     f_clustersize = 0
     f_indexbuffersize = 0
     f_mft = []
 
     
-    def __init__(self,fname, mountpoint):
+    def __init__(self,fname, mountpoint, slot=None):
         self.f_mft = []
         self.f_mftkey = {}
-        super(NTFSC, self).__init__(fname, mountpoint)
+        self.f_dirtyrecords = set()
+        super(NTFSC, self).__init__(fname, mountpoint, slot)
         self.fs_fstype = "ntfs"
         self.f_mounted = False
         self.helper = Chelper()
@@ -148,25 +297,23 @@ class NTFSC(FileSystemC):
             if i.m_flags & 2:
                 i.mft_display()
                 print "EOR"
-    """ Build parent directories and a file list containing full path """
+    """ Build parent directories and a file list containing full path. Only
+    directories are parsed, slack and the children index are built when
+    first asked for """
     
     def _dir_structure(self):
         
-        self.f_slack = []
-        for m in self.f_mft:
-            s = m.get_slack()
-            if s and m.m_mftnumber > 16: 
-                """ flatten slack structure in case of multiple data streams """
-                for tmp_slack in s:
-                    self.f_slack.append(tmp_slack)
-                       
-            if m.m_flags & 3 == 3:
-
+        self.f_slack = None
+        self.f_children = None
+        for n in xrange(0, len(self.f_mft)):
+            if self.f_mft.flags(n) & 3 == 3:
+                m = self.f_mft[n]
                 for d in m.m_dirTree:
                     if d.flags & 2:
                         continue                    
-                    self.f_mft[d.filerecord].set_parent_dir(d.parentdir)
+                    self.f_mft.set_parent_dir(d.filerecord, d.parentdir)
 
+        self.f_pathindex = {}
         recursive = [(5,"")]
         while True:
             try:
@@ -183,53 +330,124 @@ class NTFSC(FileSystemC):
                         flags |= FLAG_SYSTEM
                     else:
                         flags |= FLAG_REGULAR
-                    if self.f_mft[d.filerecord].m_flags & 3 == 3:
+                    if self.f_mft.flags(d.filerecord) & 3 == 3:
                         flags |= FLAG_DIRECTORY
                     
                         
-                    self.fs_filelist[d.filerecord] = FileEntry(d.filerecord,path+"/"+d.filename, flags, self.f_mft[d.filerecord])
+                    self.fs_filelist[d.filerecord] = FileEntry(d.filerecord,path+"/"+d.filename, flags, None,
+                                                               self.f_mft.__getitem__)
+                    self.f_pathindex[path+"/"+d.filename] = d.filerecord
 
                     if flags & FLAG_DIRECTORY and d.filerecord != 5 and not flags & FLAG_SYSTEM:
                         recursive.append([d.filerecord,path+"/"+d.filename])
 
             except IndexError:
                 break
-        
 
+    def _collect_slack(self):
+        self.f_slack = []
+        for m in self.f_mft:
+            s = m.get_slack()
+            if s and m.m_mftnumber > 16: 
+                """ flatten slack structure in case of multiple data streams """
+                for tmp_slack in s:
+                    self.f_slack.append(tmp_slack)
+
+    """ parent record -> records, deleted ones included """
+    def _children(self, mftnumber):
+        if self.f_children == None:
+            self.f_children = {}
+            for n in xrange(0, len(self.f_mft)):
+                """ extension records carry no name of their own """
+                if self.f_mft.is_extension(n):
+                    continue
+                m = self.f_mft[n]
+                if m.m_mftnumber != 5:
+                    self.f_children.setdefault(m.m_parentdir, []).append(n)
+        return self.f_children.get(mftnumber, [])
          
     def get_file_slack(self):
+        if self.f_slack == None:
+            self._collect_slack()
         return self.f_slack if len (self.f_slack) > 0 else None
+
+    """ Writer that populates the image file without mounting it. Call after fs_init """
+    def get_direct_writer(self):
+        if not self.helper.direct_write:
+            return None
+        self.fs_flush()
+        return NTFSWriter(self)
             
     def register_used_file_slack(self,location,used):
+        if self.f_slack == None:
+            self._collect_slack()
         for s in self.f_slack:
             if s[0] == location:
                 s[2] = used
                 
         
     def fs_init(self):
-        self.fs_fh.seek(0)
         self.fs_filelist = {}
-        buf = self.fs_fh.read(512)
+        buf = self.fs_view.read(0, 512)
         self.ntfs_vbr_init(buf)
-        self.fs_fh.seek(self.f_clustersize*self.f_mft1)
-        buf = self.fs_fh.read(self.f_mftsize)
+        buf = self.fs_view.read(self.f_clustersize*self.f_mft1, self.f_mftsize)
         mft = _MftEntry(buf,self,self.f_clustersize*self.f_mft1)
-        """ check this """
-        self.f_mft = []
         self.f_mftkey = {} 
-
-        self.f_mft.append(mft)
-
-        pup = mft.mft_data(None, 1024, -1)
-
-        for i in range(0,len(pup),self.f_mftsize):
-            loc = mft.locate_data(None,i+1024)
-            mft_record = _MftEntry(pup[i:i+1024],self,loc)
-            self.f_mft.append(mft_record) 
+        self.f_mft = _MftTable(self, mft, self.helper.mft_cache if self.helper.lazy_mft else None)
+        self.f_mft.load()
         #self.f_directory = DirectoryTree(self.f_mft)
         self._dir_structure()
-
-        self.f_bitmap = bit_data = self.f_mft[6].return_unnamed_data().read_data(-1,-1)
+        """ $MftMirr holds copies of the first records """
+        mirror = self.f_mft[1].return_unnamed_data()
+        self.f_mirrorcount = len(mirror.read_data(-1, -1))/self.f_mftsize
+
+        bit_data = self.f_mft[6].return_unnamed_data().read_data(-1,-1)
+        self.f_bitmap = bytearray(bit_data)
+        self.f_free = FreeExtentIndex(runs_from_bitmap(bit_data), FREE_SEARCH_START,
+                                      self._cluster_count())
+        self.f_dirtyrecords = set()
+        self.fs_parsed = True
+
+    """ MFT records written behind the parser's back, e.g. by NTFSWriter. 
+    $Bitmap is not tracked, writers keep f_bitmap current themselves """
+    def fs_mark_records(self, numbers):
+        self.f_dirtyrecords.update(numbers)
+
+    def _read_record(self, number):
+        if number == 0:
+            location = self.f_clustersize*self.f_mft1
+            buf = self.fs_writer.overlay(location, self.fs_view.read(location, self.f_mftsize))
+            return _MftEntry(buf, self, location)
+        mft = self.f_mft[0]
+        offset = number*self.f_mftsize
+        """ Index buffers of a directory are read from the image as well. A 
+        plain record only needs the writes still buffered laid over it """
+        if self.f_mft.flags(number) & 2:
+            self.fs_flush()
+        buf = mft.mft_data(None, offset, self.f_mftsize)
+        step = min(self.f_clustersize, self.f_mftsize)
+        buf = "".join([self.fs_writer.overlay(mft.locate_data(None, offset+i), buf[i:i+step])
+                       for i in range(0, self.f_mftsize, step)])
+        return _MftEntry(buf, self, mft.locate_data(None, offset))
+
+    def _apply_deltas(self):
+        if len(self.f_dirtyrecords) == 0:
+            return
+        dirty = self.f_dirtyrecords
+        self.f_dirtyrecords = set()
+        """ record 0 first, the others are read through its runlist """
+        if 0 in dirty:
+            self.f_mft[0] = self._read_record(0)
+        """ records added to a grown $MFT """
+        mftsize = self.f_mft[0].m_qdata[None].a_actual_size_of_content
+        for number in range(len(self.f_mft), mftsize/self.f_mftsize):
+            self.f_mft.append(None)
+            dirty.add(number)
+        for number in dirty:
+            if number != 0:
+                self.f_mft[number] = self._read_record(number)
+        self.fs_filelist = {}
+        self._dir_structure()
 
 
     def get_list_of_files(self,flags):
@@ -241,31 +459,34 @@ class NTFSC(FileSystemC):
         return result
             
     def mount_image(self):
-        result = call([self.helper.binary, "attach", "ntfs", self.fs_shortname], 
-                      shell=False)
+        if self.fs_session:
+            return 0
+        self.fs_flush()
+        result = self.helper.call(["attach", "ntfs", self.fs_shortname]+self._slot_args())
         if result == 0:
             self.f_mounted = True
+            self.fs_mark_external()
+            stats.count("mounts")
         return result
     def dismount_image(self):
         #if not self.f_mounted:
         #    return 0
-        result = call([self.helper.binary, "detach"], shell=False)
+        if self.fs_session:
+            return 0
+        result = self.helper.call(["detach"]+self._slot_args())
         if result == 0:
             self.f_mounted = False
+            stats.count("umounts")
         return result
     def _return_dir_items_by_mft(self,mftnumber):
-        result = []
-        for f in self.f_mft:
-            #print >>sys.stderr, "uuu", f.get_file_name(), f.m_parentdir
-            if f.m_parentdir == mftnumber and f.m_mftnumber != 5:
-                result.append(f)
-        return result
+        return [self.f_mft[n] for n in self._children(mftnumber)]
     
     def find_file_by_path(self,name):
         """ Non-deleted file """
-        for fkey in self.fs_filelist.keys():
-            if self.fs_filelist[fkey].get_file_name() == name:
-                return self.fs_filelist[fkey].get_link()
+        try:
+            return self.f_mft[self.f_pathindex[name]]
+        except KeyError:
+            pass
         """ Deleted file """
         """ Try to find the corresponding MFT record. 
         pathlist returns "", first, second, etc
@@ -304,20 +525,83 @@ class NTFSC(FileSystemC):
         
     def change_time(self,fname,btime):
         try:
-            m = self.find_file_by_path(fname)
-            m.change_std_time(btime)
-            m.change_fname_time(btime)
+            number = self.timeline_target(fname)[1]
         except ForensicError:
             print >>sys.stderr, fname
             raise
+        self.timeline_begin()
+        try:
+            self.change_times(number, [btime])
+        finally:
+            self.timeline_end()
+
+    """ TimelineEngine interface. Changes are grouped by MFT record. Between
+    timeline_begin and timeline_end every record that is changed, and every
+    directory whose index names a changed record, is held with an update 
+    open. Each of them, and each index buffer, is written once by 
+    timeline_end """
+    def timeline_begin(self):
+        self.f_timeline = {}
+
+    def timeline_end(self):
+        records = self.f_timeline
+        self.f_timeline = None
+        for number in sorted(records.keys()):
+            records[number].end_update()
+            """ the record may have been dropped from the table meanwhile """
+            self.f_mft[number] = records[number]
+
+    def timeline_target(self, path):
+        try:
+            number = self.f_pathindex[path]
+        except KeyError:
+            number = self.find_file_by_path(path).m_mftnumber
+        return [number, number]
+
+    def change_times(self, number, btimes):
+        m = self._open_record(number)
+        for btime in btimes:
+            m.change_time(btime)
+        self._stage_index_times(number, m)
+
+    def _open_record(self, number):
+        try:
+            return self.f_timeline[number]
+        except KeyError:
+            m = self.f_mft[number]
+            m.begin_update()
+            self.f_timeline[number] = m
+            return m
+
+    """ Directory index entries keep a copy of the $FILE_NAME times. Copy the
+    times of record m to its entries in the parent directories """
+    def _stage_index_times(self, number, m):
+        for name, parent, raw in m.fname_times():
+            if parent >= len(self.f_mft):
+                continue
+            for entry in self._open_record(parent).index_entries(number, name):
+                entry.parent.write_entry(entry, 0x18, raw)
+
     def implement_action(self,act):
         fname = act[0]
         action = act[1]
         try:
-            m = self.find_file_by_path(fname)
-            stdtime = m.query_std_time()
+            number = self.timeline_target(fname)[1]
         except ForensicError:
             raise
+        self.timeline_begin()
+        try:
+            m = self._open_record(number)
+            stdtime = m.query_std_time()
+            result = self._implement_action(m, stdtime, action)
+            self._stage_index_times(number, m)
+        finally:
+            self.timeline_end()
+        return result
+
+    """ Every change an action makes is staged on the record, which is
+    written once by timeline_end """
+    def _implement_action(self, m, stdtime, action):
         result=""
         try:
             actiontime = action["Read"]
@@ -377,70 +661,89 @@ class NTFSC(FileSystemC):
                 mftEntry.getDirectoryStructure()
     
     def write_location(self,position,data):
+        self.fs_writer.write(position, data)
+
+    """ Write MFT record number, fixups applied, through the $MFT runlist in
+    pieces of at most a cluster, and to $MftMirr if it is mirrored there. A 
+    record whose number does not match its location is written at location """
+    def write_record(self, number, location, data):
+        mft = self.f_mft[0]
+        offset = number*self.f_mftsize
+        step = min(self.f_clustersize, self.f_mftsize)
         try:
-            fh = open(self.fs_filename, "r+b")
-            fh.seek(position)
-            fh.write(data)
-            fh.close()
-        except IOError:
-            raise ForensicError("Cannot write to image")
+            pieces = [[mft.locate_data(None, offset+i), data[i:i+step]] 
+                      for i in range(0, len(data), step)]
+        except IndexError:
+            pieces = []
+        if len(pieces) == 0 or pieces[0][0] != location:
+            self.write_location(location, data)
+            return
+        for position, piece in pieces:
+            self.write_location(position, piece)
+        if number < self.f_mirrorcount:
+            self.write_location(self.f_clustersize*self.f_mft2+offset, data)
 
 
     def get_cluster_status(self,number):
-        byte = int(number/8)
-        bit = number - byte*8
-        b_tmp, = struct.unpack("B",self.f_bitmap[byte])
-        return (b_tmp >> bit) & 1
+        return (self.f_bitmap[number/8] >> (number%8)) & 1
     
     def set_cluster_status(self,number, value, image_write=False):
         if value < 0 or value > 1:
             return False
-        byte = int(number/8)
-        bit = number - byte*8
-        
-        old_value = ord(self.f_bitmap[byte])
-        bloc = (2**bit)*value
-        new_value = struct.pack ("B",old_value | bloc)
-        
-        self.f_bitmap = self.f_bitmap[:byte]+new_value+self.f_bitmap[byte+1:]
+        self.set_cluster_range(number, 1, value, image_write)
+
+    """ Mark count clusters from first used (value 1) or free (value 0). With
+    image_write the changed bytes of $Bitmap go to the image in one write per
+    fragment of $Bitmap """
+    def set_cluster_range(self, first, count, value, image_write=False):
+        span = _set_bit_range(self.f_bitmap, first, count, value)
+        if span == None:
+            return
+        if value:
+            self.f_free.reserve(first, count)
+        else:
+            self.f_free.release(first, count)
         if image_write:
-            wloc = self.f_mft[6].locate_data(None,byte)
-            self.write_location(wloc, new_value)
+            self._write_bitmap(span[0], span[1])
+
+    def _write_bitmap(self, start, end):
+        pieces = []
+        pos = start
+        while pos < end:
+            stop = min(end, (pos/self.f_clustersize+1)*self.f_clustersize)
+            wloc = self.f_mft[6].locate_data(None,pos)
+            if len(pieces) > 0 and pieces[-1][0]+pieces[-1][2]-pieces[-1][1] == wloc:
+                pieces[-1][2] = stop
+            else:
+                pieces.append([wloc, pos, stop])
+            pos = stop
+        for wloc, a, b in pieces:
+            self.write_location(wloc, str(self.f_bitmap[a:b]))
+
+    def _cluster_count(self):
+        return self.f_size / (self.f_clustersize / self.f_sectorsize) -1
 
-    
     def get_surface_status(self,candidate,datasize):
-        numofclusters = self.f_size / (self.f_clustersize / self.f_sectorsize)-1
+        numofclusters = self._cluster_count()
         required = int(datasize / self.f_clustersize) +1
         if candidate < 0 or candidate > numofclusters-required-1:
             print candidate,datasize,numofclusters,required
             raise ForensicError("get_cluster_status: this should not happen")
+        return self.f_free.is_free_range(candidate, required)
 
-        all_free = True
-        for i in range(candidate,candidate+required):
-            if self.get_cluster_status(i) == 1:
-                all_free = False
-        return all_free
-
+    """ Picks a random place among the free runs that fit and reserves it, so
+    that the next call does not return the same clusters """
     def locate_unallocated_space(self,datasize):
-        i=0
-        numofclusters = self.f_size / (self.f_clustersize / self.f_sectorsize) -1
         required = int(datasize / self.f_clustersize) +1
-        while True:
-            y = randint(32,numofclusters-required)
-            if self.get_surface_status(y,datasize) == True:
-                return y*self.f_clustersize
-            i += 1
-            if i > 20:
-                break
-        """ do a sequential search """
-
-        for y in xrange(32,numofclusters-required):
-            if self.get_surface_status(y,datasize) == True:
-                return y*self.f_clustersize
-        return -1
+        y = self.f_free.find(required)
+        if y == -1:
+            return -1
+        self.f_free.reserve(y, required)
+        return y*self.f_clustersize
 
     def fs_finalise(self):
-        pass
+        """ mft_data reads the image file """
+        self.fs_flush()
         try:
             rmft = self.f_mft[0].mft_data(None,1024*5,1024)
             wloc = self.f_clustersize * self.f_mft2 + 1024*5
@@ -449,4 +752,5 @@ class NTFSC(FileSystemC):
                 self.write_location(wloc, rmft)
         except ForensicError:
             raise ForensicError("Unable to fix $MftMirr")
+        self.fs_commit()
             
@@ -0,0 +1,803 @@
+'''
+Copyright 2014 Hannu Visti
+
+This file is part of ForGe forensic test image generator.
+ForGe is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import struct
+import time
+import os
+from StringIO import StringIO
+from tools import _remove_fixup, _apply_fixup, _set_bit_range
+from directory import _ParseIndexEntries
+from ui.uitools import ForensicError
+from imagefile.stats import CountingFile
+
+""" Writes files, directories and alternate data streams straight into an
+NTFS image file, without ntfs-3g or a mount. Works on an initialised NTFSC.
+
+New MFT records get $STANDARD_INFORMATION, a POSIX namespace $FILE_NAME and
+$DATA, resident or non-resident. Clusters are taken from $Bitmap and records
+from the $MFT bitmap, $MFT is extended when it runs out of records. Directory
+indexes of every changed directory are rebuilt once in close() as a sorted
+$I30 B-tree. Nothing is written to $LogFile, the volume looks like one that
+was cleanly unmounted. """
+
+AT_STANDARD_INFORMATION = 0x10
+AT_FILE_NAME = 0x30
+AT_DATA = 0x80
+AT_INDEX_ROOT = 0x90
+AT_INDEX_ALLOCATION = 0xa0
+AT_BITMAP = 0xb0
+AT_END = 0xffffffff
+
+MFT_RECORD_IN_USE = 0x1
+MFT_RECORD_IS_DIRECTORY = 0x2
+
+FILE_ATTR_ARCHIVE = 0x20
+FILE_ATTR_DIRECTORY = 0x10000000
+
+INDEX_ENTRY_NODE = 0x1
+INDEX_ENTRY_END = 0x2
+
+""" ntfs-3g leaves the records below 64 to the system """
+FIRST_USER_RECORD = 64
+MFT_EXTEND_RECORDS = 64
+RESIDENT_LIMIT = 600
+COPY_BLOCK = 1024*1024
+I30 = u"$I30"
+
+def _align8(n):
+    return (n+7) & ~7
+
+def _ntfs_now():
+    return int((time.time()+11644473600)*10000000)
+
+def _sort_key(name):
+    """ COLLATION_FILE_NAME: upper case comparison, exact case breaks ties """
+    up = []
+    for c in name:
+        u = c.upper()
+        up.append(ord(u) if len(u) == 1 else ord(c))
+    return (up, [ord(c) for c in name])
+
+def _to_unicode(name):
+    if isinstance(name, str):
+        return name.decode("utf-8")
+    return name
+
+def _decode_runs(buf):
+    """ mapping pairs to [[length, lcn],...]. Sparse runs have lcn None """
+    runs = []
+    ptr = 0
+    lcn = 0
+    while ptr < len(buf) and ord(buf[ptr]) != 0:
+        header = ord(buf[ptr])
+        lsize = header & 0xf
+        osize = header >> 4
+        ptr += 1
+        length = 0
+        for i in range(lsize-1, -1, -1):
+            length = (length << 8) | ord(buf[ptr+i])
+        ptr += lsize
+        if osize == 0:
+            runs.append([length, None])
+            continue
+        delta = 0
+        for i in range(osize-1, -1, -1):
+            delta = (delta << 8) | ord(buf[ptr+i])
+        if delta >= 1 << (osize*8-1):
+            delta -= 1 << (osize*8)
+        ptr += osize
+        lcn += delta
+        runs.append([length, lcn])
+    return runs
+
+def _encode_signed(value):
+    out = ""
+    while True:
+        out += chr(value & 0xff)
+        value >>= 8
+        if (value == 0 and not ord(out[-1]) & 0x80) or (value == -1 and ord(out[-1]) & 0x80):
+            return out
+
+def _encode_runs(runs):
+    buf = ""
+    previous = 0
+    for length, lcn in runs:
+        l = _encode_signed(length)
+        if lcn == None:
+            buf += chr(len(l))+l
+            continue
+        o = _encode_signed(lcn-previous)
+        buf += chr(len(l) | (len(o) << 4))+l+o
+        previous = lcn
+    return buf+"\0"
+
+def _index_root(blocksize, blockclusters, entries, large):
+    value = struct.pack("<IIIB3x", AT_FILE_NAME, 1, blocksize, blockclusters)
+    value += struct.pack("<IIIB3x", 16, 16+len(entries), 16+len(entries), large)
+    return _resident(AT_INDEX_ROOT, value+entries, I30)
+
+def _resident(atype, value, name=u"", flags=0, indexed=0):
+    name = name.encode("utf-16-le")
+    valueoffset = _align8(24+len(name))
+    length = _align8(valueoffset+len(value))
+    buf = struct.pack("<IIBBHHHIHBB", atype, length, 0, len(name)/2, 24, flags, 0,
+                      len(value), valueoffset, indexed, 0)
+    buf += name+"\0"*(valueoffset-24-len(name))+value
+    return buf+"\0"*(length-len(buf))
+
+def _nonresident(atype, runs, clustersize, size, name=u""):
+    name = name.encode("utf-16-le")
+    clusters = sum([r[0] for r in runs])
+    pairsoffset = _align8(64+len(name))
+    pairs = _encode_runs(runs)
+    length = _align8(pairsoffset+len(pairs))
+    buf = struct.pack("<IIBBHHHQQHB5xQQQ", atype, length, 1, len(name)/2, 64, 0, 0,
+                      0, clusters-1, pairsoffset, 0, clusters*clustersize, size, size)
+    buf += name+"\0"*(pairsoffset-64-len(name))+pairs
+    return buf+"\0"*(length-len(buf))
+
+class _Attribute(object):
+    """ Raw attribute of a record with the header fields the writer needs """
+    def __init__(self, raw):
+        self.raw = raw
+        self.type, self.length = struct.unpack("<II", raw[0:8])
+        self.resident = ord(raw[8]) == 0
+        namelen = ord(raw[9])
+        nameoffset, = struct.unpack("<H", raw[10:12])
+        self.name = raw[nameoffset:nameoffset+namelen*2].decode("utf-16-le")
+
+    def value(self):
+        size, offset = struct.unpack("<IH", self.raw[16:22])
+        return self.raw[offset:offset+size]
+
+    def runs(self):
+        offset, = struct.unpack("<H", self.raw[32:34])
+        return _decode_runs(self.raw[offset:])
+
+    def sizes(self):
+        """ allocated, data and initialised size of a non-resident attribute """
+        return struct.unpack("<QQQ", self.raw[40:64])
+
+class _Record(object):
+    """ MFT record as a list of raw attributes """
+    def __init__(self, number, data, mftsize):
+        self.number = number
+        self.mftsize = mftsize
+        self.attributes = []
+        buf = bytearray(data)
+        if buf[0:4] == "FILE":
+            _remove_fixup(buf)
+            buf = str(buf)
+            self.sequence, self.links, attroffset, self.flags = struct.unpack("<HHHH", buf[16:24])
+            self.base, = struct.unpack("<Q", buf[32:40])
+            used, = struct.unpack("<I", buf[24:28])
+            self.usn = buf[48:50]
+            o = attroffset
+            while o < used:
+                atype, alen = struct.unpack("<II", buf[o:o+8])
+                if atype == AT_END or alen == 0:
+                    break
+                self.attributes.append(_Attribute(buf[o:o+alen]))
+                o += alen
+        else:
+            self.sequence = self.links = self.flags = self.base = 0
+            self.usn = "\0\0"
+
+    def find(self, atype, name=u""):
+        for a in self.attributes:
+            if a.type == atype and a.name == name:
+                return a
+        return None
+
+    def remove(self, atype, name=u""):
+        self.attributes = [a for a in self.attributes if not (a.type == atype and a.name == name)]
+
+    def add(self, raw):
+        """ Attributes are kept sorted by type and name """
+        attr = _Attribute(raw)
+        self.remove(attr.type, attr.name)
+        i = 0
+        while i < len(self.attributes) and (self.attributes[i].type, self.attributes[i].name) < (attr.type, attr.name):
+            i += 1
+        self.attributes.insert(i, attr)
+        return attr
+
+    def _attroffset(self):
+        return _align8(48+2*(self.mftsize/512+1))
+
+    def size(self):
+        return self._attroffset()+sum([a.length for a in self.attributes])+8
+
+    def pack(self):
+        if self.size() > self.mftsize:
+            raise ForensicError("MFT record %d full" % self.number)
+        body = ""
+        for instance, a in enumerate(self.attributes):
+            body += a.raw[:14]+struct.pack("<H", instance)+a.raw[16:]
+        body += struct.pack("<II", AT_END, 0)
+        fixup = self.mftsize/512+1
+        attroffset = self._attroffset()
+        header = struct.pack("<4sHHQHHHHIIQHHI", "FILE", 48, fixup, 0, self.sequence, self.links,
+                             attroffset, self.flags, attroffset+len(body), self.mftsize, self.base,
+                             len(self.attributes), 0, self.number)
+        header += self.usn+"\0"*(2*(fixup-1))
+        header += "\0"*(attroffset-len(header))
+        buf = bytearray(header+body+"\0"*(self.mftsize-attroffset-len(body)))
+        return str(_apply_fixup(buf))
+
+class _Directory(object):
+    """ $I30 index of a directory: file reference and key of every entry """
+    def __init__(self, writer, record):
+        self.writer = writer
+        self.record = record
+        self.entries = []
+        self.dirty = False
+        root = record.find(AT_INDEX_ROOT, I30)
+        if root == None:
+            raise ForensicError("Not a directory: %d" % record.number)
+        value = root.value()
+        self.blocksize, = struct.unpack("<I", value[8:12])
+        self.blockclusters = ord(value[12])
+        entryoffset, = struct.unpack("<I", value[16:20])
+        self._parse(value[16+entryoffset:])
+        alloc = record.find(AT_INDEX_ALLOCATION, I30)
+        bitmap = record.find(AT_BITMAP, I30)
+        if alloc != None and bitmap != None:
+            bits = bitmap.value() if bitmap.resident else writer.read_runs(bitmap.runs(), 0, bitmap.sizes()[1])
+            data = writer.read_runs(alloc.runs(), 0, alloc.sizes()[1])
+            for b in range(0, min(len(data)/self.blocksize, len(bits)*8)):
+                if not (ord(bits[b/8]) >> (b%8)) & 1:
+                    continue
+                block = data[b*self.blocksize:(b+1)*self.blocksize]
+                if block[0:4] != "INDX":
+                    continue
+                block = str(_remove_fixup(bytearray(block)))
+                entryoffset, = struct.unpack("<I", block[0x18:0x1c])
+                self._parse(block[0x18+entryoffset:])
+
+    def _parse(self, buf):
+        for entry, offset in _ParseIndexEntries(buf):
+            flags, = struct.unpack("<I", entry[12:16])
+            if flags & INDEX_ENTRY_END:
+                continue
+            ref, = struct.unpack("<Q", entry[0:8])
+            keylength, = struct.unpack("<H", entry[10:12])
+            self.entries.append([ref, entry[16:16+keylength]])
+
+    def _name(self, key):
+        return key[66:66+2*ord(key[64])].decode("utf-16-le")
+
+    def lookup(self, name):
+        """ file reference of name or None. DOS names are ignored """
+        uname = name.upper()
+        for ref, key in self.entries:
+            if ord(key[65]) != 2 and self._name(key).upper() == uname:
+                return ref, key
+        return None
+
+    def add(self, ref, key):
+        self.entries.append([ref, key])
+        self.dirty = True
+
+    def remove(self, number):
+        self.entries = [e for e in self.entries if e[0] & 0xffffffffffff != number]
+        self.dirty = True
+
+    """ Index rebuild """
+    def _entry(self, ref, key, child):
+        length = _align8(16+len(key))+(8 if child != None else 0)
+        flags = INDEX_ENTRY_NODE if child != None else 0
+        buf = struct.pack("<QHHI", ref, length, len(key), flags)+key
+        buf += "\0"*(_align8(len(buf))-len(buf))
+        if child != None:
+            buf += struct.pack("<Q", child)
+        return buf
+
+    def _node(self, seps, children):
+        buf = ""
+        for i, (ref, key) in enumerate(seps):
+            buf += self._entry(ref, key, children[i])
+        if children[-1] != None:
+            buf += struct.pack("<QHHIQ", 0, 24, 0, INDEX_ENTRY_NODE | INDEX_ENTRY_END, children[-1])
+        else:
+            buf += struct.pack("<QHHI", 0, 16, 0, INDEX_ENTRY_END)
+        return buf
+
+    def _root(self, seps, children):
+        large = 1 if children[-1] != None else 0
+        return _index_root(self.blocksize, self.blockclusters, self._node(seps, children), large)
+
+    def _vcn(self, block):
+        cs = self.writer.w_clustersize
+        if self.blocksize >= cs:
+            return block*self.blocksize/cs
+        return block*self.blocksize/512
+
+    def _indx(self, block, seps, children):
+        entries = self._node(seps, children)
+        fixup = self.blocksize/512+1
+        used = 0x28+len(entries)
+        buf = struct.pack("<4sHHQQIIIB3x", "INDX", 0x28, fixup, 0, self._vcn(block),
+                          0x28, used, self.blocksize-0x18, 1 if children[-1] != None else 0)
+        buf += "\0\0"*fixup
+        buf += "\0"*(0x40-len(buf))+entries
+        return _apply_fixup(bytearray(buf+"\0"*(self.blocksize-len(buf))))
+
+    def rebuild(self):
+        """ Write the entries as a B-tree built bottom up. Leaves are filled in
+        collation order, the entry after a full node moves up to the parent
+        level. Levels are added until the top fits in the index root """
+        record = self.record
+        w = self.writer
+        self.entries.sort(key=lambda e: _sort_key(self._name(e[1])))
+        record.remove(AT_INDEX_ALLOCATION, I30)
+        record.remove(AT_BITMAP, I30)
+        seps = self.entries
+        children = [None]*(len(seps)+1)
+        blocks = []
+        capacity = self.blocksize-0x40
+        while True:
+            record.add(self._root(seps, children))
+            if record.size() <= w.w_mftsize-self._allocation_reserve(len(blocks)):
+                break
+            if not seps:
+                raise ForensicError("Directory index does not fit in MFT record")
+            newseps = []
+            newchildren = []
+            nodeseps = []
+            nodechildren = [children[0]]
+            for i, sep in enumerate(seps):
+                if len(self._node(nodeseps+[sep], nodechildren+[children[i+1]])) <= capacity or not nodeseps:
+                    nodeseps.append(sep)
+                    nodechildren.append(children[i+1])
+                    continue
+                if i == len(seps)-1:
+                    """ keep the last node non-empty """
+                    last = nodeseps.pop()
+                    right = nodechildren.pop()
+                    blocks.append([nodeseps, nodechildren])
+                    newseps.append(last)
+                    newchildren.append(self._vcn(len(blocks)-1))
+                    nodeseps = [sep]
+                    nodechildren = [right, children[i+1]]
+                    continue
+                blocks.append([nodeseps, nodechildren])
+                newseps.append(sep)
+                newchildren.append(self._vcn(len(blocks)-1))
+                nodeseps = []
+                nodechildren = [children[i+1]]
+            blocks.append([nodeseps, nodechildren])
+            newchildren.append(self._vcn(len(blocks)-1))
+            seps = newseps
+            children = newchildren
+
+        if blocks:
+            nbytes = len(blocks)*self.blocksize
+            runs = w.reserve_index(record.number, nbytes)
+            data = bytearray()
+            for b, (s, c) in enumerate(blocks):
+                data += self._indx(b, s, c)
+            w.write_runs(runs, 0, str(data))
+            record.add(_nonresident(AT_INDEX_ALLOCATION, runs, w.w_clustersize, nbytes, I30))
+            bits = bytearray(_align8((len(blocks)+7)/8))
+            for b in range(0, len(blocks)):
+                bits[b/8] |= 1 << (b%8)
+            record.add(_resident(AT_BITMAP, str(bits), I30))
+            if record.size() > w.w_mftsize:
+                raise ForensicError("Directory index does not fit in MFT record")
+        w.mark_record(record)
+        self.dirty = False
+
+    def _allocation_reserve(self, nblocks):
+        """ room for $INDEX_ALLOCATION and $BITMAP once the index has blocks """
+        if nblocks == 0:
+            return 0
+        return 96+32+_align8((nblocks+7)/8)
+
+class NTFSWriter(object):
+    def __init__(self, fs):
+        self.fs = fs
+        try:
+            self.w_fh = CountingFile(open(fs.fs_filename, "r+b"))
+        except IOError:
+            raise ForensicError("Cannot open image for writing")
+        self.w_clustersize = fs.f_clustersize
+        self.w_mftsize = fs.f_mftsize
+        self.w_clusters = fs.f_size/(fs.f_clustersize/fs.f_sectorsize)
+        self.w_records = {}
+        self.w_dirty = set()
+        self.w_dirs = {}
+        self.w_oldindex = {}
+
+        """ $MFT runs are needed before any other record can be read """
+        self.w_fh.seek(fs.f_mft1*self.w_clustersize)
+        self.w_mft = _Record(0, self.w_fh.read(self.w_mftsize), self.w_mftsize)
+        self.w_records[0] = self.w_mft
+        data = self.w_mft.find(AT_DATA)
+        self.w_mftruns = data.runs()
+        self.w_mftbytes = data.sizes()[1]
+
+        """ shared with the parser, which then needs no refresh of $Bitmap """
+        self.w_bitmap = fs.f_bitmap
+        self.w_bitmapdirty = None
+        bmrecord = self.get_record(6)
+        self.w_bitmapruns = bmrecord.find(AT_DATA).runs()
+
+        bitmap = self.w_mft.find(AT_BITMAP)
+        if bitmap.resident:
+            self.w_mftbitmap = bytearray(bitmap.value())
+        else:
+            self.w_mftbitmap = bytearray(self.read_runs(bitmap.runs(), 0, bitmap.sizes()[1]))
+
+        mirror = self.get_record(1).find(AT_DATA)
+        self.w_mirrorcount = mirror.sizes()[1]/self.w_mftsize if not mirror.resident else 0
+
+        """ data is placed after an MFT zone of 1/8 of the volume, like ntfs-3g """
+        mftend = self.w_mftruns[-1][1]+self.w_mftruns[-1][0]
+        self.w_next = min(mftend+self.w_clusters/8, self.w_clusters-1)
+        self.w_mftnext = mftend
+
+    """ Raw I/O through runlists """
+    def _pieces(self, runs, offset, length):
+        """ yields [image offset, length] covering offset..offset+length """
+        cs = self.w_clustersize
+        vcn = 0
+        end = offset+length
+        for rlen, lcn in runs:
+            start = vcn*cs
+            stop = (vcn+rlen)*cs
+            vcn += rlen
+            if stop <= offset or lcn == None:
+                continue
+            if start >= end:
+                break
+            a = max(start, offset)
+            b = min(stop, end)
+            yield [lcn*cs+(a-start), b-a, a-offset]
+
+    def read_runs(self, runs, offset, length):
+        buf = bytearray(length)
+        for loc, l, pos in self._pieces(runs, offset, length):
+            self.w_fh.seek(loc)
+            buf[pos:pos+l] = self.w_fh.read(l)
+        return str(buf)
+
+    def write_runs(self, runs, offset, data):
+        for loc, l, pos in self._pieces(runs, offset, len(data)):
+            self.w_fh.seek(loc)
+            self.w_fh.write(data[pos:pos+l])
+
+    """ Clusters """
+    def _set_bits(self, lcn, count, value):
+        span = _set_bit_range(self.w_bitmap, lcn, count, value)
+        if value:
+            self.fs.f_free.reserve(lcn, count)
+        else:
+            self.fs.f_free.release(lcn, count)
+        if self.w_bitmapdirty == None:
+            self.w_bitmapdirty = span
+        else:
+            self.w_bitmapdirty = [min(span[0], self.w_bitmapdirty[0]), max(span[1], self.w_bitmapdirty[1])]
+
+    def _is_free(self, c):
+        return not (self.w_bitmap[c/8] >> (c%8)) & 1
+
+    def allocate(self, n, start=None):
+        """ First fit from start, wrapping around. Returns runs [[length, lcn],..] """
+        if n == 0:
+            return []
+        c = self.w_next if start == None else start
+        runs = []
+        left = n
+        for _ in xrange(0, self.w_clusters):
+            if self.w_bitmap[c/8] == 0xff and c%8 == 0 and c+8 <= self.w_clusters:
+                c = c+8 if c+8 < self.w_clusters else 0
+                continue
+            if self._is_free(c):
+                if runs and runs[-1][1]+runs[-1][0] == c:
+                    runs[-1][0] += 1
+                else:
+                    runs.append([1, c])
+                left -= 1
+                if left == 0:
+                    break
+            c = c+1 if c+1 < self.w_clusters else 0
+        if left > 0:
+            raise ForensicError("Not enough free clusters")
+        for length, lcn in runs:
+            self._set_bits(lcn, length, 1)
+        if start == None:
+            self.w_next = runs[-1][1]+runs[-1][0]
+        return runs
+
+    def free(self, runs):
+        for length, lcn in runs:
+            if lcn != None:
+                self._set_bits(lcn, length, 0)
+
+    """ MFT records """
+    def get_record(self, number):
+        try:
+            return self.w_records[number]
+        except KeyError:
+            pass
+        data = self.read_runs(self.w_mftruns, number*self.w_mftsize, self.w_mftsize)
+        record = _Record(number, data, self.w_mftsize)
+        self.w_records[number] = record
+        return record
+
+    def mark_record(self, record):
+        self.w_dirty.add(record.number)
+
+    def _extend_mft(self, records):
+        """ Grow $MFT by at least records records, preferably right after its
+        last cluster. New records are formatted empty """
+        cs = self.w_clustersize
+        grow = (records*self.w_mftsize+cs-1)/cs
+        newruns = self.allocate(grow, self.w_mftnext)
+        self.w_mftnext = newruns[-1][1]+newruns[-1][0]
+        for run in newruns:
+            if self.w_mftruns[-1][1]+self.w_mftruns[-1][0] == run[1]:
+                self.w_mftruns[-1][0] += run[0]
+            else:
+                self.w_mftruns.append(run)
+        first = self.w_mftbytes/self.w_mftsize
+        self.w_mftbytes = sum([r[0] for r in self.w_mftruns])*cs
+        empty = _Record(0, "", self.w_mftsize)
+        for number in range(first, self.w_mftbytes/self.w_mftsize):
+            empty.number = number
+            self.write_runs(self.w_mftruns, number*self.w_mftsize, empty.pack())
+        self.w_mft.add(_nonresident(AT_DATA, self.w_mftruns, cs, self.w_mftbytes))
+        self.mark_record(self.w_mft)
+
+    def new_record(self, flags):
+        number = FIRST_USER_RECORD
+        while number/8 < len(self.w_mftbitmap) and (self.w_mftbitmap[number/8] >> (number%8)) & 1:
+            number += 1
+        if number >= self.w_mftbytes/self.w_mftsize:
+            self._extend_mft(number-self.w_mftbytes/self.w_mftsize+MFT_EXTEND_RECORDS)
+        while number/8 >= len(self.w_mftbitmap):
+            self.w_mftbitmap += bytearray(8)
+        self.w_mftbitmap[number/8] |= 1 << (number%8)
+        old = self.get_record(number)
+        record = _Record(number, "", self.w_mftsize)
+        record.sequence = old.sequence if old.sequence > 0 else 1
+        record.links = 1
+        record.flags = flags
+        self.w_records[number] = record
+        self.mark_record(record)
+        return record
+
+    def free_record(self, record):
+        for a in record.attributes:
+            if not a.resident:
+                self.free(a.runs())
+        record.flags = 0
+        record.sequence = record.sequence+1 if record.sequence < 0xffff else 1
+        self.w_mftbitmap[record.number/8] &= ~(1 << (record.number%8)) & 0xff
+        self.mark_record(record)
+
+    def reserve_index(self, number, nbytes):
+        """ Clusters for nbytes of index buffers of directory number. The old
+        allocation is kept when it is large enough """
+        cs = self.w_clustersize
+        need = (nbytes+cs-1)/cs
+        runs = self.w_oldindex.pop(number, [])
+        if sum([r[0] for r in runs]) >= need:
+            return self._trim_runs(runs, need)
+        self.free(runs)
+        return self.allocate(need)
+
+    def _trim_runs(self, runs, clusters):
+        """ keep the first clusters of runs, give the rest back """
+        kept = []
+        for length, lcn in runs:
+            if clusters == 0:
+                self.free([[length, lcn]])
+            elif length <= clusters:
+                kept.append([length, lcn])
+                clusters -= length
+            else:
+                kept.append([clusters, lcn])
+                self.free([[length-clusters, lcn+clusters]])
+                clusters = 0
+        return kept
+
+    """ Attributes of new records """
+    def _standard_information(self, parent, attr):
+        now = _ntfs_now()
+        si = parent.find(AT_STANDARD_INFORMATION).value()
+        value = struct.pack("<QQQQIIII", now, now, now, now, attr, 0, 0, 0)
+        if len(si) >= 72:
+            """ NTFS 3.x: owner and security ids from the parent directory """
+            value += si[48:56]+struct.pack("<QQ", 0, 0)
+        return _resident(AT_STANDARD_INFORMATION, value)
+
+    def _file_name(self, parent, name, attr, allocated, size):
+        now = _ntfs_now()
+        uname = name.encode("utf-16-le")
+        return struct.pack("<QQQQQQQIIBB", parent.number | (parent.sequence << 48), now, now,
+                           now, now, allocated, size, attr, 0, len(name), 0)+uname
+
+    """ Directories """
+    def get_directory(self, number):
+        try:
+            return self.w_dirs[number]
+        except KeyError:
+            pass
+        record = self.get_record(number)
+        d = _Directory(self, record)
+        alloc = record.find(AT_INDEX_ALLOCATION, I30)
+        if alloc != None:
+            self.w_oldindex[number] = alloc.runs()
+        self.w_dirs[number] = d
+        return d
+
+    def _split(self, path):
+        return [p for p in _to_unicode(path).split(u"/") if p not in (u"", u".")]
+
+    def makedirs(self, path):
+        """ Create directory path and any missing parents. Returns the directory """
+        d = self.get_directory(5)
+        for name in self._split(path):
+            found = d.lookup(name)
+            if found != None:
+                ref, key = found
+                if not struct.unpack("<I", key[56:60])[0] & FILE_ATTR_DIRECTORY:
+                    raise ForensicError("Not a directory: "+name)
+                d = self.get_directory(ref & 0xffffffffffff)
+                continue
+            d = self._create_directory(d, name)
+        return d
+
+    def _check_name(self, name):
+        if len(name) > 255 or u"/" in name or u"\0" in name:
+            raise ForensicError("Illegal NTFS file name "+name)
+
+    def _create_directory(self, parent, name):
+        self._check_name(name)
+        record = self.new_record(MFT_RECORD_IN_USE | MFT_RECORD_IS_DIRECTORY)
+        key = self._file_name(parent.record, name, FILE_ATTR_DIRECTORY, 0, 0)
+        record.add(self._standard_information(parent.record, 0))
+        record.add(_resident(AT_FILE_NAME, key, indexed=1))
+        record.add(_index_root(parent.blocksize, parent.blockclusters, 
+                               struct.pack("<QHHI", 0, 16, 0, INDEX_ENTRY_END), 0))
+        d = _Directory(self, record)
+        d.dirty = True
+        self.w_dirs[record.number] = d
+        parent.add(record.number | (record.sequence << 48), key)
+        return d
+
+    """ Files """
+    def _data_attribute(self, record, fobj, size, name=u""):
+        """ resident if the data fits the record, clusters otherwise """
+        if size <= RESIDENT_LIMIT:
+            raw = _resident(AT_DATA, fobj.read(size), name)
+            if record.size()+len(raw) <= self.w_mftsize:
+                record.add(raw)
+                return 0
+            fobj.seek(0)
+        cs = self.w_clustersize
+        runs = self.allocate((size+cs-1)/cs)
+        offset = 0
+        for length, lcn in runs:
+            """ runs are contiguous, copy in blocks """
+            left = min(length*cs, size-offset)
+            loc = lcn*cs
+            while left > 0:
+                buf = fobj.read(min(left, COPY_BLOCK))
+                if not buf:
+                    break
+                self.w_fh.seek(loc)
+                self.w_fh.write(buf)
+                loc += len(buf)
+                left -= len(buf)
+            offset += length*cs
+        record.add(_nonresident(AT_DATA, runs, cs, size, name))
+        return sum([r[0] for r in runs])*cs
+
+    def write_stream(self, dirpath, name, fobj, size):
+        """ Create file dirpath/name of size bytes read from fobj. An existing
+        file of the same name is replaced like a copy to a mounted image does """
+        name = _to_unicode(name)
+        self._check_name(name)
+        d = self.makedirs(dirpath)
+        found = d.lookup(name)
+        if found != None:
+            ref, key = found
+            if struct.unpack("<I", key[56:60])[0] & FILE_ATTR_DIRECTORY:
+                raise ForensicError("Is a directory: "+name)
+            number = ref & 0xffffffffffff
+            self.free_record(self.get_record(number))
+            d.remove(number)
+        record = self.new_record(MFT_RECORD_IN_USE)
+        record.add(self._standard_information(d.record, FILE_ATTR_ARCHIVE))
+        allocated = self._data_attribute(record, fobj, size)
+        key = self._file_name(d.record, name, FILE_ATTR_ARCHIVE, allocated, size)
+        record.add(_resident(AT_FILE_NAME, key, indexed=1))
+        d.add(record.number | (record.sequence << 48), key)
+        return record.number
+
+    def write_file(self, path, data):
+        parts = _to_unicode(path).rsplit(u"/", 1)
+        dirpath, name = parts if len(parts) == 2 else [u"", parts[0]]
+        return self.write_stream(dirpath, name, StringIO(data), len(data))
+
+    def copy_file(self, source, dirpath):
+        """ Copy local file source into directory dirpath of the image """
+        try:
+            size = os.path.getsize(source)
+            fobj = open(source, "rb")
+        except (IOError, OSError):
+            raise ForensicError("Cannot read "+source)
+        try:
+            return self.write_stream(dirpath, os.path.basename(source), fobj, size)
+        finally:
+            fobj.close()
+
+    def add_stream(self, path, stream, data):
+        """ Add alternate data stream path:stream to an existing file """
+        stream = _to_unicode(stream)
+        parts = self._split(path)
+        if not parts:
+            raise ForensicError("No file name")
+        d = self.makedirs(u"/".join(parts[:-1]))
+        found = d.lookup(parts[-1])
+        if found == None:
+            raise ForensicError("File not found: "+path)
+        record = self.get_record(found[0] & 0xffffffffffff)
+        old = record.find(AT_DATA, stream)
+        if old != None:
+            if not old.resident:
+                self.free(old.runs())
+            record.remove(AT_DATA, stream)
+        self._data_attribute(record, StringIO(data), len(data), stream)
+        self.mark_record(record)
+
+    def close(self):
+        """ Rebuild changed directory indexes, then write records, the $MFT
+        bitmap, $MftMirr and $Bitmap """
+        for d in self.w_dirs.values():
+            if d.dirty:
+                d.rebuild()
+
+        bitmap = self.w_mft.find(AT_BITMAP)
+        size = _align8(len(self.w_mftbitmap))
+        bits = str(self.w_mftbitmap)+"\0"*(size-len(self.w_mftbitmap))
+        if bitmap.resident:
+            self.w_mft.add(_resident(AT_BITMAP, bits))
+        else:
+            runs = bitmap.runs()
+            allocated = bitmap.sizes()[0]
+            if size > allocated:
+                cs = self.w_clustersize
+                runs = runs+self.allocate((size-allocated+cs-1)/cs)
+            self.write_runs(runs, 0, bits)
+            self.w_mft.add(_nonresident(AT_BITMAP, runs, self.w_clustersize, size))
+        self.mark_record(self.w_mft)
+
+        mirror = self.fs.f_mft2*self.w_clustersize
+        for number in sorted(self.w_dirty):
+            data = self.w_records[number].pack()
+            self.write_runs(self.w_mftruns, number*self.w_mftsize, data)
+            if number < self.w_mirrorcount:
+                self.w_fh.seek(mirror+number*self.w_mftsize)
+                self.w_fh.write(data)
+        self.fs.fs_mark_records(self.w_dirty)
+        self.w_dirty = set()
+
+        if self.w_bitmapdirty != None:
+            start, end = self.w_bitmapdirty
+            self.write_runs(self.w_bitmapruns, start, str(self.w_bitmap[start:end]))
+            self.w_bitmapdirty = None
+        self.w_fh.close()
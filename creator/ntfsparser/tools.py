@@ -172,3 +172,66 @@ class _NTFSTime:
         
         
         
+
+def _fixup_blocks(buf):
+    """ update sequence array offset and the number of 512 byte blocks it covers.
+    Garbage headers of unused records are cut down to what buf can hold """
+    updateoffset, fixup = struct.unpack_from("<HH", buf, 4)
+    blocks = min(max(fixup-1, 0), len(buf)/512, max(len(buf)-updateoffset-2, 0)/2)
+    return updateoffset, blocks
+
+def _fixup_valid(buf):
+    """ True if every 512 byte block of a bytearray record or index buffer still
+    ends in the update sequence number, i.e. no block is torn or stale """
+    updateoffset, blocks = _fixup_blocks(buf)
+    usn = buf[updateoffset:updateoffset+2]
+    for z in range(0, blocks):
+        if buf[z*512+510:z*512+512] != usn:
+            return False
+    return True
+
+def _remove_fixup(buf):
+    """ Put the bytes saved in the update sequence array back to the end of every 
+    512 byte block of an MFT record or index buffer. buf is a bytearray, changed
+    in place """
+    updateoffset, blocks = _fixup_blocks(buf)
+    for z in range(0, blocks):
+        x = updateoffset+2+z*2
+        buf[z*512+510:z*512+512] = buf[x:x+2]
+    return buf
+
+def _apply_fixup(buf):
+    """ Counterpart of _remove_fixup before a write. Increments the update sequence 
+    number, saves the end of every 512 byte block and puts the number there """
+    updateoffset, blocks = _fixup_blocks(buf)
+    usn, = struct.unpack_from("<H", buf, updateoffset)
+    usn = usn+1 if 0 < usn < 0xffff else 1
+    buf[updateoffset:updateoffset+2] = struct.pack("<H", usn)
+    for z in range(0, blocks):
+        x = updateoffset+2+z*2
+        buf[x:x+2] = buf[z*512+510:z*512+512]
+        buf[z*512+510:z*512+512] = buf[updateoffset:updateoffset+2]
+    return buf
+
+def _set_bit_range(bitmap, first, count, value):
+    """ Set (value 1) or clear (value 0) bits first..first+count-1 of a bytearray 
+    bitmap, bit n in bit n%8 of byte n/8. Whole bytes are changed with one slice 
+    assignment. Returns the changed byte span [start, end), None if count is 0 """
+    if count <= 0:
+        return None
+    last = first+count-1
+    b0 = first/8
+    b1 = last/8
+    lomask = (0xff << (first%8)) & 0xff
+    himask = 0xff >> (7-last%8)
+    if b0 == b1:
+        lomask &= himask
+    if value:
+        bitmap[b0] |= lomask
+        bitmap[b1] |= himask if b1 > b0 else lomask
+        bitmap[b0+1:b1] = "\xff"*(b1-b0-1)
+    else:
+        bitmap[b0] &= ~lomask & 0xff
+        bitmap[b1] &= ~(himask if b1 > b0 else lomask) & 0xff
+        bitmap[b0+1:b1] = "\x00"*(b1-b0-1)
+    return [b0, b1+1]
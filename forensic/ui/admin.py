@@ -19,7 +19,7 @@ from django.contrib import admin
 from ui.models import User,Case,Image,TrivialFileItem, FileSystem, HidingMethod
 from ui.models import Webhistory,TrivialStrategy,Url,SearchEngine
 from ui.models import TrivialObject, SecretStrategy, HiddenObject
-from ui.models import SecretFileItem, WebMethod
+from ui.models import SecretFileItem, WebMethod, Job, JobImage, ImageStage
 from django.forms import ModelForm
 import datetime
 
@@ -103,6 +103,17 @@ class HiddenObjectAdmin(admin.ModelAdmin):
 class ImageAdmin(admin.ModelAdmin):
     list_display=("case", "seqno", "weekvariance", "filename")
     search_fields = ["case"]
+
+class ImageStageAdmin(admin.ModelAdmin):
+    list_display=("image", "seq", "name", "seconds", "reads", "bytes_read", "writes", 
+                  "bytes_written", "write_calls", "mounts", "umounts")
+    list_filter = ["name"]
+
+class JobAdmin(admin.ModelAdmin):
+    list_display=("case", "webhistory", "status", "date_created", "date_started", "date_finished", "message")
+
+class JobImageAdmin(admin.ModelAdmin):
+    list_display=("job", "seqno", "status", "reason")
     
   
 admin.site.register(Case, CaseAdmin)
@@ -121,3 +132,6 @@ admin.site.register(TrivialObject, TrivialObjectAdmin)
 admin.site.register(SecretStrategy, SecretStrategyAdmin)
 admin.site.register(HiddenObject, HiddenObjectAdmin)
 admin.site.register(Image, ImageAdmin)
+admin.site.register(ImageStage, ImageStageAdmin)
+admin.site.register(Job, JobAdmin)
+admin.site.register(JobImage, JobImageAdmin)
@@ -0,0 +1,77 @@
+'''
+Copyright 2014 Hannu Visti
+
+This file is part of ForGe forensic test image generator.
+ForGe is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import time
+import datetime
+from traceback import format_exc
+from optparse import make_option
+from django import db
+from django.core.management.base import BaseCommand
+
+""" creator is installed next to forensic """
+CREATORDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 
+                                          "..", "..", "..", "..", "creator"))
+if CREATORDIR not in sys.path:
+    sys.path.append(CREATORDIR)
+
+from ui.models import Job, JOB_FAILED
+from ui.uitools import errlog
+
+class Command(BaseCommand):
+    help = """Run queued image creation jobs. More than one worker may run on 
+a host if their chelper slot ranges (--first-slot .. +--workers) do not overlap"""
+    option_list = BaseCommand.option_list + (
+        make_option("--workers", type="int", dest="workers", default=None,
+                    help="images built in parallel, default WORKERS of uitools"),
+        make_option("--first-slot", type="int", dest="first_slot", default=0,
+                    help="first chelper slot used by this worker"),
+        make_option("--interval", type="int", dest="interval", default=5,
+                    help="seconds between queue polls"),
+        make_option("--once", action="store_true", dest="once", default=False,
+                    help="exit when the queue is empty"),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                job = Job.claim_next()
+            except Exception:
+                errlog(format_exc())
+                db.connection.close()
+                time.sleep(options["interval"])
+                continue
+            if job == None:
+                if options["once"]:
+                    return
+                time.sleep(options["interval"])
+                continue
+            self.stdout.write("%s started\n" % job)
+            try:
+                job.run(workers=options["workers"], first_slot=options["first_slot"])
+            except Exception:
+                """ Job.run could not even record the failure, e.g. the 
+                database went away. Mark the job failed if possible and go on 
+                with a new connection """
+                errlog(format_exc())
+                db.connection.close()
+                try:
+                    Job.objects.filter(pk=job.pk).update(
+                        status=JOB_FAILED, date_finished=datetime.datetime.now(),
+                        message="Worker error")
+                except Exception:
+                    errlog(format_exc())
+                    db.connection.close()
+                continue
+            self.stdout.write("%s %s: %s\n" % (job, job.get_status_display(), job.message))
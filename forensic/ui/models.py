@@ -12,6 +12,7 @@ along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from django.db import models
+from django import db
 
 from django.core.files.storage import default_storage
 import sys,os
@@ -23,6 +24,13 @@ from uitools import Chelper
 from subprocess import call
 import datetime
 import importlib
+from traceback import format_exc
+from multiprocessing import Pool, Queue
+from imagefile.stats import StageStats
+from imagefile.timeline import TimelineEngine
+
+""" HidingMethod.priorityflag of methods that need a mounted image """
+FLAG_FILESYSTEM = 1
 
 class User(models.Model):
     ROLES = ((0,"Administrator"), (1,"Teacher"), (2,"Student"), (3,"Tester"))
@@ -79,6 +87,11 @@ class HidingMethod(models.Model):
             func = self._hide_class_name
         return func
 
+    def needs_mount(self, filesystem):
+        """ True if the method writes through the mounted file system, see
+        priorityflag in hiding.ads """
+        return self.get_hide_class()(filesystem).priorityflag == FLAG_FILESYSTEM
+
 class WebMethod(models.Model):
     name = models.CharField(max_length=32, unique=True)
     priority = models.IntegerField(default=0)
@@ -125,7 +138,11 @@ class Webhistory(models.Model):
     def getLongFilename(self,fname):        
         return Chelper().prefix+"/"+fname
 
-    def processWebhistory(self):
+    def processWebhistory(self, slot=None, job=None):
+        """ slot selects the chelper mount point like in Case.build_image. 
+        The browser container is the same for every slot. Progress of every
+        image is kept in JobImage if job is given. Returns [succeed_list, 
+        failed_list] """
         try:
             self.filesystem = FileSystem.objects.filter(name="NTFS")[0]
         except:
@@ -137,8 +154,7 @@ class Webhistory(models.Model):
         s_searches = self.searchengine_set.exclude(group=0)
         command = self.filesystem.get_create_function()
         fsclass = self.filesystem.get_class()
-        mountpoint = Chelper().mountpoint
-        prefix = Chelper().prefix
+        mountpoint = Chelper().get_mountpoint(slot)
 
 
         uclass = self.method.get_hide_class()
@@ -150,46 +166,65 @@ class Webhistory(models.Model):
         if rdict["status"] == 2:
             raise ForensicError(rdict["message"])
 
+        if job != None:
+            job.jobimage_set.all().delete()
+            JobImage.objects.bulk_create([JobImage(job=job, seqno=i) 
+                                          for i in range(1,len(rdict["results"])+1)])
         i=0
         failed_list=[]
+        succeed_list=[]
         for r in rdict["results"]:
             i += 1
-            if r["status"] != "OK":
-                continue
+            if job != None:
+                JobImage.objects.filter(job=job, seqno=i).update(status=JOB_RUNNING)
+            failure = self._build_web_image(i, r, command, fsclass, mountpoint, slot)
+            if failure == None:
+                succeed_list.append(i)
+                if job != None:
+                    JobImage.objects.filter(job=job, seqno=i).update(status=JOB_DONE)
+            else:
+                failed_list.append([i,failure])
+                if job != None:
+                    JobImage.objects.filter(job=job, seqno=i).update(status=JOB_FAILED,
+                                                                     reason=str(failure)[:512])
+        return [succeed_list,failed_list]
 
-            iname=self.name+"-"+str(i)
-            fcr =  command(size=r["size"], garbage=False,
-                           clustersize=8, 
-                           name=iname)
-            if fcr != 0:
-                uitools.errlog( "something may be wrong, image not created")
-                failed_list.append([i,"Unable to create image file"])
-                continue
-            mount_file = self.getLongFilename(iname)
-            fsystem = fsclass(mount_file, mountpoint)
-            fsystem.fs_init()
-            if fsystem.mount_image() != 0:
-                failed_list.append([i,"Cannot mount image file"])
-                uitools.errlog("--- Cannot mount file, image not processed")
-                os.remove(mount_file)
-                continue
-            try:
-                cdir=os.getcwd()
-                os.chdir(mountpoint)
-            except:
-                fsystem.dismount_image()
-                os.remove(mount_file)
-                failed_list.append([i, "unable to change directory"])
-                continue
-            cres = call(["/bin/tar", "xf", r["fname"]], shell=False)
-            if cres != 0:
-                uitools.errlog("Unable to untar %s" % r["fname"])
-                fsystem.dismount_image()
-                os.remove(mount_file)
-                failed_list.append([i, "unable to untar"])
-                continue
-            os.chdir(cdir)
+    """ Image i with the browser history r untarred to its root. Returns None 
+    or the reason of the failure """
+    def _build_web_image(self, i, r, command, fsclass, mountpoint, slot):
+        if r["status"] != "OK":
+            return "Browser history not created"
+
+        iname=self.name+"-"+str(i)
+        fcr =  command(size=r["size"], garbage=False,
+                       clustersize=8, 
+                       name=iname)
+        if fcr != 0:
+            uitools.errlog( "something may be wrong, image not created")
+            return "Unable to create image file"
+        mount_file = self.getLongFilename(iname)
+        fsystem = fsclass(mount_file, mountpoint, slot)
+        fsystem.fs_init()
+        if fsystem.mount_image() != 0:
+            uitools.errlog("--- Cannot mount file, image not processed")
+            os.remove(mount_file)
+            return "Cannot mount image file"
+        try:
+            cdir=os.getcwd()
+            os.chdir(mountpoint)
+        except:
+            fsystem.dismount_image()
+            os.remove(mount_file)
+            return "unable to change directory"
+        cres = call(["/bin/tar", "xf", r["fname"]], shell=False)
+        os.chdir(cdir)
+        if cres != 0:
+            uitools.errlog("Unable to untar %s" % r["fname"])
             fsystem.dismount_image()
+            os.remove(mount_file)
+            return "unable to untar"
+        fsystem.dismount_image()
+        return None
 
 class Url(models.Model):
     case = models.ForeignKey(Webhistory)
@@ -209,6 +244,35 @@ class SearchEngine(models.Model):
     click_result = models.IntegerField(default=0)
     click_depth = models.IntegerField(default=1)
 
+""" Worker process state and entry point of the parallel image build.
+These live at module level so that multiprocessing can pickle them """
+_worker_slot = None
+
+def _init_case_worker(slots):
+    global _worker_slot
+    _worker_slot = slots.get()
+    db.connection.close()
+
+def _build_case_image(job, case=None, slot=None):
+    case_id, i, sweep_id, job_id = job
+    if slot == None:
+        slot = _worker_slot
+    if case == None:
+        case = Case.objects.get(pk=case_id)
+    sweepfile = None
+    if sweep_id != None:
+        sweepfile = SecretFileItem.objects.get(pk=sweep_id)
+    if job_id != None:
+        JobImage.objects.filter(job=job_id, seqno=i).update(status=JOB_RUNNING)
+    failure = case.build_image(i, slot=slot, sweepfile=sweepfile)
+    if job_id != None:
+        if failure == None:
+            JobImage.objects.filter(job=job_id, seqno=i).update(status=JOB_DONE)
+        else:
+            JobImage.objects.filter(job=job_id, seqno=i).update(status=JOB_FAILED, 
+                                                                reason=str(failure)[:512])
+    return [i, failure]
+
 class Case(models.Model):
     name = models.CharField(max_length = 256, unique=True)
     owner = models.ForeignKey(User)
@@ -252,15 +316,14 @@ class Case(models.Model):
 
         return len(sfiles) if sweep > 0 else amount
 
-    def processCase(self):
+    def processCase(self, workers=None, job=None, first_slot=0):
+        """ Build every image of the case. With more than one worker the
+        images are built by a process pool, one image per worker at a time.
+        Each worker owns a chelper slot, i.e. its own mount point and loop
+        device, numbered from first_slot. Progress of each image is recorded 
+        in JobImage if job is given. Returns [succeed_list, failed_list] """
 
-        trivial_strategies = self.trivialstrategy_set.all()
-        secret_strategies_pre = self.secretstrategy_set.all()
-        secret_strategies = secret_strategies_pre
         command = self.filesystem.get_create_function()
-        fsclass = self.filesystem.get_class()
-        mountpoint = Chelper().mountpoint
-        prefix = Chelper().prefix
 
         failed_list=[]
         succeed_list = []
@@ -273,225 +336,273 @@ class Case(models.Model):
         if command == None:
             uitools.errlog("no FS create command")
             return None
+        if workers == None:
+            workers = Chelper().workers
+        workers = max(1, min(workers, tobecreated))
+
+        """ Each sweep image hides its own file of the sweep group """
+        sweepfiles = [None]*tobecreated
+        if self.sweep != None:
+            secretfiles = SecretFileItem.objects.filter(group=self.sweep.group)
+            sweepfiles = [sf.pk for sf in secretfiles[:tobecreated]]
+        job_id = None
+        if job != None:
+            job_id = job.pk
+            job.jobimage_set.all().delete()
+            JobImage.objects.bulk_create([JobImage(job=job, seqno=i) 
+                                          for i in range(1,tobecreated+1)])
+        jobs = [[self.pk, i, sweepfiles[i-1], job_id] for i in range(1,tobecreated+1)]
+
         try:
             removed_chmod = os.chmod
             del os.chmod
         except AttributeError:
             removed_chmod = None
-        if self.sweep != None:
-            secretfiles = SecretFileItem.objects.filter(group=self.sweep.group)
-            secretindex=0
 
-        for i in range(1,tobecreated+1):
-            if self.trivialstrategy_set.count() == 0:
-                failed_list.append([i,"No trivial strategies"])
-                continue
-            filename = self.name+"-"+str(i)
-            
-            result =  command(size=self.size, garbage=self.garbage, 
-                              clustersize=self.fsparam1, 
-                              name=filename)
-            if result != 0:
-                uitools.errlog( "something may be wrong, image not created")
-                failed_list.append([i,"Unable to create image file"])
-                continue
-            image = Image(filename=filename, seqno = i, case = self)
-            image.save()
-            mount_file = image.getLongFilename()
-            fsystem = fsclass(mount_file, mountpoint)
-            fsystem.fs_init()
-            if fsystem.mount_image() != 0:
-                failed_list.append([i,"Cannot mount image file"])
-                uitools.errlog("--- Cannot mount file, image not processed")
-                os.remove(mount_file)
-                image.delete()
-                continue
-            """ Set root dir time """
-            rand_weeks = random.randint(0,self.weekvariance)
-            image.weekvariance = rand_weeks
-            image.save()
-            timevariance = datetime.timedelta(weeks=rand_weeks)
-            image_time = self.roottime + timevariance
-            time_command_list = []
-            time_command_list = [["/.",image_time]]
-            flag = False
-            for strategy in trivial_strategies:
+        try:
+            if workers > 1:
+                """ Workers must not share the database connection of this process """
+                db.connection.close()
+                slots = Queue()
+                for slot in range(first_slot,first_slot+workers):
+                    slots.put(slot)
+                pool = Pool(processes=workers, initializer=_init_case_worker, 
+                            initargs=(slots,))
                 try:
-                    tl = image.implement_trivial_strategy(strategy, strategy.dirtime+timevariance)
-                    time_command_list.append([strategy.path,strategy.dirtime+timevariance])
-                    time_command_list = time_command_list + tl
-                except ForensicError as fe:
-                    failed_list.append([i,fe])
-                    uitools.errlog(fe)
+                    results = pool.map(_build_case_image, jobs, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                slot = first_slot if first_slot > 0 else None
+                results = [_build_case_image(j, case=self, slot=slot) for j in jobs]
+        finally:
+            if removed_chmod != None:
+                setattr(os, "chmod", removed_chmod)
+
+        for i,failure in results:
+            if failure == None:
+                succeed_list.append(i)
+            else:
+                failed_list.append([i,failure])
+        return [succeed_list,failed_list]
+
+    def build_image(self, i, slot=None, sweepfile=None):
+        """ Create image number i of the case. Returns None on success or the
+        reason of failure. slot selects the chelper mount point, sweepfile is
+        the secret file hidden by the sweep strategy. Time and I/O of each 
+        stage are stored in ImageStage """
+        stats = StageStats()
+        stats.activate()
+        try:
+            return self._build_image(i, slot, sweepfile, stats)
+        finally:
+            stats.deactivate()
+
+    def _build_image(self, i, slot, sweepfile, stats):
+        trivial_strategies = self.trivialstrategy_set.all()
+        secret_strategies = self.secretstrategy_set.all()
+        command = self.filesystem.get_create_function()
+        fsclass = self.filesystem.get_class()
+        mountpoint = Chelper().get_mountpoint(slot)
+
+        if self.trivialstrategy_set.count() == 0:
+            return "No trivial strategies"
+        filename = self.name+"-"+str(i)
+        
+        stats.begin("create")
+        result =  command(size=self.size, garbage=self.garbage, 
+                          clustersize=self.fsparam1, 
+                          name=filename)
+        if result != 0:
+            uitools.errlog( "something may be wrong, image not created")
+            return "Unable to create image file"
+        image = Image(filename=filename, seqno = i, case = self)
+        image.save()
+        mount_file = image.getLongFilename()
+        stats.begin("parse")
+        fsystem = fsclass(mount_file, mountpoint, slot)
+        fsystem.fs_init()
+        stats.begin("trivial")
+        """ Trivial files go straight into the image file if the file system 
+        has a writer, otherwise through a mount """
+        writer = fsystem.get_direct_writer()
+        if writer == None and fsystem.mount_image() != 0:
+            uitools.errlog("--- Cannot mount file, image not processed")
+            os.remove(mount_file)
+            image.delete()
+            return "Cannot mount image file"
+        """ Set root dir time """
+        rand_weeks = random.randint(0,self.weekvariance)
+        image.weekvariance = rand_weeks
+        image.save()
+        timevariance = datetime.timedelta(weeks=rand_weeks)
+        image_time = self.roottime + timevariance
+        time_command_list = []
+        time_command_list = [["/.",image_time]]
+        for strategy in trivial_strategies:
+            try:
+                tl = image.implement_trivial_strategy(strategy, strategy.dirtime+timevariance, 
+                                                      mountpoint, writer)
+                time_command_list.append([strategy.path,strategy.dirtime+timevariance])
+                time_command_list = time_command_list + tl
+            except ForensicError as fe:
+                uitools.errlog(fe)
+                if writer != None:
+                    writer.close()
+                else:
                     fsystem.dismount_image()
+                os.remove(mount_file)
+                image.delete()
+                return fe
+            
+        """ Bring the parsed structures up to date. After a direct write only
+        the changed records and directories are read again """
+        if writer != None:
+            writer.close()
+        else:
+            fsystem.dismount_image()
+        stats.begin("refresh")
+        fsystem.fs_refresh()
+
+        """ 
+        Reserve code for placeall implementation. 
+
+
+        flag = False
+        secret_strategies = []
+        for st in secret_strategies_pre:
+            if st.placeall:
+                if st == self.sweep:
+                    uitools.errlog("Sweep strategy cannot be a placeall strategy")
+                    failed_list.append([i,"Secret strategy cannot be a placeall strategy"])
                     os.remove(mount_file)
                     image.delete()
                     flag = True
                     break
-            if flag == True:
-                continue
+                pafiles = SecretFileItem.objects.filter(group=st.group)
                 
-            """ Initialise NTFS structures at this stage """
-            fsystem.dismount_image()
-            fsystem.fs_init()
-
-            """ 
-            Reserve code for placeall implementation. 
-
-
-            flag = False
-            secret_strategies = []
-            for st in secret_strategies_pre:
-                if st.placeall:
-                    if st == self.sweep:
-                        uitools.errlog("Sweep strategy cannot be a placeall strategy")
-                        failed_list.append([i,"Secret strategy cannot be a placeall strategy"])
-                        os.remove(mount_file)
-                        image.delete()
-                        flag = True
-                        break
-                    pafiles = SecretFileItem.objects.filter(group=st.group)
-                    
-                else:
-                    secret_strategies.append(st)
-            if flag == True:
-                continue """
+            else:
+                secret_strategies.append(st)
+        if flag == True:
+            continue """
 
 
 
-            file_delete_list = []
-            file_action_list = []    
+        file_delete_list = []
+        file_action_list = []    
 
-            try:
-                for prio in range (1,21):
-                    current_strategies = [t for t in secret_strategies if t.method.priority == prio]
-                    for sstrategy in current_strategies:
-                        if self.sweep != None:
-                            if sstrategy == self.sweep:
-                                tv = image.implement_secret_strategy(sstrategy, fsystem, timevariance, 
-                                                                     sfile = secretfiles[secretindex])
-                                secretindex += 1
-                            else:
-                                tv = image.implement_secret_strategy(sstrategy, fsystem, timevariance, 
-                                                                     sfile = None)
-                        else:
-                            tv = image.implement_secret_strategy(sstrategy, fsystem, timevariance, 
-                                                                 sfile = None)
-                        if tv:
-                            try:
-                                time_command_list = time_command_list + tv["timeline"]
-                            except KeyError:
-                                pass
-                            try:
-                                file_delete_list = file_delete_list + tv["todelete"]
-                            except KeyError:
-                                pass
-                            try: 
-                                file_action_list = file_action_list + tv["actions"]
-                            except KeyError:
-                                pass
-                            
-            except ForensicError as fe:
-                failed_list.append([i,fe])
-                uitools.errlog(fe)
-                fsystem.dismount_image()
-                os.remove(mount_file)
-                image.delete()
-                continue
+        try:
+            for prio in range (1,21):
+                current_strategies = [t for t in secret_strategies if t.method.priority == prio]
+                """ Methods that write through the mounted file system share one
+                mount. The ones that write the image directly go first """
+                mounted = [t for t in current_strategies if t.method.needs_mount(fsystem)]
+                current_strategies = [t for t in current_strategies if t not in mounted]+mounted
+                for sstrategy in current_strategies:
+                    if sstrategy in mounted and not fsystem.fs_session:
+                        stats.begin("mount")
+                        fsystem.begin_mount_session()
+                    stats.begin("hide "+sstrategy.method.name)
+                    if self.sweep != None and sstrategy == self.sweep:
+                        tv = image.implement_secret_strategy(sstrategy, fsystem, timevariance, 
+                                                             sfile = sweepfile)
+                    else:
+                        tv = image.implement_secret_strategy(sstrategy, fsystem, timevariance, 
+                                                             sfile = None)
+                    if tv:
+                        try:
+                            time_command_list = time_command_list + tv["timeline"]
+                        except KeyError:
+                            pass
+                        try:
+                            file_delete_list = file_delete_list + tv["todelete"]
+                        except KeyError:
+                            pass
+                        try: 
+                            file_action_list = file_action_list + tv["actions"]
+                        except KeyError:
+                            pass
+                if fsystem.fs_session and fsystem.end_mount_session() != 0:
+                    raise ForensicError("Cannot dismount image")
                         
-            """ Implement deletions 
-            First a dummy is written to the root directory to make sure the files entered last
-            are not deleted """
-            if fsystem.mount_image() != 0:
-                failed_list.append([i,"Cannot mount image for deletions"])
-                uitools.errlog("cannot mount for deletions")
-                image.delete()
-                os.remove(mount_file)
-                continue
+        except ForensicError as fe:
+            uitools.errlog(fe)
+            if fsystem.fs_session:
+                fsystem.end_mount_session()
+            os.remove(mount_file)
+            image.delete()
+            return fe
+                    
+        """ Implement deletions 
+        First a dummy is written to the root directory to make sure the files entered last
+        are not deleted """
+        stats.begin("delete")
+        if fsystem.mount_image() != 0:
+            uitools.errlog("cannot mount for deletions")
+            image.delete()
+            os.remove(mount_file)
+            return "Cannot mount image for deletions"
+        try:
+            dfile = open(mountpoint+"/info.txt","w")
+            dfile.write("Created by Forensic test image generator")
+            dfile.write("Case %s, image %d" % (self.name,i))
+            dfile.close()
+        except IOError:
+            uitools.errlog("Cannot write copyright. Not proceeding")
+            fsystem.dismount_image()
+            image.delete()
+            os.remove(mount_file)
+            return "Cannot write copyright"
+         
+        for dfile in file_delete_list:
             try:
-                dfile = open(mountpoint+"/info.txt","w")
-                dfile.write("Created by Forensic test image generator")
-                dfile.write("Case %s, image %d" % (self.name,i))
-                dfile.close()
-            except IOError:
-                failed_list.append([i,"Cannot write copyright"])
-                uitools.errlog("Cannot write copyright. Not proceeding")
+                os.remove(dfile)
+            except (IOError,OSError):
+                uitools.errlog("cannot delete file")
                 fsystem.dismount_image()
                 image.delete()
                 os.remove(mount_file)
-                continue
-             
-            """ flag = temporary variable to detect errors """
-            flag = False    
-            for dfile in file_delete_list:
-                try:
-                    os.remove(dfile)
-                except (IOError,OSError):
-                    failed_list.append([i,"Cannot delete file %s" % dfile])
-                    uitools.errlog("cannot delete file")
-                    fsystem.dismount_image()
-                    image.delete()
-                    os.remove(mount_file)
-                    flag = True
-                    break
-            if flag:
-                continue
-            fsystem.dismount_image() 
-            
-            
-            """ read FS structures once more from scratch """
-            del fsystem           
-
-            fsystem = fsclass(mount_file, mountpoint)
-            fsystem.fs_init()
-            flag = False
-            """ Implement time """
-            for ti in time_command_list:
-                try:
-                    pass
-                    fsystem.change_time(ti[0],dict(all=ti[1]))
-                except ForensicError as fe:
-                    failed_list.append([i,fe])
-                    uitools.errlog(fe)
-                    os.remove(mount_file)
-                    image.delete()
-                    flag = True
-                    break
-            if flag:
-                continue
-            
-            del fsystem
-            fsystem = fsclass(mount_file,mountpoint)
-            fsystem.fs_init()
-            """ implement actions """
-            flag = False
-            for act in file_action_list:
-                try:
-                    fsystem.implement_action(act)
-                except ForensicError as fe:
-                    failed_list.append([i,fe])
-                    uitools.errlog(fe)
-                    os.remove(mount_file)
-                    image.delete()
-                    flag = True
-                    break
-            if flag:
-                continue
-            
-            """ Finally - do file system specific cleanup actions 
-                for NTFS this means setting . in $MftMirr to correspond to $Mft """    
+                return "Cannot delete file %s" % dfile
+        fsystem.dismount_image() 
+        
+        
+        """ the mount invalidated the parsed structures, read them once more """
+        stats.begin("refresh")
+        fsystem.fs_refresh()
+        """ Implement time """
+        stats.begin("timeline")
+        timeline = TimelineEngine(fsystem)
+        timeline.add_list(time_command_list)
+        for path, reason in timeline.apply():
+            uitools.errlog("Timestamps of %s not changed: %s" % (path, reason))
+        
+        """ timestamps were changed through the parsed model, nothing to re-read """
+        fsystem.fs_refresh()
+        """ implement actions """
+        stats.begin("actions")
+        for act in file_action_list:
             try:
-                fsystem.fs_finalise()
+                fsystem.implement_action(act)
             except ForensicError as fe:
-                failed_list.append([i,fe])
                 uitools.errlog(fe)
                 os.remove(mount_file)
                 image.delete()
-                continue               
-            succeed_list.append(i)
-        if removed_chmod != None:
-            setattr(os, "chmod", removed_chmod)
-        return [succeed_list,failed_list]
+                return fe
+        
+        """ Finally - do file system specific cleanup actions 
+            for NTFS this means setting . in $MftMirr to correspond to $Mft """    
+        stats.begin("finalise")
+        try:
+            fsystem.fs_finalise()
+        except ForensicError as fe:
+            uitools.errlog(fe)
+            os.remove(mount_file)
+            image.delete()
+            return fe
+        stats.end()
+        image.save_stages(stats.get_stages())
+        return None
             
 class TrivialStrategy(models.Model):
     TYPES = ((0,"Image"), (1,"Document"), (2,"Email"), (3,"Web"), (4,"Audio"), (5, "Video"), 
@@ -547,8 +658,16 @@ class Image(models.Model):
     def getLongFilename(self):        
         return Chelper().prefix+"/"+self.filename
     
-    def implement_trivial_strategy(self, strategy, dirtime):
-        mountpoint = Chelper().mountpoint
+    """ Stores the wall time and I/O of the build stages of this image """
+    def save_stages(self, stages):
+        ImageStage.objects.bulk_create([ImageStage(image=self, seq=n, **stage) 
+                                        for n, stage in enumerate(stages)])
+
+    """ Copy trivial files of strategy to the image. With a direct writer the 
+    files are written into the image file, otherwise to the mounted image """
+    def implement_trivial_strategy(self, strategy, dirtime, mountpoint=None, writer=None):
+        if mountpoint == None:
+            mountpoint = Chelper().mountpoint
 
         initialdelta = datetime.timedelta(seconds=random.randint(5,360))
         ''' Time difference of directory files will be randomly 0-3 seconds ''' 
@@ -568,19 +687,25 @@ class Image(models.Model):
             files = file_candidates
         
         strategypath = mountpoint+strategy.path
-        try:
-            if not os.path.exists(strategypath):
-                os.makedirs(strategypath)
-                #time_command_list.append([strategypath, dirtime])
-                
-        except OSError:
-            raise ForensicError("cannot create trivial directory")
+        if writer != None:
+            writer.makedirs(strategy.path)
+        else:
+            try:
+                if not os.path.exists(strategypath):
+                    os.makedirs(strategypath)
+                    #time_command_list.append([strategypath, dirtime])
+                    
+            except OSError:
+                raise ForensicError("cannot create trivial directory")
             
 
         for f in files:
             path = f.file.path
             try:
-                shutil.copy(path,strategypath)
+                if writer != None:
+                    writer.copy_file(path, strategy.path)
+                else:
+                    shutil.copy(path,strategypath)
                 tro = TrivialObject(image=self,file=f,path=strategy.path+"/"+f.name, inuse=False)
                 tro.save()
                 b = path.rsplit("/",1)[1]
@@ -707,6 +832,24 @@ class Image(models.Model):
         tfile = TrivialObject.objects.filter(image=self, path = tpath)[0]
         return tfile.inuse
     
+class ImageStage(models.Model):
+    """ Wall time and I/O of one stage of building an image. Hiding methods
+    get a stage each, named "hide <method>" """
+    image = models.ForeignKey(Image)
+    seq = models.IntegerField()
+    name = models.CharField(max_length=64)
+    seconds = models.FloatField()
+    reads = models.BigIntegerField(default=0)
+    bytes_read = models.BigIntegerField(default=0)
+    writes = models.BigIntegerField(default=0)
+    bytes_written = models.BigIntegerField(default=0)
+    write_calls = models.BigIntegerField(default=0)
+    mounts = models.IntegerField(default=0)
+    umounts = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return self.image.filename+":"+self.name
+
 class TrivialObject(models.Model):
     image = models.ForeignKey(Image)
     file = models.ForeignKey(TrivialFileItem)
@@ -745,3 +888,85 @@ class HiddenObject(models.Model):
     def __unicode__(self):
         return self.image.filename+":"+self.location
     
+
+""" Queued image creation. The web UI only queues a job, the forgeworker 
+management command claims queued jobs and runs them. Several workers can run
+on one host, each with its own range of chelper slots """
+JOB_QUEUED = 0
+JOB_RUNNING = 1
+JOB_DONE = 2
+JOB_FAILED = 3
+
+class Job(models.Model):
+    STATES = ((JOB_QUEUED,"Queued"), (JOB_RUNNING,"Running"), (JOB_DONE,"Done"), 
+              (JOB_FAILED,"Failed"))
+    case = models.ForeignKey(Case, blank=True, null=True)
+    webhistory = models.ForeignKey(Webhistory, blank=True, null=True)
+    status = models.IntegerField(choices=STATES, default=JOB_QUEUED)
+    date_created = models.DateTimeField('date created')
+    date_started = models.DateTimeField(blank=True, null=True)
+    date_finished = models.DateTimeField(blank=True, null=True)
+    message = models.CharField(max_length=512, blank=True)
+
+    def __unicode__(self):
+        if self.case != None:
+            return "Job %d: %s" % (self.pk, self.case.name)
+        return "Job %d: %s" % (self.pk, self.webhistory.name)
+
+    @staticmethod
+    def claim_next():
+        """ Oldest queued job, marked running. The conditional update makes 
+        sure two workers never run the same job """
+        for job in Job.objects.filter(status=JOB_QUEUED).order_by("pk"):
+            claimed = Job.objects.filter(pk=job.pk, status=JOB_QUEUED).update(
+                status=JOB_RUNNING, date_started=datetime.datetime.now())
+            if claimed == 1:
+                return Job.objects.get(pk=job.pk)
+        return None
+
+    def run(self, workers=None, first_slot=0):
+        try:
+            if self.case != None:
+                qres = self.case.processCase(workers=workers, job=self, first_slot=first_slot)
+                if qres == None:
+                    raise ForensicError("No file system create command")
+            else:
+                slot = first_slot if first_slot > 0 else None
+                qres = self.webhistory.processWebhistory(slot=slot, job=self)
+            self.message = "%d images created, %d failed" % (len(qres[0]), len(qres[1]))
+            self.status = JOB_DONE if len(qres[0]) > 0 or len(qres[1]) == 0 else JOB_FAILED
+        except ForensicError as fe:
+            uitools.errlog(fe)
+            self.message = str(fe.value)[:512]
+            self.status = JOB_FAILED
+        except Exception as e:
+            """ I/O, parse or database errors of a worker come back through 
+            Pool.map. The job must not stay running """
+            uitools.errlog(format_exc())
+            self.message = ("%s: %s" % (e.__class__.__name__, e))[:512]
+            self.status = JOB_FAILED
+        self.date_finished = datetime.datetime.now()
+        self.save()
+
+    def progress(self):
+        """ Job state for the polling view """
+        images = [dict(seqno=ji.seqno, status=ji.get_status_display(), reason=ji.reason)
+                  for ji in self.jobimage_set.order_by("seqno")]
+        return dict(id=self.pk, status=self.get_status_display(), message=self.message,
+                    finished=self.status in (JOB_DONE, JOB_FAILED),
+                    total=len(images), 
+                    done=len([i for i in images if i["status"] in ("Done", "Failed")]),
+                    images=images)
+
+class JobImage(models.Model):
+    STATES = ((JOB_QUEUED,"Queued"), (JOB_RUNNING,"Running"), (JOB_DONE,"Done"), 
+              (JOB_FAILED,"Failed"))
+    job = models.ForeignKey(Job)
+    seqno = models.IntegerField()
+    status = models.IntegerField(choices=STATES, default=JOB_QUEUED)
+    reason = models.CharField(max_length=512, blank=True)
+    class Meta:
+        unique_together = ('job', 'seqno',)
+
+    def __unicode__(self):
+        return "%d:%d" % (self.job.pk, self.seqno)
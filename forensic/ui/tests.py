@@ -1,16 +1,438 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+'''
+Copyright 2014 Hannu Visti
 
-Replace this with more appropriate tests for your application.
-"""
+This file is part of ForGe forensic test image generator.
+ForGe is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
 
-from django.test import TestCase
+You should have received a copy of the GNU General Public License
+along with ForGe.  If not, see <http://www.gnu.org/licenses/>.
+'''
 
+""" Behaviour tests of the image writers and the structures under them. They
+work on small image files in a temporary directory and need neither root nor
+the database. Run with "manage.py test ui" """
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+import os
+import sys
+import datetime
+import struct
+import random
+import shutil
+import tempfile
+import unittest
+
+""" creator is installed next to forensic """
+CREATORDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "creator"))
+if CREATORDIR not in sys.path:
+    sys.path.append(CREATORDIR)
+
+from fat.fat import FATC
+from fat.fatwriter import FATWriter
+from ntfsparser.ntfsc import NTFSC, _ntfs_set_volume_name
+from ntfsparser.ntfswriter import NTFSWriter
+from bench.synth import format_image, MKFS_NTFS
+from ntfsparser.tools import _fixup_blocks, _fixup_valid, _remove_fixup, _apply_fixup
+from ntfsparser.mftentry import _MftEntry
+from ui.uitools import ForensicError
+from imagefile.timeline import TimelineEngine
+from imagefile.extents import FreeExtentIndex, runs_from_bitmap, runs_from_entries
+
+def format_fat(path, bits, sectors, spc):
+    """ Empty FAT12/16/32 file system of sectors 512 byte sectors, spc sectors
+    per cluster and two FATs, written without mkfs. Returns the last cluster """
+    reserved = 32 if bits == 32 else 1
+    rootentries = 0 if bits == 32 else 512
+    clusters = sectors/spc
+    fatsize = ((clusters+2)*bits/8+511)/512
+    datastart = reserved+2*fatsize+rootentries*32/512
+    last = 1+(sectors-datastart)/spc
+    vbr = bytearray(512)
+    vbr[0:11] = "\xeb\x3c\x90FORGTEST"
+    struct.pack_into("<HBHBHHBHHHII", vbr, 11, 512, spc, reserved, 2, rootentries,
+                     sectors if sectors < 65536 else 0, 0xf8,
+                     fatsize if bits != 32 else 0, 32, 64, 0,
+                     sectors if sectors >= 65536 else 0)
+    if bits == 32:
+        struct.pack_into("<IHHIHH", vbr, 36, fatsize, 0, 0, 2, 1, 6)
+        struct.pack_into("<BxBI11s8s", vbr, 64, 0x80, 0x29, 0x1234abcd, "TEST".ljust(11),
+                         "FAT32".ljust(8))
+        fat = struct.pack("<III", 0x0ffffff8, 0x0fffffff, 0x0fffffff)
+    else:
+        struct.pack_into("<BxBI11s8s", vbr, 36, 0x80, 0x29, 0x1234abcd, "TEST".ljust(11),
+                         ("FAT%d" % bits).ljust(8))
+        fat = "\xf8\xff\xff" if bits == 12 else "\xf8\xff\xff\xff"
+    vbr[510:512] = "\x55\xaa"
+    fh = open(path, "wb")
+    fh.truncate(sectors*512)
+    fh.write(vbr)
+    if bits == 32:
+        """ FSInfo in sector 1, the root directory has cluster 2 """
+        info = bytearray(512)
+        info[0:4] = "RRaA"
+        struct.pack_into("<4sII", info, 484, "rrAa", last-2, 3)
+        info[510:512] = "\x55\xaa"
+        fh.seek(512)
+        fh.write(info)
+        fh.seek(6*512)
+        fh.write(vbr)
+    for i in range(0, 2):
+        fh.seek((reserved+i*fatsize)*512)
+        fh.write(fat)
+    fh.close()
+    return last
+
+class ImageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="forgetest")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fat_image(self, bits):
+        """ [path, last cluster] of a new image of type bits """
+        path = os.path.join(self.tmpdir, "fat%d.img" % bits)
+        sectors, spc = {12: (2048, 1), 16: (16384, 2), 32: (81920, 1)}[bits]
+        return [path, format_fat(path, bits, sectors, spc)]
+
+class FATWriterTest(ImageTestCase):
+    """ Files are written, the image is parsed again from scratch """
+    FILES = {u"/a.txt": "a"*10,
+             u"/Mixed Case Directory/A file with a long name.dat": "long"*3000,
+             u"/docs/deep/er/empty": "",
+             u"/docs/deep/er/replaced.txt": "second version"}
+
+    def write_files(self, path):
+        fs = FATC(path)
+        fs.fs_init()
+        writer = FATWriter(fs)
+        writer.write_file(u"/docs/deep/er/replaced.txt", "first version"*500)
+        for name, data in sorted(self.FILES.items()):
+            writer.write_file(name, data)
+        """ more entries than one cluster of the directory holds """
+        for i in range(0, 40):
+            writer.write_file(u"/many/file number %d.bin" % i, chr(65+i)*(i*100))
+        writer.close()
+
+    def check_round_trip(self, bits):
+        path, last = self.fat_image(bits)
+        self.write_files(path)
+        fs = FATC(path)
+        fs.fs_init()
+        self.assertEqual(fs.fs_fstype, "FAT%d" % bits)
+        files = dict(self.FILES)
+        for i in range(0, 40):
+            files[u"/many/file number %d.bin" % i] = chr(65+i)*(i*100)
+        for name, data in files.items():
+            entry = fs.find_file_by_path(name).link
+            self.assertEqual(entry.d_filesize, len(data), name)
+            self.assertEqual((entry.read_file() or "")[:len(data)], data, name)
+            self.assertEqual(len(entry.d_clusterchain),
+                             (len(data)+fs.f_clustersize-1)/fs.f_clustersize, name)
+
+        """ every FAT copy is the same and FSInfo counts the free clusters """
+        fh = open(path, "rb")
+        copies = []
+        for i in range(0, fs.f_numberoffats):
+            fh.seek((fs.f_reserved+i*fs.f_fatsize)*fs.f_sectorsize)
+            copies.append(fh.read(fs.f_fatsize*fs.f_sectorsize))
+        self.assertEqual(copies[0], copies[1])
+        free = len([c for c in range(2, last+1) if fs.f_fat.ftb[c] == 0])
+        if bits == 32:
+            fh.seek(512)
+            info = fh.read(512)
+            self.assertEqual(struct.unpack("<I", info[488:492])[0], free)
+        fh.close()
+        return free
+
+    def test_fat12(self):
+        self.check_round_trip(12)
+
+    def test_fat16(self):
+        self.check_round_trip(16)
+
+    def test_fat32(self):
+        self.check_round_trip(32)
+
+@unittest.skipUnless(os.path.exists(MKFS_NTFS), "needs "+MKFS_NTFS)
+class NTFSWriterTest(ImageTestCase):
+    def ntfs_image(self):
+        path = os.path.join(self.tmpdir, "ntfs.img")
+        format_image("NTFS", path, 16, 4096)
+        return path
+
+    def test_round_trip(self):
+        path = self.ntfs_image()
+        files = {u"/docs/tiny.txt": "replaced", u"/docs/big.dat": "big"*40000}
+        for i in range(0, 60):
+            files[u"/many/file number %d.bin" % i] = chr(65+i%26)*(i*50)
+        fs = NTFSC(path, self.tmpdir)
+        fs.fs_init()
+        writer = NTFSWriter(fs)
+        writer.write_file(u"/docs/tiny.txt", "first version")
+        for name, data in sorted(files.items()):
+            writer.write_file(name, data)
+        writer.add_stream(u"/docs/tiny.txt", "secret", "hidden"*500)
+        writer.close()
+
+        fs = NTFSC(path, self.tmpdir)
+        fs.fs_init()
+        used = {}
+        for name, data in files.items():
+            record = fs.find_file_by_path(name)
+            self.assertEqual(record.return_unnamed_data().a_size, len(data), name)
+            self.assertEqual(record.mft_data(None, 0, len(data)), data, name)
+            attr = record.return_unnamed_data()
+            """ clusters of non-resident data are allocated in $Bitmap and 
+            belong to one file only """
+            for lcn, length in zip(getattr(attr, "a_lcns", []), getattr(attr, "a_lengths", [])):
+                for c in range(lcn, lcn+length):
+                    self.assertTrue(fs.f_bitmap[c/8] & (1 << (c%8)), name)
+                    self.assertFalse(c in used, name)
+                    used[c] = name
+        record = fs.find_file_by_path(u"/docs/tiny.txt")
+        self.assertEqual(record.mft_data(u"secret", 0, 3000), "hidden"*500)
+
+def _free_runs(bits, lo=0, hi=None):
+    """ Reference: runs [first, length] of zeros in a list of bits """
+    runs = []
+    for n in range(lo, len(bits) if hi == None else hi):
+        if bits[n]:
+            continue
+        if runs and runs[-1][0]+runs[-1][1] == n:
+            runs[-1][1] += 1
+        else:
+            runs.append([n, 1])
+    return runs
+
+def _pack_bits(bits):
+    return "".join([chr(sum([bits[i+b] << b for b in range(0, 8)]))
+                    for i in range(0, len(bits), 8)])
+
+class ExtentIndexTest(unittest.TestCase):
+    """ FreeExtentIndex against a plain list of allocation bits """
+    SIZE = 4096
+
+    def setUp(self):
+        random.seed(4242)
+
+    def random_bits(self):
+        """ long free and used stretches with single bits in between """
+        bits = []
+        while len(bits) < self.SIZE:
+            bits += [random.randint(0, 1)]*random.choice([1, 3, 9, 40, 200])
+        return bits[:self.SIZE]
+
+    def test_runs_from_bitmap(self):
+        for _ in range(0, 20):
+            bits = self.random_bits()
+            self.assertEqual(runs_from_bitmap(_pack_bits(bits)), _free_runs(bits))
+        self.assertEqual(runs_from_bitmap("\xff"*8), [])
+        self.assertEqual(runs_from_bitmap("\x00"*8), [[0, 64]])
+
+    def test_runs_from_entries(self):
+        for width, fmt in [(2, "<H"), (4, "<I")]:
+            values = [random.choice([0, 0, 0, 1, 0x100, 0xffff]) for _ in range(0, 500)]
+            raw = "".join([struct.pack(fmt, v) for v in values])
+            self.assertEqual(runs_from_entries(raw, width), 
+                             _free_runs([1 if v else 0 for v in values]))
+
+    def test_reserve_release_find(self):
+        bits = self.random_bits()
+        lo, hi = 32, self.SIZE-50
+        index = FreeExtentIndex(runs_from_bitmap(_pack_bits(bits)), lo, hi)
+        self.assertEqual(map(list, index.get_runs()), _free_runs(bits, lo, hi))
+        for _ in range(0, 2000):
+            start = random.randint(0, self.SIZE-1)
+            n = random.randint(1, 64)
+            if random.randint(0, 1):
+                index.reserve(start, n)
+                for c in range(start, min(start+n, self.SIZE)):
+                    bits[c] = 1
+            else:
+                index.release(start, n)
+                for c in range(max(start, lo), min(start+n, hi)):
+                    bits[c] = 0
+            expected = _free_runs(bits, lo, hi)
+            self.assertEqual(map(list, index.get_runs()), expected)
+
+            n = random.randint(1, 100)
+            first = index.find(n)
+            if first == -1:
+                self.assertTrue(all([length < n for start, length in expected]))
+            else:
+                self.assertTrue(lo <= first and first+n <= hi)
+                self.assertEqual(bits[first:first+n], [0]*n)
+                self.assertTrue(index.is_free_range(first, n))
+            c = random.randint(0, self.SIZE-1)
+            self.assertEqual(index.is_free(c), lo <= c < hi and bits[c] == 0)
+
+def _record(usn, fixups=3):
+    """ 1024 byte MFT record without fixups, random apart from the header
+    and an empty attribute list """
+    buf = bytearray([random.randint(0, 255) for _ in range(0, 1024)])
+    struct.pack_into("<4sHH", buf, 0, "FILE", 48, fixups)
+    struct.pack_into("<H", buf, 48, usn)
+    struct.pack_into("<HHII", buf, 20, 56, 1, 64, 1024)
+    struct.pack_into("<I", buf, 56, 0xffffffff)
+    return buf
+
+class _RecordSink(object):
+    """ Parent of an _MftEntry, keeps what would go to the image """
+    def __init__(self):
+        self.writes = []
+
+    def write_record(self, number, location, data):
+        self.writes.append([location, data])
+
+class FixupTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(4242)
+
+    def test_round_trip(self):
+        record = _record(0x1234)
+        disk = _apply_fixup(bytearray(record))
+        usn = struct.pack("<H", 0x1235)
+        self.assertEqual(str(disk[48:50]), usn)
+        self.assertEqual(str(disk[510:512]), usn)
+        self.assertEqual(str(disk[1022:1024]), usn)
+        self.assertTrue(_fixup_valid(disk))
+        restored = _remove_fixup(bytearray(disk))
+        """ only the sequence number and the saved block ends differ """
+        self.assertEqual(restored[:48], record[:48])
+        self.assertEqual(restored[54:], record[54:])
+
+    def test_usn_mismatch(self):
+        for position in (510, 1023):
+            disk = _apply_fixup(_record(7))
+            disk[position] ^= 1
+            self.assertFalse(_fixup_valid(disk))
+
+    def test_usn_wraps(self):
+        for old, new in [(0xffff, 1), (0, 1), (1, 2)]:
+            disk = _apply_fixup(_record(old))
+            self.assertEqual(struct.unpack_from("<H", disk, 48)[0], new)
+
+    def test_garbage_header(self):
+        """ unused records may hold anything, the block count is cut down """
+        buf = _record(5, fixups=0xffff)
+        self.assertEqual(_fixup_blocks(buf), (48, 2))
+        struct.pack_into("<H", buf, 4, 1020)
+        self.assertEqual(_fixup_blocks(buf)[1], 1)
+        _remove_fixup(bytearray(buf))
+        _fixup_valid(buf)
+
+    def test_record_write(self):
+        sink = _RecordSink()
+        entry = _MftEntry(str(_apply_fixup(_record(9))), sink, 4096)
+        entry.write_location(4096+200, "changed")
+        self.assertEqual(len(sink.writes), 1)
+        location, data = sink.writes[0]
+        disk = bytearray(data)
+        self.assertEqual(location, 4096)
+        self.assertTrue(_fixup_valid(disk))
+        self.assertEqual(struct.unpack_from("<H", disk, 48)[0], 11)
+        self.assertEqual(str(_remove_fixup(disk)[200:207]), "changed")
+
+    def test_torn_record_is_not_written(self):
+        sink = _RecordSink()
+        disk = _apply_fixup(_record(9))
+        disk[1022] ^= 1
+        entry = _MftEntry(str(disk), sink, 4096)
+        self.assertRaises(ForensicError, entry.write_location, 4096+200, "changed")
+        self.assertEqual(sink.writes, [])
+
+class VolumeNameTest(unittest.TestCase):
+    def volume_record(self, used):
+        """ $Volume with a resident $VOLUME_NAME at 56, its end marker at 88 """
+        record = _record(3)
+        struct.pack_into("<IIIHHIHH", record, 56, 0x60, 32, 0, 0, 0, 4, 24, 0)
+        record[80:88] = "O\0L\0\0\0\0\0"
+        struct.pack_into("<I", record, 88, 0xffffffff)
+        struct.pack_into("<I", record, 24, used)
+        return str(_apply_fixup(record))
+
+    def test_set_name(self):
+        disk = bytearray(_ntfs_set_volume_name(self.volume_record(96), u"New label"))
+        self.assertTrue(_fixup_valid(disk))
+        record = _remove_fixup(disk)
+        value = u"New label".encode("utf-16-le")
+        self.assertEqual(struct.unpack_from("<II", record, 56), (0x60, 48))
+        self.assertEqual(struct.unpack_from("<I", record, 72)[0], len(value))
+        self.assertEqual(str(record[80:80+len(value)]), value)
+        self.assertEqual(struct.unpack_from("<I", record, 104)[0], 0xffffffff)
+        self.assertEqual(struct.unpack_from("<I", record, 24)[0], 112)
+
+    def test_name_not_found(self):
+        """ the walk runs out of used bytes before the attribute """
+        self.assertRaises(ForensicError, _ntfs_set_volume_name, 
+                          self.volume_record(60), u"x")
+        self.assertRaises(ForensicError, _ntfs_set_volume_name, 
+                          str(_apply_fixup(_record(3))), u"x")
+
+class _FailingFS(object):
+    """ File system whose targets cannot be changed """
+    def __init__(self):
+        self.calls = []
+
+    def timeline_target(self, path):
+        if path.startswith("/missing"):
+            raise ForensicError("File not found: "+path)
+        return [path[:2], path[:2]]
+
+    def timeline_begin(self):
+        self.calls.append("begin")
+
+    def change_times(self, target, btimes):
+        if target == "/b":
+            raise ForensicError("Cannot write "+target)
+        self.calls.append([target, len(btimes)])
+
+    def timeline_end(self):
+        self.calls.append("end")
+
+    def fs_flush(self):
+        self.calls.append("flush")
+
+class TimelineTest(ImageTestCase):
+    def test_fat_timeline(self):
+        path = self.fat_image(16)[0]
+        fs = FATC(path)
+        fs.fs_init()
+        writer = FATWriter(fs)
+        writer.write_file(u"/one.txt", "one")
+        writer.write_file(u"/dir/two.txt", "two")
+        writer.close()
+
+        fs = FATC(path)
+        fs.fs_init()
+        first = datetime.datetime(2010, 5, 6, 7, 8, 10)
+        second = datetime.datetime(2012, 1, 2, 3, 4, 6)
+        engine = TimelineEngine(fs)
+        engine.add_list([[u"/one.txt", first], [u"/missing.txt", first],
+                         [u"/dir/two.txt", first]])
+        """ a later change of the same file wins """
+        engine.add(u"/dir/two.txt", dict(mtime=second))
+        self.assertEqual(engine.apply(),
+                         [[u"/missing.txt", "File not found: /missing.txt"]])
+
+        fs = FATC(path)
+        fs.fs_init()
+        self.assertEqual(fs.find_file_by_path(u"/one.txt").link.d_time.mtime, first)
+        self.assertEqual(fs.find_file_by_path(u"/dir/two.txt").link.d_time.mtime, second)
+
+    def test_failed_paths(self):
+        fs = _FailingFS()
+        engine = TimelineEngine(fs)
+        now = datetime.datetime(2014, 1, 1)
+        for path in ["/b2", "/a", "/missing", "/b1", "/b2", "/c"]:
+            engine.add(path, now)
+        failed = engine.apply()
+        """ every path of a failed target is reported once """
+        self.assertEqual(failed, [["/missing", "File not found: /missing"],
+                                  ["/b1", "Cannot write /b"],
+                                  ["/b2", "Cannot write /b"]])
+        self.assertEqual(fs.calls, ["begin", ["/a", 1], ["/c", 1], "end", "flush"])
+        self.assertEqual(engine.apply(), [])
@@ -32,6 +32,9 @@ urlpatterns = patterns('',
     url(r'^images$', views.imageView, name='image'),  
     url(r'^webhistory/(?P<iid>\d+)/$', views.webhistoryView, name='webhistory'),
     url(r'^webhistory$', views.webhistoryView, name='webhistory'),  
+    url(r'^jobs/(?P<jid>\d+)/status$', views.jobStatusView, name='jobstatus'),
+    url(r'^jobs/(?P<jid>\d+)/$', views.jobView, name='job'),
+    url(r'^jobs$', views.jobView, name='job'),
     url(r'^solution$', views.solutionView, name='solution'),
     url(r'^solution/(?P<iid>\d+)/$', views.solutionView, name='solution'),
 )
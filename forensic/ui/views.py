@@ -19,15 +19,16 @@ from django.views import generic
 
 from django.db import DatabaseError
 import sys
+import json
 import datetime
 from django.core.context_processors import csrf
 from django.shortcuts import render, get_object_or_404, render_to_response
 from ui.forms import RequestCaseForm,RequestWebhistoryForm
-from ui.uitools import errlog
+from ui.uitools import errlog, Chelper
 
 from ui.models import Case, TrivialFileItem, User, FileSystem, HidingMethod
 from ui.models import  SecretFileItem, SecretStrategy, Image, Webhistory
-from ui.models import HiddenObject, TrivialObject, WebMethod
+from ui.models import HiddenObject, TrivialObject, WebMethod, Job
 
 class Selection():
     selected = 0
@@ -244,6 +245,10 @@ def imageView(request, iid=-1):
             case = Case.objects.get(pk=iid)
             if not case:
                 return HttpResponseRedirect("/ui/images")
+            if Chelper().async_jobs:
+                job = Job(case=case, date_created=datetime.datetime.now())
+                job.save()
+                return HttpResponseRedirect("/ui/jobs/"+str(job.pk)+"/")
             qres = case.processCase()
             if qres:
                 return render(request, "ui/creationreport.html", 
@@ -278,6 +283,10 @@ def webhistoryView(request, iid=-1):
             case = Webhistory.objects.get(pk=iid)
             if not case:
                 return HttpResponseRedirect("/ui/webhistory")
+            if Chelper().async_jobs:
+                job = Job(webhistory=case, date_created=datetime.datetime.now())
+                job.save()
+                return HttpResponseRedirect("/ui/jobs/"+str(job.pk)+"/")
             qres = case.processWebhistory()
             if qres:
                 return render(request, "ui/creationreport.html", 
@@ -298,6 +307,25 @@ def webhistoryView(request, iid=-1):
         
     return render(request, "ui/webhistory.html", {"form": form, "active_cases": table})
  
+def jobView(request, jid=-1):
+    table = Job.objects.order_by("-pk")[:50]
+    job = None
+    if jid != -1:
+        try:
+            job = Job.objects.get(pk=jid)
+        except Job.DoesNotExist:
+            return HttpResponseRedirect("/ui/jobs")
+    return render(request, "ui/jobs.html", {"jobs": table, "job": job})
+
+def jobStatusView(request, jid):
+    """ Progress of a job as JSON, polled by the job page """
+    try:
+        job = Job.objects.get(pk=jid)
+    except Job.DoesNotExist:
+        return HttpResponse(json.dumps({"error": "no such job"}), status=404,
+                            content_type="application/json")
+    return HttpResponse(json.dumps(job.progress()), content_type="application/json")
+
 def solutionView(request, iid=-1):
     table = Case.objects.all()
     if request.method == "POST":
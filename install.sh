@@ -110,6 +110,7 @@ if [ ! "$2" = "CODE" ]; then
 	rm chelper.c
 	rm chelper.h_
 	rm lxc.c
+	rm daemon.c
 fi
 
 cd $APPDIR
@@ -143,6 +144,8 @@ echo "all done. Now exit root, change to $APPDIR/forensic"
 echo "and run python manage.py syncdb"
 echo "Finally start Django"
 echo "python manage.py runserver"
+echo "and the image creation worker"
+echo "python manage.py forgeworker"
 
 
 